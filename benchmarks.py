@@ -0,0 +1,452 @@
+#!/usr/bin/env python
+# _*_ coding: utf-8 _*_
+"""
+Benchmarks for the simulation hot paths and for whole scenarios.
+
+Each benchmark reports the cost of an operation as the network involved
+grows, along with how that cost scales: the exponent k in time ~ N^k fitted
+across sizes. Results can be written to JSON and compared against a baseline
+written earlier, so that changes to the complexity of the toolkit show up as
+numbers:
+
+    ./benchmarks.py --output baseline.json
+    ./benchmarks.py --baseline baseline.json
+    ./benchmarks.py --sizes 10,100,1000,5000 --scenario-sizes 10,100,1000 --repeat 500
+
+With --baseline the exit status is 1 if anything got slower than --tolerance
+allows.
+
+--interpreters times the scenarios under each of a list of interpreters
+instead, and checks that each scenario comes out the same under all of them:
+
+    ./benchmarks.py --interpreters python2,python3,pypy3 --scenario-sizes 10,100
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import hashlib
+import platform
+import tempfile
+import subprocess
+import utils
+import engines
+import optparse
+import scenarios
+
+# TBucket.calculate_trust() grows too quickly for the routing table sizes the
+# other benchmarks use.
+TBUCKET_SIZES = [5, 10, 20]
+
+def row(**columns):
+    # utils.table() sizes columns by their values, so pad values to at least
+    # the width of their headings.
+    return dict((k, str(v).ljust(len(k))) for k, v in columns.items())
+
+def measure(benchmark, size, seconds, variant=""):
+    """
+    A measurement of seconds per call of benchmark at size, where variant
+    tells apart implementations or scenarios measured under one benchmark.
+    """
+    return {"benchmark": benchmark, "variant": variant, "size": size,
+            "seconds": seconds}
+
+def duration(seconds):
+    if seconds < 0.001:
+        return "%.3fus" % (seconds * 1000000)
+    if seconds < 1:
+        return "%.3fms" % (seconds * 1000)
+    return "%.3fs" % seconds
+
+def build_pair(size):
+    """
+    Return two routers who already know the same set of size peers, so that
+    transact_with() exercises the gossip merge without having anything to add.
+    """
+    others = [utils.Router() for _ in range(size)]
+    a, b   = utils.Router(), utils.Router()
+
+    routers = utils.RouterDirectory(others + [a, b])
+    for router in (a, b):
+        router.routers = routers
+        router.peers   = [r.node.copy() for r in others]
+    a.peers.append(b.node.copy())
+    b.peers.append(a.node.copy())
+    return a, b
+
+def bench_transact_with(sizes, repeat):
+    """
+    Time Router.transact_with() against a peer whose routing table is the same
+    size as ours, once both tables have converged.
+    """
+    results = []
+    for size in sizes:
+        a, b = build_pair(size)
+        peer = a.get(b.node.threeple)
+
+        start = time.time()
+        for _ in range(repeat):
+            a.transact_with(peer)
+        results.append(measure("transact_with", size, (time.time() - start) / repeat))
+    return results
+
+def bench_get(sizes, repeat):
+    """
+    Time Router.get() for the last peer in the routing table.
+    """
+    results = []
+    for size in sizes:
+        a, b     = build_pair(size)
+        nodeple  = a.peers[-1].threeple
+
+        start = time.time()
+        for _ in range(repeat):
+            a.get(nodeple)
+        results.append(measure("get", size, (time.time() - start) / repeat))
+    return results
+
+def build_bucket(size, members=5):
+    """
+    Return a router who knows size peers, members of which are pre-trusted.
+    Everyone has only had satisfactory transactions with one another.
+    """
+    rng     = utils.Stream(size)
+    others  = [utils.Router() for _ in range(size)]
+    router  = utils.Router()
+    # Random ports collide often enough at these sizes to matter.
+    ports   = rng.sample(range(1, 100000), size + 1)
+    for r, port in zip(others + [router], ports):
+        r.node.port = r.node.long_id = port
+
+    routers = utils.RouterDirectory(others + [router])
+    for r in others + [router]:
+        r.routers = routers
+        r.peers   = [o.node.copy() for o in routers if o != r]
+        # Varied ratings, as in a network that's been running a while.
+        for peer in r.peers:
+            peer.transactions = rng.randint(100, 4000)
+            peer.trust        = 0.5 + (peer.transactions * peer.epsilon)
+    for peer in router.peers[:members]:
+        router.tbucket[peer.long_id] = peer
+    return router
+
+def bench_calculate_trust(sizes, repeat):
+    """
+    Time PTPBucket.calculate_trust() with the reference implementation and with
+    each PTPBucket engine in engines.map.
+    """
+    implementations = [("python", None)]
+    for name, engine in sorted(engines.map.items()):
+        if engine.bucket is not utils.PTPBucket:
+            continue
+        try:
+            implementations.append((name, engine()))
+        except ImportError:
+            pass
+
+    results = []
+    for size in sizes:
+        router = build_bucket(size)
+        for name, engine in implementations:
+            router.tbucket.engine = engine
+            start = time.time()
+            for _ in range(repeat):
+                router.tbucket.calculate_trust()
+            results.append(measure("PTPBucket.calculate_trust", size,
+                                   (time.time() - start) / repeat, name))
+    return results
+
+def bench_tbucket(sizes, repeat):
+    """
+    Time TBucket.calculate_trust() for a router who knows size peers.
+    """
+    results = []
+    for size in sizes:
+        router         = build_bucket(size, members=0)
+        router.tbucket = utils.TBucket(router)
+        router.tbucket.append(router.peers[:2])
+        start = time.time()
+        for _ in range(repeat):
+            router.tbucket.calculate_trust()
+        results.append(measure("TBucket.calculate_trust", size,
+                               (time.time() - start) / repeat))
+    return results
+
+def build_options(size, transactions=10):
+    return optparse.Values({"nodes": size, "pre_trusted": 2,
+                            "transactions": transactions, "verbose": False,
+                            "no_prisoners": False, "batch": False, "sense_jobs": 0})
+
+def bench_generate_routers(sizes, repeat):
+    """
+    Time utils.generate_routers() for networks of size routers.
+    """
+    results = []
+    for size in sizes:
+        start = time.time()
+        for _ in range(repeat):
+            utils.generate_routers(build_options(size))
+        results.append(measure("generate_routers", size, (time.time() - start) / repeat))
+    return results
+
+def bench_introduce(sizes):
+    """
+    Time utils.introduce() making size routers aware of one another.
+    """
+    results = []
+    for size in sizes:
+        routers = utils.generate_routers(build_options(size))
+        start   = time.time()
+        utils.introduce(routers)
+        results.append(measure("introduce", size, time.time() - start))
+    return results
+
+def build_network(size, degree=20):
+    """
+    Return size routers who each know degree of the others at random.
+    """
+    rng     = utils.Stream(size)
+    routers = utils.RouterDirectory(utils.Router() for _ in range(size))
+    for router in routers:
+        router.routers = routers
+        router.peers   = [r.node.copy() for r in rng.sample(routers, min(degree, size))
+                          if r != router]
+        for peer in router.peers:
+            peer.transactions = rng.randint(1, 1000)
+            peer.trust        = 0.5 + rng.randint(-peer.transactions, peer.transactions) * peer.epsilon
+    for router in routers[:max(size // 100, 1)]:
+        routers[0].tbucket[router.node.long_id] = router.node
+    return routers
+
+def bench_eigentrust(sizes):
+    """
+    Time a global EigenTrust solve over networks of size routers.
+    """
+    results = []
+    try:
+        engine = engines.EigenTrust()
+    except ImportError:
+        return results
+    for size in sizes:
+        routers = build_network(size)
+        bucket  = utils.TBucket(routers[0])
+        start   = time.time()
+        engine.solve(routers, bucket.beta, bucket.iterations)
+        results.append(measure("EigenTrust.solve", size, time.time() - start))
+    return results
+
+def fingerprint(routers):
+    """
+    A digest of how a run ended: each router's routing table and its members
+    of P and EP, in order.
+    """
+    digest = hashlib.sha1()
+    for router in routers:
+        bucket = router.tbucket
+        digest.update(repr((
+            router.node.port,
+            [(p.port, p.trust, p.transactions) for p in router.peers],
+            list(bucket.keys()),
+            list(getattr(bucket, "extent", {}).keys()),
+        )).encode("utf-8"))
+    return digest.hexdigest()
+
+def bench_scenarios(sizes, transactions, names=None):
+    """
+    Time whole runs of each scenario in scenarios.map with --nodes size.
+    Scenarios are seeded so that every run of the benchmark does the same
+    work. Some have a minimum network size or round count of their own.
+    Replays need a trace, so they're only run if named.
+    """
+    results = []
+    for size in sizes:
+        for name in sorted(names or [n for n in scenarios.map if n != "replay"]):
+            utils.set_seed(("benchmark", name, size))
+            start = time.time()
+            returned = scenarios.map[name](build_options(size, transactions))
+            result   = measure("scenario", size, time.time() - start, name)
+            result["fingerprint"] = fingerprint(returned.get("routers", []))
+            results.append(result)
+    utils.set_seed(None)
+    return results
+
+def interpreter(command, arguments):
+    """
+    Run this script's scenario benchmarks under the interpreter command, such
+    as "pypy3", and return what it wrote with --output.
+    """
+    fd, path = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call(command.split() + [os.path.abspath(__file__),
+                                  "--only-scenarios", "--output", path] + arguments,
+                                  stdout=devnull)
+        with open(path) as fd:
+            return json.load(fd)
+    finally:
+        os.remove(path)
+
+def interpreters(runs):
+    """
+    Return a row for each scenario and size comparing how long it took under
+    each interpreter with the first, and whether it came out the same.
+    """
+    measured = [dict(((r["variant"], r["size"]), r) for r in run["results"]) for run in runs]
+    rows     = []
+    for r in runs[0]["results"]:
+        key     = (r["variant"], r["size"])
+        columns = {"Scenario": r["variant"], "N": r["size"]}
+        for run, results in zip(runs, measured):
+            seconds = results[key]["seconds"]
+            columns[run["interpreter"]] = "%s (%.2fx)" % \
+                (duration(seconds), r["seconds"] / seconds if seconds else 0)
+        columns["Same"] = "yes" if len(set(results[key]["fingerprint"]
+                                           for results in measured)) == 1 else "NO"
+        rows.append(row(**columns))
+    return rows
+
+def scaling(results):
+    """
+    Return the exponent k in seconds ~ size^k fitted by least squares to each
+    benchmark and variant measured at more than one size, by (benchmark,
+    variant).
+    """
+    curves = {}
+    for result in results:
+        if result["seconds"] > 0:
+            curves.setdefault((result["benchmark"], result["variant"]), []).append(
+                (math.log(result["size"]), math.log(result["seconds"])))
+    exponents = {}
+    for key, points in curves.items():
+        if len(set(x for x, y in points)) < 2:
+            continue
+        mx = sum(x for x, y in points) / len(points)
+        my = sum(y for x, y in points) / len(points)
+        exponents[key] = sum((x - mx) * (y - my) for x, y in points) / \
+                         sum((x - mx) ** 2 for x, y in points)
+    return exponents
+
+def tabulate(results, exponents):
+    rows = []
+    for r in results:
+        rows.append(row(**{
+            "Benchmark": r["benchmark"],
+            "Variant":   r["variant"] or "-",
+            "N":         r["size"],
+            "Per Call":  duration(r["seconds"]),
+            "Scaling":   "N^%.2f" % exponents[(r["benchmark"], r["variant"])]
+                         if (r["benchmark"], r["variant"]) in exponents else "-",
+        }))
+    return rows
+
+def compare(results, baseline, tolerance):
+    """
+    Return a row for each measurement also in baseline and how many of them
+    are slower than baseline by more than a factor of tolerance.
+    """
+    before = dict(((r["benchmark"], r["variant"], r["size"]), r["seconds"])
+                  for r in baseline["results"])
+    rows, regressions = [], 0
+    for r in results:
+        key = (r["benchmark"], r["variant"], r["size"])
+        if not key in before or not before[key]:
+            continue
+        ratio = r["seconds"] / before[key]
+        regressions += ratio > tolerance
+        rows.append(row(**{
+            "Benchmark": r["benchmark"],
+            "Variant":   r["variant"] or "-",
+            "N":         r["size"],
+            "Baseline":  duration(before[key]),
+            "Now":       duration(r["seconds"]),
+            "Ratio":     "%.2fx%s" % (ratio, " slower" if ratio > tolerance else ""),
+        }))
+    return rows, regressions
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(prog=sys.argv[0], description="Benchmark the toolkit's hot paths.")
+    parser.add_option("--sizes",          dest="sizes", action="store", default="10,100,1000,5000", help="Routing table sizes (default: 10,100,1000,5000)")
+    parser.add_option("--repeat",         dest="repeat", action="store", default=200, help="Calls per size (default: 200)")
+    parser.add_option("--scenario-sizes", dest="scenario_sizes", action="store", default="10", help="Network sizes to run each scenario at (default: 10)")
+    parser.add_option("--transactions",   dest="transactions", action="store", default=10, help="Rounds per scenario run (default: 10)")
+    parser.add_option("--scenarios",      dest="scenarios", action="store", default=None, help="Scenarios to run (default: all)")
+    parser.add_option("--output",         dest="output", action="store", default=None, help="Write results to this JSON file")
+    parser.add_option("--baseline",       dest="baseline", action="store", default=None, help="Compare results against this JSON file")
+    parser.add_option("--tolerance",      dest="tolerance", action="store", default=1.25, help="Slowdown over baseline to report as a regression (default: 1.25)")
+    parser.add_option("--only-scenarios", dest="only_scenarios", action="store_true", default=False, help="Only time whole scenarios")
+    parser.add_option("--interpreters",   dest="interpreters", action="store", default=None, help="Time scenarios under each of these interpreters, e.g. python2,python3,pypy3")
+    (options, args) = parser.parse_args()
+
+    if options.interpreters:
+        arguments = ["--scenario-sizes", options.scenario_sizes,
+                     "--transactions", str(options.transactions)]
+        if options.scenarios:
+            arguments += ["--scenarios", options.scenarios]
+        runs = []
+        for command in options.interpreters.split(","):
+            try:
+                runs.append(interpreter(command, arguments))
+            except (OSError, subprocess.CalledProcessError) as e:
+                print("Error: %s: %s" % (command, e))
+                raise SystemExit(1)
+            runs[-1]["interpreter"] = command
+        rows = interpreters(runs)
+        utils.log("Compared with %s:", options.interpreters.split(",")[0])
+        utils.table(rows, columns=["Scenario", "N"] + options.interpreters.split(",") + ["Same"])
+        if options.output:
+            with open(options.output, "w") as fd:
+                json.dump({"created": time.time(), "runs": runs}, fd, indent=2, sort_keys=True)
+            utils.log("Wrote %s.", options.output)
+        differences = sum(r["Same"].strip() != "yes" for r in rows)
+        if differences:
+            utils.log("%i scenarios came out differently.", differences)
+            utils.flush()
+            raise SystemExit(1)
+        raise SystemExit
+
+    sizes          = [int(_) for _ in options.sizes.split(",")]
+    scenario_sizes = [int(_) for _ in options.scenario_sizes.split(",")]
+    repeat         = int(options.repeat)
+    names          = options.scenarios.split(",") if options.scenarios else None
+
+    utils.set_log_level(utils.WARNING)
+    results  = []
+    if not options.only_scenarios:
+        results += bench_transact_with(sizes, repeat)
+        results += bench_get(sizes, repeat)
+        results += bench_calculate_trust([s for s in sizes if s <= 1000], max(repeat // 100, 1))
+        results += bench_tbucket(TBUCKET_SIZES, 1)
+        results += bench_generate_routers([s for s in sizes if s <= 1000], max(repeat // 100, 1))
+        results += bench_introduce([s for s in sizes if s <= 1000])
+        results += bench_eigentrust([s * 2 for s in sizes])
+    results += bench_scenarios(scenario_sizes, int(options.transactions), names)
+    utils.set_log_level(utils.INFO)
+
+    exponents = scaling(results)
+    utils.table(tabulate(results, exponents),
+                columns=("Benchmark", "Variant", "N", "Per Call", "Scaling"))
+
+    if options.output:
+        with open(options.output, "w") as fd:
+            json.dump({
+                "python":  sys.version.split()[0],
+                "implementation": platform.python_implementation(),
+                "created": time.time(),
+                "results": results,
+                "scaling": [{"benchmark": b, "variant": v, "exponent": k}
+                            for (b, v), k in sorted(exponents.items())],
+            }, fd, indent=2, sort_keys=True)
+        utils.log("Wrote %s.", options.output)
+
+    if options.baseline:
+        with open(options.baseline) as fd:
+            rows, regressions = compare(results, json.load(fd), float(options.tolerance))
+        utils.log("Compared with %s:", options.baseline)
+        utils.table(rows, columns=("Benchmark", "Variant", "N", "Baseline", "Now", "Ratio"))
+        if regressions:
+            utils.log("%i measurements regressed.", regressions)
+            utils.flush()
+            raise SystemExit(1)
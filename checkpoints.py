@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# _*_ coding: utf-8 _*_
+"""
+Checkpoints of runs in rounds.
+
+Given --checkpoint, a scenario saves the state of its network to that file
+every --checkpoint-every rounds, and --resume continues a run from the round
+the file it's given was saved at:
+
+    ./eigentrust.py -s F -n 1000 -t 10000 --seed 1 --checkpoint f.npz
+    ./eigentrust.py --resume f.npz --checkpoint f.npz
+
+A checkpoint is a compressed numpy .npz archive of columns: one row per
+router, per entry in a routing table and per member of a PTPBucket, along with
+the state of every random number generator, the sensing schedule and
+utils.counters. Columns are written one at a time as they're built. It's
+written to a temporary file that then replaces the last checkpoint, so
+a run interrupted while saving leaves the last checkpoint as it was.
+
+Resuming runs the scenario's setup again from the same seed, or from the state
+the random module was in when the run began, then overwrites the network it
+sets up with the checkpointed one. Anything a scenario keeps outside of its
+routers, like which routers are in its collective, is taken from setup, so it
+must be the same at every round. What calculate_trust() and snapshot() cache
+is left out and worked out again, as is how far routers had got when they last
+gossiped, so their first merges after resuming compare tables in full.
+
+A resumed run takes the same course as one that wasn't interrupted, on
+whichever interpreter it's resumed with.
+"""
+import io
+import os
+import json
+import zipfile
+import utils
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+VERSION = 1
+
+# What the random module was in when the run began. See begin().
+origin = None
+
+# The options a resumed run takes from its checkpoint.
+OPTIONS = ("scenario", "nodes", "pre_trusted", "transactions", "no_prisoners",
+           "sense_every", "k_bucket")
+
+# Router attributes saved in columns of their own, or not at all. Any others
+# that a scenario's subclasses add and that JSON can hold are saved with each
+# router, like threat model C's responses.
+ATTRIBUTES = ("id", "node", "index", "network", "no_prisoners", "version",
+              "_peers", "routers", "tbucket", "probably_malicious", "rendered",
+              "frozen", "gossiped", "random", "serial")
+
+def begin():
+    """
+    Note the state of the random module before a scenario sets up its network,
+    which is what setup draws from when there's no seed.
+    """
+    global origin
+    origin = random.getstate()
+
+def state_columns(states):
+    """
+    Return columns for a list of random.getstate()s.
+    """
+    return {
+        "states":  numpy.array([s[1] for s in states], dtype=numpy.uint32).reshape(-1, 625),
+        "gauss":   numpy.array([numpy.nan if s[2] is None else s[2] for s in states]),
+    }
+
+def state_rows(states, gauss):
+    """
+    Turn columns from state_columns() back into random.getstate()s.
+    """
+    return [(3, tuple(int(n) for n in s), None if numpy.isnan(g) else float(g))
+            for s, g in zip(states, gauss)]
+
+def node_columns(prefix, nodes, serials):
+    """
+    Yield a column per Node attribute for the nodes that calling nodes()
+    gives, where the router each one represents is given by its serial. Each
+    column is built with a fresh pass over them.
+    """
+    def numbers(attribute, dtype):
+        return numpy.fromiter((attribute(n) for n in nodes()), dtype=dtype)
+
+    yield prefix + "id",           numpy.array([n.id for n in nodes()], dtype=str)
+    yield prefix + "ip",           numpy.array([n.ip for n in nodes()], dtype=str)
+    yield prefix + "port",         numbers(lambda n: n.port, numpy.int64)
+    # Long IDs needn't fit in 64 bits.
+    yield prefix + "long_id",      numpy.array([str(n.long_id) for n in nodes()], dtype=str)
+    yield prefix + "trust",        numbers(lambda n: n.trust, numpy.float64)
+    yield prefix + "transactions", numbers(lambda n: n.transactions, numpy.int64)
+    yield prefix + "epsilon",      numbers(lambda n: n.epsilon, numpy.float64)
+    yield prefix + "seen",         numbers(lambda n: n.seen, numpy.int64)
+    yield prefix + "router",       numbers(lambda n: serials.get(id(n.router), -1), numpy.int64)
+
+def text(column):
+    """
+    Return a column of strings as a list of this interpreter's str, whichever
+    interpreter saved it.
+    """
+    return column.astype(str).tolist()
+
+def node_rows(data, prefix, routers):
+    """
+    Return the Nodes in columns from node_columns(), given routers by serial.
+    """
+    columns = [data[prefix + name].tolist() for name in
+               ("port", "trust", "transactions", "epsilon", "router")]
+    columns = [text(data[prefix + name]) for name in ("id", "ip", "long_id")] + columns
+    # Checkpoints from before KBucketTable don't say when peers were last seen.
+    if prefix + "seen" in data:
+        columns.append(data[prefix + "seen"].tolist())
+    else:
+        columns.append([0] * len(columns[0]))
+    nodes = []
+    for node_id, ip, long_id, port, trust, transactions, epsilon, serial, seen in zip(*columns):
+        node              = utils.Node(ip=ip, port=port, router=routers.get(serial))
+        node.id           = node_id
+        node.long_id      = int(long_id)
+        node.trust        = trust
+        node.transactions = transactions
+        node.epsilon      = epsilon
+        node.seen         = seen
+        nodes.append(node)
+    return nodes
+
+def extras(router):
+    """
+    Return the attributes of router beyond those of Router, as JSON.
+    """
+    found = {}
+    for name, value in vars(router).items():
+        if name in ATTRIBUTES:
+            continue
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            continue
+        found[name] = value
+    return json.dumps(found)
+
+def columns(n, network, scheduler, options):
+    """
+    Yield the columns of a checkpoint of the routers reachable from network at
+    the start of round n, one at a time, by name.
+    """
+    routers = utils.reachable(network)
+    serials = dict((id(r), r.serial) for r in routers)
+
+    # Directories, the scenario's own first.
+    directories, indices = [network], {id(network): 0}
+    for router in routers:
+        if not id(router.routers) in indices:
+            indices[id(router.routers)] = len(directories)
+            directories.append(router.routers)
+
+    header = {
+        "version":  VERSION,
+        "round":    n,
+        "options":  dict((name, getattr(options, name, None)) for name in OPTIONS),
+        "seed":     utils.seed,
+        "created":  utils.Router.created,
+        "counters": {"totals": utils.counters, "snapshots": utils.counters.snapshots},
+    }
+    yield "header",            numpy.array(json.dumps(header))
+    yield "serial",            numpy.array([r.serial for r in routers], dtype=numpy.int64)
+    yield "kind",              numpy.array([type(r).__name__ for r in routers], dtype=str)
+    yield "router_id",         numpy.array([r.id for r in routers], dtype=str)
+    yield "malicious",         numpy.array([bool(r.probably_malicious) for r in routers])
+    yield "no_prisoners",      numpy.array([-1 if r.no_prisoners is None else int(r.no_prisoners)
+                                            for r in routers], dtype=numpy.int8)
+    yield "router_version",    numpy.array([r.version for r in routers], dtype=numpy.int64)
+    yield "directory",         numpy.array([indices[id(r.routers)] for r in routers],
+                                           dtype=numpy.int64)
+    yield "consensus_events",  numpy.array([r.tbucket.consensus_events for r in routers],
+                                           dtype=numpy.int64)
+    yield "extras",            numpy.array([extras(r) for r in routers], dtype=str)
+    yield "peer_counts",       numpy.array([len(r.peers) for r in routers], dtype=numpy.int64)
+    yield "p_counts",          numpy.array([len(r.tbucket) for r in routers], dtype=numpy.int64)
+    yield "ep_counts",         numpy.array([len(r.tbucket.extent) for r in routers],
+                                           dtype=numpy.int64)
+    yield "directory_kind",    numpy.array([isinstance(d, utils.RouterDirectory)
+                                            for d in directories])
+    yield "directory_counts",  numpy.array([len(d) for d in directories], dtype=numpy.int64)
+    yield "directory_members", numpy.array([r.serial for d in directories for r in d],
+                                           dtype=numpy.int64)
+
+    for column in node_columns("node_", lambda: (r.node for r in routers), serials):
+        yield column
+    for column in node_columns("peer_", lambda: (p for r in routers for p in r.peers),
+                               serials):
+        yield column
+    for column in node_columns("p_", lambda: (p for r in routers for p in r.tbucket.values()),
+                               serials):
+        yield column
+    for column in node_columns("ep_", lambda: (p for r in routers
+                                               for p in r.tbucket.extent.values()), serials):
+        yield column
+
+    # Every stream, or the random module if there's no seed.
+    paths  = sorted(utils.streams.keys()) if utils.seed is not None else []
+    states = [utils.streams[p].getstate() for p in paths] + [random.getstate()]
+    if origin is not None:
+        states.append(origin)
+    for name, column in state_columns(states).items():
+        yield "random_" + name, column
+    yield "random_paths",      numpy.array([json.dumps(p) for p in paths], dtype=str)
+
+    # The sensing schedule, by router ID.
+    owners = list(scheduler.tables.keys())
+    yield "due_id",            numpy.array(list(scheduler.due.keys()), dtype=str)
+    yield "due_round",         numpy.array(list(scheduler.due.values()), dtype=numpy.int64)
+    yield "seen",              numpy.array(scheduler.seen)
+    yield "table_id",          numpy.array(owners, dtype=str)
+    yield "table_counts",      numpy.array([len(scheduler.tables[o]) for o in owners],
+                                           dtype=numpy.int64)
+    yield "table_key_id",      numpy.array([k[0] for o in owners for k in scheduler.tables[o]],
+                                           dtype=str)
+    yield "table_key_port",    numpy.array([k[1] for o in owners for k in scheduler.tables[o]],
+                                           dtype=numpy.int64)
+
+def save(path, n, network, scheduler, options):
+    """
+    Checkpoint the routers reachable from network at the start of round n.
+
+    Columns are compressed and written out one at a time as they're built,
+    so saving needs memory for the largest of them rather than all of them.
+    """
+    if numpy is None:
+        raise ImportError("Checkpoints require numpy.")
+
+    with utils.phase("checkpointing"):
+        temporary = path + ".tmp"
+        with zipfile.ZipFile(temporary, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+            for name, column in columns(n, network, scheduler, options):
+                # As numpy.savez_compressed() stores them.
+                fd = io.BytesIO()
+                numpy.lib.format.write_array(fd, numpy.asanyarray(column), allow_pickle=False)
+                archive.writestr(name + ".npy", fd.getvalue())
+        os.rename(temporary, path)
+
+    utils.log("Checkpointed round %s to %s.", "{:,}".format(n), path)
+
+def load(path):
+    """
+    Return the header of the checkpoint at path and its columns.
+    """
+    if numpy is None:
+        raise ImportError("Checkpoints require numpy.")
+    data   = numpy.load(path)
+    header = json.loads(text(data["header"]))
+    if header.get("version") != VERSION:
+        raise ValueError("%s is a version %s checkpoint. Expected version %i." % \
+            (path, header.get("version"), VERSION))
+    return header, data
+
+def prepare(options, path):
+    """
+    Set options, the seed and the random module up as they were when the run
+    checkpointed to path began, before its scenario sets up its network again.
+    """
+    header, data = load(path)
+    for name, value in header["options"].items():
+        setattr(options, name, value)
+    seed = header["seed"]
+    utils.set_seed(tuple(seed) if isinstance(seed, list) else seed)
+
+    global origin
+    if len(data["random_gauss"]) > len(data["random_paths"]) + 1:
+        origin = state_rows(data["random_states"][-1:], data["random_gauss"][-1:])[0]
+        random.setstate(origin)
+    return header
+
+def split(column, counts):
+    """
+    Split column into consecutive runs of counts.
+    """
+    runs, start = [], 0
+    for count in counts:
+        runs.append(column[start:start + count])
+        start += count
+    return runs
+
+def restore(path, network, scheduler):
+    """
+    Overwrite the routers reachable from network, as a scenario's setup left
+    them, with those checkpointed to path, and return the round to continue
+    from.
+    """
+    header, data = load(path)
+
+    with utils.phase("checkpointing"):
+        live    = dict((r.serial, r) for r in utils.reachable(network))
+        classes = dict((type(r).__name__, type(r)) for r in live.values())
+
+        # Routers created after setup are created again in the same order, so
+        # that their streams are named the same.
+        routers = {}
+        for serial, kind in zip(data["serial"].tolist(), text(data["kind"])):
+            if serial in live:
+                routers[serial] = live[serial]
+                continue
+            utils.Router.created = serial
+            routers[serial] = classes.get(kind, utils.Router)()
+        utils.Router.created = header["created"]
+
+        serials = data["serial"].tolist()
+        own     = node_rows(data, "node_", routers)
+        peers   = split(node_rows(data, "peer_", routers), data["peer_counts"].tolist())
+        p       = split(node_rows(data, "p_", routers), data["p_counts"].tolist())
+        ep      = split(node_rows(data, "ep_", routers), data["ep_counts"].tolist())
+        rows    = zip(serials, text(data["router_id"]), data["malicious"].tolist(),
+                      data["no_prisoners"].tolist(), data["router_version"].tolist(),
+                      data["consensus_events"].tolist(), text(data["extras"]))
+
+        for i, (serial, router_id, malicious, no_prisoners, version, events, attributes) \
+                in enumerate(rows):
+            router = routers[serial]
+            router.id                 = router_id
+            router.node               = own[i]
+            router.probably_malicious = malicious
+            router.no_prisoners       = None if no_prisoners < 0 else bool(no_prisoners)
+            router.peers              = peers[i]
+            router.version            = version
+            router.rendered           = None
+            router.frozen             = None
+            router.gossiped           = {}
+            for name, value in json.loads(attributes).items():
+                setattr(router, name, value)
+
+            # Members of P and EP are the routing table's own nodes where
+            # they're still in it.
+            bucket = router.tbucket
+            bucket.clear()
+            bucket.extent.clear()
+            for members, into in ((p[i], bucket), (ep[i], bucket.extent)):
+                for node in members:
+                    into[node.long_id] = router.peers.lookup((node.id, node.port)) or node
+            bucket.consensus_events = events
+            bucket.sensed = {}
+            bucket.heard  = {}
+            bucket.epoch  = (0, None)
+
+        # Directories are refilled in place, as scenarios hold on to them.
+        kinds  = data["directory_kind"].tolist()
+        counts = data["directory_counts"].tolist()
+        members = split(data["directory_members"].tolist(), counts)
+        directories, used = {0: network}, set([id(network)])
+        for serial, index in zip(serials, data["directory"].tolist()):
+            if index in directories or not serial in live:
+                continue
+            directory = live[serial].routers
+            if not id(directory) in used:
+                directories[index] = directory
+                used.add(id(directory))
+        for index, kind in enumerate(kinds):
+            if not index in directories:
+                directories[index] = utils.RouterDirectory() if kind else []
+            directories[index][:] = [routers[s] for s in members[index]]
+        for serial, index in zip(serials, data["directory"].tolist()):
+            routers[serial].routers = directories[index]
+
+        # Random number generators, as they were.
+        paths  = [tuple(json.loads(p)) for p in text(data["random_paths"])]
+        states = state_rows(data["random_states"], data["random_gauss"])
+        for path_, state in zip(paths, states):
+            if path_ in utils.streams:
+                utils.streams[path_].setstate(state)
+        random.setstate(states[len(paths)])
+
+        scheduler.due   = dict(zip(text(data["due_id"]), data["due_round"].tolist()))
+        scheduler.seen  = int(data["seen"])
+        keys = split(list(zip(text(data["table_key_id"]), data["table_key_port"].tolist())),
+                     data["table_counts"].tolist())
+        scheduler.tables = dict((o, set(k)) for o, k in zip(text(data["table_id"]), keys))
+
+        utils.counters.clear()
+        utils.counters.update(header["counters"]["totals"])
+        utils.counters.snapshots = header["counters"]["snapshots"]
+
+    utils.log("Resuming from round %s of %s.", "{:,}".format(header["round"]), path)
+    return header["round"]
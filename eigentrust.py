@@ -1,4 +1,4 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python
 # _*_ coding: utf-8 _*_
 """
 The purpose of this toolkit is to stimulate refinement in an iterative
@@ -16,9 +16,13 @@ NOTE: This model cannot defend against peers who earn trust and then defect.
 """
 import sys
 import utils
+import sweep
 import random
+import engines
 import optparse
+import traces
 import scenarios
+import checkpoints
 
 if __name__ == "__main__":
     description = "The Psybernetics Distributed Trust Toolkit"
@@ -31,42 +35,200 @@ if __name__ == "__main__":
     parser.add_option("-n", "--nodes",        dest="nodes", action="store", default=10, help="(default: 10)")
     parser.add_option("-p", "--pre-trusted",  dest="pre_trusted", action="store", default=2, help="(default: 2)")
     parser.add_option("--describe",           dest="describe", action="store", default=None, help="Print a scenarios' documentation.")
-    parser.add_option("-v", "--verbose",      dest="verbose", action="store_true", default=False)
+    parser.add_option("-v", "--verbose",      dest="verbose", action="store_true", default=False, help="Log at debug level")
     parser.add_option("-t", "--transactions", dest="transactions", action="store", default=10000, help="(defaults to 10,000)")
     # --no-prisoners means any unsatisfactory transaction immediately earns the sending peer a trust rating of 0.
     parser.add_option("--no-prisoners",       dest="no_prisoners", action="store_true", default=False, help="(disabled by default)")
+    parser.add_option("--state",              dest="state", action="store_true", default=False, help="Keep routing tables in arrays (requires numpy)")
+    parser.add_option("--batch",              dest="batch", action="store_true", default=False, help="Run each round of transactions in bulk (implies --state)")
+    parser.add_option("--k-bucket",           dest="k_bucket", action="store", default=None, help="Keep at most this many peers per k-bucket in routing tables, Kademlia style")
+    parser.add_option("--engine",             dest="engine", action="store", default=None, help="Compute trust with an alternative engine: %s" % ", ".join(sorted(engines.map.keys())))
+    parser.add_option("--seed",               dest="seed", action="store", default=None, help="Seed every source of randomness for a reproducible run")
+    parser.add_option("--sense-jobs",         dest="sense_jobs", action="store", default=0, help="Sense against a snapshot of the network across this many processes")
+    parser.add_option("--duration",           dest="duration", action="store", default=None, help="Run as a discrete-event simulation for this many units of time instead of in rounds")
+    parser.add_option("--rate",               dest="rate", action="store", default=None, help="Transactions per router per unit of time with --duration (default: half its peers)")
+    parser.add_option("--sense-every",        dest="sense_every", action="store", default=None, help="Have every router sense together this often instead of staggering them by routing table size and churn")
+    parser.add_option("--profile",            dest="profile", action="store_true", default=False, help="Report the time spent in each phase of the run")
+    parser.add_option("--profile-dir",        dest="profile_dir", action="store", default=None, help="Also write a cProfile profile of each phase here (implies --profile)")
+    parser.add_option("--counters",           dest="counters", action="store", default=None, help="Write counts of the work done in each round here as JSON")
+    parser.add_option("--trace",              dest="trace", action="store", default=None, help="Append a binary record of every transaction and change to P and EP to this file")
+    parser.add_option("--replay",             dest="replay", action="store", default=None, help="Replay the last run in a trace from --trace instead of simulating one (requires numpy)")
+    parser.add_option("--bucket",             dest="bucket", action="store", default=None, help="Replay with this bucket: %s" % ", ".join(sorted(traces.BUCKETS.keys())))
+    parser.add_option("--checkpoint",         dest="checkpoint", action="store", default=None, help="Checkpoint the run to this file every --checkpoint-every rounds (requires numpy)")
+    parser.add_option("--checkpoint-every",   dest="checkpoint_every", action="store", default=500, help="(default: 500)")
+    parser.add_option("--resume",             dest="resume", action="store", default=None, help="Continue the run checkpointed to this file")
+    parser.add_option("--sweep",              dest="sweep", action="append", default=[], help="Sweep a parameter over values, e.g. nodes=20,50,100 (repeatable)")
+    parser.add_option("--seeds",              dest="seeds", action="store", default=8, help="Runs per combination of swept parameters (default: 8)")
+    parser.add_option("--jobs",               dest="jobs", action="store", default=None, help="Processes to sweep with (default: one per CPU)")
     (options, args) = parser.parse_args()
 
+    if options.verbose:
+        utils.set_log_level(utils.DEBUG)
+
     if options.describe:
         if options.describe in scenarios.map:
             print(scenarios.map[options.describe].__doc__)
         else:
             print("Error: Unknown scenario.")
 
-    if isinstance(options.nodes, (unicode, str)) and not options.nodes.isdigit():
+    if isinstance(options.nodes, str) and not options.nodes.isdigit():
         print("--nodes must be an integer.")
         raise SystemExit
 
     options.nodes = int(options.nodes)
 
-    if isinstance(options.pre_trusted, (unicode, str)) and \
+    if isinstance(options.pre_trusted, str) and \
             not options.pre_trusted.isdigit():
         print("--pre-trusted must be an integer.")
         raise SystemExit
 
     options.pre_trusted = int(options.pre_trusted)
     
-    if isinstance(options.transactions, (unicode, str)) and not options.transactions.isdigit():
+    if isinstance(options.transactions, str) and not options.transactions.isdigit():
         print("--transactions must be an integer.")
         raise SystemExit
 
     options.transactions = int(options.transactions)
 
+    if isinstance(options.sense_jobs, str) and not options.sense_jobs.isdigit():
+        print("--sense-jobs must be an integer.")
+        raise SystemExit
+
+    options.sense_jobs = int(options.sense_jobs)
+
+    if options.sense_every is not None:
+        if not options.sense_every.isdigit() or not int(options.sense_every):
+            print("--sense-every must be a positive integer.")
+            raise SystemExit
+        options.sense_every = int(options.sense_every)
+
+    for name in ("duration", "rate"):
+        if getattr(options, name) is None:
+            continue
+        try:
+            setattr(options, name, float(getattr(options, name)))
+        except ValueError:
+            print("--%s must be a number." % name)
+            raise SystemExit
+
+    if options.k_bucket is not None:
+        if not options.k_bucket.isdigit() or not int(options.k_bucket):
+            print("--k-bucket must be a positive integer.")
+            raise SystemExit
+        options.k_bucket = int(options.k_bucket)
+
+    if isinstance(options.checkpoint_every, str) and \
+            (not options.checkpoint_every.isdigit() or not int(options.checkpoint_every)):
+        print("--checkpoint-every must be a positive integer.")
+        raise SystemExit
+
+    options.checkpoint_every = int(options.checkpoint_every)
+
+    if isinstance(options.seeds, str) and \
+            (not options.seeds.isdigit() or not int(options.seeds)):
+        print("--seeds must be a positive integer.")
+        raise SystemExit
+
+    options.seeds = int(options.seeds)
+
+    if options.jobs is not None:
+        if not options.jobs.isdigit() or not int(options.jobs):
+            print("--jobs must be a positive integer.")
+            raise SystemExit
+        options.jobs = int(options.jobs)
+
+    if options.replay:
+        options.scenario = "replay"
+        # Replays make the recorded transactions one at a time on Nodes.
+        for name in ("state", "batch", "duration", "checkpoint", "resume"):
+            if getattr(options, name):
+                print("--%s can't be used with --replay." % name)
+                raise SystemExit
+    elif options.scenario == "replay":
+        print("Error: The replay scenario requires --replay.")
+        raise SystemExit
+
+    if options.bucket and not options.bucket in traces.BUCKETS:
+        print("Error: Unknown bucket.")
+        raise SystemExit
+
+    if options.checkpoint or options.resume:
+        # Checkpoints hold routing tables as Nodes and rounds as rounds.
+        for name in ("state", "batch", "duration", "sweep"):
+            if getattr(options, name):
+                print("--%s can't be used with --checkpoint or --resume." % name)
+                raise SystemExit
+
+    if options.resume:
+        try:
+            checkpoints.prepare(options, options.resume)
+        except (ImportError, IOError, ValueError) as e:
+            print("Error: %s" % e)
+            raise SystemExit
+
+    elif options.seed is not None:
+        utils.set_seed(int(options.seed) if options.seed.isdigit() else options.seed)
+
+    if options.k_bucket:
+        utils.Router.k = options.k_bucket
+
+    if options.state or options.batch:
+        try:
+            utils.Router.state = utils.NetworkState()
+        except ImportError as e:
+            print("Error: %s" % e)
+            raise SystemExit
+
+    if options.engine:
+        if not options.engine in engines.map:
+            print("Error: Unknown engine.")
+            raise SystemExit
+        if engines.map[options.engine].bucket is not utils.PTPBucket and \
+                (options.checkpoint or options.resume):
+            print("--engine %s can't be used with --checkpoint or --resume." % options.engine)
+            raise SystemExit
+        try:
+            engine = engines.map[options.engine]()
+            engine.bucket.engine = engine
+        except ImportError as e:
+            print("Error: %s" % e)
+            raise SystemExit
+        # Routers are built with the bucket the engine calculates trust for.
+        utils.Router.bucket = engine.bucket
+
+    if options.trace:
+        if options.sweep:
+            print("--trace can't be used with --sweep.")
+            raise SystemExit
+        try:
+            utils.recorder = traces.Recorder(options.trace)
+        except (IOError, ValueError) as e:
+            print("Error: %s" % e)
+            raise SystemExit
+
+    if options.profile or options.profile_dir:
+        utils.timer = utils.PhaseTimer(profile=bool(options.profile_dir))
+
     returned_data = {}
 
-    if options.scenario:
+    if options.sweep:
+        if not options.scenario in scenarios.map:
+            print("Error: --sweep requires a known --scenario.")
+            raise SystemExit
+        try:
+            axes = sweep.parse(options.sweep)
+        except ValueError as e:
+            print("Error: %s" % e)
+            raise SystemExit
+        results = sweep.sweep(options, axes, options.seeds, options.jobs)
+        utils.table(sweep.summarise(axes, results),
+                    columns=[name for name, values in axes] + list(sweep.MEASURES))
+        returned_data["results"] = results
+
+    elif options.scenario:
         if options.scenario in scenarios.map:
-            print options
+            print(options)
+            checkpoints.begin()
             returned_data = scenarios.map[options.scenario](options)
             if not isinstance(returned_data, dict):
                 returned_data = {}
@@ -75,11 +237,28 @@ if __name__ == "__main__":
             raise SystemExit
 
     if "routers" in returned_data:
-        table_data = [{"Routing Table": r,
-            "Consensus Events": str(r.tbucket.consensus_events) +\
-            "               "} \
-            for r in returned_data["routers"]]
-        utils.table(table_data)
+        with utils.phase("rendering"):
+            table_data = [{"Routing Table": r,
+                "Consensus Events": str(getattr(r.tbucket, "consensus_events", 0)) +\
+                "               "} \
+                for r in returned_data["routers"]]
+            utils.table(table_data, columns=("Routing Table", "Consensus Events"))
+
+    if utils.timer:
+        utils.table(utils.timer.report(), columns=utils.PhaseTimer.columns)
+        if options.profile_dir:
+            for path in utils.timer.dump(options.profile_dir):
+                utils.log("Wrote %s.", path)
+        returned_data["timer"] = utils.timer
+
+    if utils.recorder:
+        utils.recorder.close()
+        utils.log("Wrote %s.", options.trace)
+
+    if options.counters:
+        utils.counters.dump(options.counters)
+        utils.log("Wrote %s.", options.counters)
+    returned_data["counters"] = utils.counters
 
     returned_data.update({"utils": utils})
 
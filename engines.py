@@ -0,0 +1,898 @@
+# _*_ coding: utf-8 _*_
+"""
+Alternative implementations of the computations in utils.py and scenarios.py
+for larger networks. These trade the readability of the reference
+implementations for array operations.
+
+    ./eigentrust.py --engine numpy -n200 -s two
+
+Engines are set on the bucket class they replace the computations of, either
+with --engine or by hand:
+
+    utils.PTPBucket.engine = engines.VectorPTPEngine()
+"""
+import heapq
+import utils
+import itertools
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def round1(values):
+    # PTPBucket rounds altruism with "%.1f" formatting, which numpy.round()
+    # doesn't reproduce exactly at the halfway points.
+    return [float("%.1f" % _) for _ in values]
+
+class VectorPTPEngine(object):
+    """
+    Computes PTPBucket.calculate_trust() over a matrix of what each member of
+    P and EP reports about every peer in our routing table.
+
+    The reference implementation vets peers one at a time and membership of P
+    and EP can change partway through a round, which later peers then see.
+    This engine evaluates every remaining peer at once under the current
+    membership and locates the first peer whose responses could trip one of
+    the impossible, deflating or inflating rating checks. Peers before that
+    point are settled with array operations, the peer itself is handed to
+    PTPBucket.sense() and evaluation resumes after it. Peers graduating into
+    EP along the way only add to the responses checked for later peers. Rating
+    checks are flagged conservatively, so the engine reports the same
+    consensus events and P/EP changes as the reference.
+
+    Per-response traces logged by PTPBucket.verbose are only produced for the
+    peers handed to PTPBucket.sense().
+    """
+    bucket = utils.PTPBucket
+
+    def __init__(self):
+        if numpy is None:
+            raise ImportError("The numpy engine requires numpy.")
+
+    def calculate_trust(self, bucket):
+        router = bucket.router
+        peers  = list(router.peers)
+        keys   = [(p.id, p.port) for p in peers]
+
+        # Duplicate entries in a routing table are compared against one
+        # another by the reference implementation. Leave those to it.
+        if len(set(keys)) != len(keys):
+            return self.reference(bucket)
+
+        round_ = Round(bucket, peers, keys)
+        start  = 0
+        while start < len(peers):
+            start = round_.settle(start)
+
+        bucket.graduate()
+        round_.check_deflation()
+        bucket.report()
+
+    def reference(self, bucket):
+        all_responses = utils.OrderedDict()
+        opinions      = {}
+        multiplier    = bucket.multiplier()
+        for peer in bucket.router:
+            bucket.sense(peer, all_responses, opinions, multiplier)
+        bucket.graduate()
+        bucket.check_deflation(all_responses)
+        bucket.report()
+
+class Round(object):
+    """
+    The state of one VectorPTPEngine sensing round for a bucket.
+    """
+    def __init__(self, bucket, peers, keys):
+        self.bucket        = bucket
+        self.peers         = peers
+        self.keys          = keys
+        self.columns       = dict((k, i) for i, k in enumerate(keys))
+        self.threeples     = [tuple(p.threeple) for p in peers]
+        self.epsilon       = bucket.router.node.epsilon
+        self.base          = bucket.router.node.trust
+        self.multiplier    = bucket.multiplier()
+
+        # Shared with PTPBucket.sense() so that each member is asked once.
+        self.opinions      = {}
+        self.all_responses = utils.OrderedDict()
+
+        # Reported trust, transactions and presence per member, and which of
+        # each members' responses have been recorded into all_responses.
+        self.rows          = {}
+        self.recorded      = {}
+
+    def row(self, member):
+        if member.long_id in self.rows:
+            return self.rows[member.long_id]
+        if not member.long_id in self.opinions:
+            self.opinions[member.long_id] = \
+                self.bucket.get_many(member, self.bucket.router.peers)
+        opinion = self.opinions[member.long_id]
+
+        n       = len(self.peers)
+        trust   = numpy.zeros(n)
+        tx      = numpy.zeros(n, dtype=numpy.int64)
+        present = numpy.zeros(n, dtype=bool)
+        for i, threeple in enumerate(self.threeples):
+            response = opinion.get(threeple)
+            if response:
+                trust[i]   = response['trust']
+                tx[i]      = response['transactions']
+                present[i] = True
+
+        # Members aren't asked about themselves.
+        column = self.columns.get((member.id, member.port))
+        if column is not None:
+            present[column] = False
+
+        self.rows[member.long_id] = (trust, tx, present)
+        return self.rows[member.long_id]
+
+    def matrix(self, members, start):
+        if not members:
+            n = len(self.peers) - start
+            return (numpy.zeros((0, n)), numpy.zeros((0, n), dtype=numpy.int64),
+                    numpy.zeros((0, n), dtype=bool))
+        rows = [self.row(m) for m in members]
+        return (numpy.array([r[0][start:] for r in rows]),
+                numpy.array([r[1][start:] for r in rows]),
+                numpy.array([r[2][start:] for r in rows]))
+
+    def altruism(self, trust, tx):
+        utils.count("altruism", numpy.size(trust))
+        divisor = tx * self.epsilon
+        a       = trust - self.base
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            ratio = a / divisor
+        return numpy.where(divisor == 0, numpy.where(a == 0, 1.0, 0.0), ratio)
+
+    def impossible(self, trust, tx):
+        return (trust > 0.5 + (tx * self.epsilon)) | \
+               ((trust < 0.5 - (tx * self.epsilon)) & (trust != 0))
+
+    def inflating(self, trust, tx, altruism, ptrust, ptx):
+        # "%.1f" % altruism >= 1.0 holds from just above 0.95. Flagging a
+        # little below that only sends more peers to PTPBucket.sense().
+        m = self.multiplier
+        return (ptrust == 0) & (ptx > 5 * m) & (tx >= ptx * m) & (altruism > 0.94)
+
+    def settle(self, start):
+        """
+        Settle peers from start onwards until one of them changes the
+        membership of P or EP other than by graduating into EP and return the
+        index to resume from.
+        """
+        bucket = self.bucket
+        peers  = self.peers[start:]
+        P      = list(bucket.values())
+
+        ptrust = numpy.array([float(p.trust) for p in peers])
+        ptx    = numpy.array([p.transactions for p in peers], dtype=numpy.int64)
+
+        # Responses from members of P, which become all_responses entries.
+        T, X, present = self.matrix(P, start)
+        valid = present & (X != 0)
+        A     = self.altruism(T, X)
+
+        flagged = valid & (self.impossible(T, X) |
+                           ((T > 0) & (A <= 0.5) & (X >= 5 * self.multiplier)) |
+                           self.inflating(T, X, A, ptrust, ptx))
+        events  = flagged.any(axis=0)
+
+        # Graduating into EP doesn't change what's concluded from P, only which
+        # members of EP are asked about the peers after it, so flags from EP
+        # are accumulated as members join.
+        n          = len(peers)
+        ep_flagged = numpy.zeros(n, dtype=bool)
+        deflating  = numpy.zeros(n, dtype=bool)
+        for member in bucket.extent.values():
+            self.flag(member, start, ptrust, ptx, ep_flagged, deflating)
+
+        local   = self.altruism(ptrust, ptx)
+        outcome = self.outcomes(P, peers, ptrust, ptx, local, T, X, A, valid)
+        graduates = numpy.zeros(n, dtype=bool)
+        graduates[outcome["graduates"]] = True
+
+        position = 0
+        while True:
+            # PTPBucket.sense() applies the deflation check to whichever member
+            # of EP it asked last, only removing them if they're also in P.
+            extent    = list(bucket.extent.values())
+            last_in_p = bool(extent) and extent[-1].long_id in bucket
+            pending   = events | ep_flagged | (deflating & last_in_p)
+
+            event     = numpy.flatnonzero(pending[position:])
+            graduated = numpy.flatnonzero(graduates[position:])
+            event     = position + event[0] if len(event) else n
+            graduated = position + graduated[0] if len(graduated) else n
+
+            if event <= graduated:
+                self.apply(P, start, position, event, valid, outcome)
+                if event < n:
+                    self.sense(start + event)
+                    return start + event + 1
+                return start + n
+
+            self.apply(P, start, position, graduated + 1, valid, outcome)
+            self.flag(self.peers[start + graduated], start, ptrust, ptx,
+                      ep_flagged, deflating)
+            position = graduated + 1
+
+    def flag(self, member, start, ptrust, ptx, flagged, deflating):
+        """
+        Accumulate the peers from start onwards that a member of EP's
+        responses might raise the impossible, deflating or inflating rating
+        checks for.
+        """
+        T, X, present = self.row(member)
+        T, X, present = T[start:], X[start:], present[start:]
+        valid = present & (X != 0)
+        A     = self.altruism(T, X)
+        flagged   |= valid & (self.impossible(T, X) |
+                              self.inflating(T, X, A, ptrust, ptx))
+        deflating |= valid & (A <= 0.8) & (T > 0)
+
+    def outcomes(self, P, peers, ptrust, ptx, local, T, X, A, valid):
+        """
+        What PTPBucket.sense() would conclude about each peer, assuming none
+        of them changes the membership of P or EP.
+        """
+        bucket   = self.bucket
+        n        = len(peers)
+        rounded  = numpy.array(round1(local.tolist())) if n else numpy.zeros(0)
+        trusted  = ptrust != 0
+        locally  = trusted & ((rounded + bucket.delta) <= 1.0)
+        deciding = trusted & ~locally
+
+        median    = numpy.zeros(n)
+        filtered  = None
+        reached   = numpy.zeros(n, dtype=bool)
+        consensus = numpy.zeros(n, dtype=bool)
+        remaining = deciding.copy()
+
+        if n and float(len(bucket)) / len(bucket.router) >= bucket.gamma:
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                experienced = (X >= ptx) & ((X - ptx) / X.astype(float) >= 0.01)
+            filtered = valid & experienced
+            alpha    = numpy.array([m.transactions > bucket.alpha for m in P], dtype=bool)
+            excelled = filtered & alpha[:, numpy.newaxis]
+            filtered = numpy.where(rounded >= 0.99, excelled, filtered)
+
+            count     = filtered.sum(axis=0)
+            skipped   = (count == 0) | ((rounded == 1.0) & (count == 1)) | \
+                        ((ptx != 0) & (rounded == 1.0))
+            reached   = deciding & ~skipped
+            median    = self.median(A, filtered)
+            consensus = reached & ((median + bucket.delta) < 1.0)
+            remaining = reached & ~consensus
+
+        members = set((m.id, m.port) for m in bucket.all)
+        in_all  = numpy.array([(p.id, p.port) in members for p in peers], dtype=bool)
+        if len(bucket):
+            rmedian    = numpy.array(round1(median.tolist())) if n else numpy.zeros(0)
+            remaining &= rmedian == 1.0
+        remaining &= ~in_all
+
+        votes = (valid & (X >= bucket.beta)).sum(axis=0)
+        if len(bucket):
+            graduates = remaining & (votes != 0) & (votes >= (len(bucket) // 2))
+        else:
+            graduates = remaining & (ptx >= bucket.beta)
+
+        return {
+            "locally":   locally,
+            "reached":   reached,
+            "consensus": consensus,
+            "median":    median,
+            "votes":     votes,
+            "graduates": numpy.flatnonzero(graduates).tolist(),
+            "filtered":  filtered,
+            "A":         A,
+        }
+
+    def median(self, A, filtered):
+        """
+        PTPBucket.median() of each column's filtered altruism ratings, taken
+        in the order members of P were asked.
+
+        PTPBucket.median() drops ratings outside [0, 1] while iterating over
+        the list it's dropping them from, which skips the rating following
+        each one dropped. That's reproduced here.
+        """
+        rows, n = A.shape
+        if not rows:
+            return numpy.zeros(n)
+        kept      = numpy.zeros(A.shape, dtype=bool)
+        skip_next = numpy.zeros(n, dtype=bool)
+        for i in range(rows):
+            listed    = filtered[i]
+            bad       = (A[i] > 1) | (A[i] < 0)
+            removed   = listed & ~skip_next & bad
+            kept[i]   = listed & ~removed
+            skip_next = numpy.where(listed, removed, skip_next)
+
+        count = kept.sum(axis=0)
+
+        # The mean is accumulated in list order, as sum() would.
+        total = numpy.zeros(n)
+        for i in range(rows):
+            total = numpy.where(kept[i], total + A[i], total)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            mean = total / count
+
+        ordered = numpy.sort(numpy.where(kept, A, numpy.inf), axis=0)
+        lo      = numpy.maximum((count - 1) // 2, 0)
+        hi      = numpy.maximum(count // 2, 0)
+        columns = numpy.arange(n)
+        med     = (ordered[lo, columns] + ordered[hi, columns]) / 2.0
+
+        median  = numpy.minimum(numpy.maximum((mean + med) / 2.0, 0), 1)
+        return numpy.where(count == 0, 0.0, median)
+
+    def apply(self, P, start, position, stop, valid, outcome):
+        """
+        Write the conclusions for peers [start + position, start + stop) back,
+        logging as PTPBucket.sense() does.
+        """
+        bucket = self.bucket
+        log    = utils.log
+
+        # Record all_responses entries, inserting members in the order the
+        # reference implementation first would.
+        firsts = []
+        for i, member in enumerate(P):
+            columns = position + numpy.flatnonzero(valid[i, position:stop])
+            if not len(columns):
+                continue
+            recorded = self.recorded.setdefault(member.long_id,
+                                                numpy.zeros(len(self.peers), dtype=bool))
+            recorded[start + columns] = True
+            if not member in self.all_responses:
+                firsts.append((columns[0], i, member))
+        for _, _, member in sorted(firsts):
+            self.all_responses[member] = []
+
+        locally   = outcome["locally"]
+        reached   = outcome["reached"]
+        consensus = outcome["consensus"]
+        filtered  = outcome["filtered"]
+        A         = outcome["A"]
+        graduates = set(outcome["graduates"])
+        logged    = position + numpy.flatnonzero((locally | reached)[position:stop])
+
+        for i in sorted(set(logged.tolist()) |
+                        set(g for g in graduates if position <= g < stop)):
+            peer = self.peers[start + i]
+            if locally[i]:
+                log("Local experience shows %s is malicious.", peer)
+                peer.trust = 0
+                continue
+            if reached[i]:
+                altruism = A[:, i][filtered[:, i]].tolist()
+                log("%s %s", peer, altruism)
+                log("Median reported altruism: %f", outcome["median"][i])
+            if consensus[i]:
+                log("Consensus from our trusted peers is that %s is malicious.", peer)
+                peer.trust = 0
+                bucket.consensus_events += 1
+                utils.count("consensus_events")
+                utils.record("consensus", bucket.router, peer)
+                continue
+            if i in graduates:
+                if len(bucket):
+                    log("votes: %s %i", peer, outcome["votes"][i])
+                log("Graduating %s into EP.", peer)
+                bucket.extent[peer.long_id] = peer
+                utils.count("graduations_ep")
+                utils.record("graduation_ep", bucket.router, peer)
+
+    def sense(self, column):
+        """
+        Hand a peer to the reference implementation, tracking which
+        all_responses entries it records.
+        """
+        before = dict((m, len(r)) for m, r in self.all_responses.items())
+        self.bucket.sense(self.peers[column], self.all_responses, self.opinions,
+                          self.multiplier)
+        for member, responses in self.all_responses.items():
+            if len(responses) > before.get(member, 0):
+                recorded = self.recorded.setdefault(member.long_id,
+                                                    numpy.zeros(len(self.peers), dtype=bool))
+                recorded[column] = True
+        for member in before:
+            if not member in self.all_responses:
+                self.recorded.pop(member.long_id, None)
+
+    def check_deflation(self):
+        """
+        PTPBucket.check_deflation() over the recorded responses.
+        """
+        bucket = self.bucket
+        if not self.all_responses:
+            return
+        ptrust = numpy.array([float(p.trust) for p in self.peers])
+        ptx    = numpy.array([p.transactions for p in self.peers], dtype=numpy.int64)
+        local  = self.altruism(ptrust, ptx)
+
+        for trusted_peer in list(self.all_responses.keys()):
+            if not trusted_peer.long_id in bucket: continue
+            T, X, _  = self.row(trusted_peer)
+            recorded = self.recorded.get(trusted_peer.long_id)
+            if recorded is None:
+                continue
+            counted = recorded & (X >= ptx) & (ptx >= 20)
+            x = int((counted & (local > 0.95) & (self.altruism(T, X) <= 0)).sum())
+            members = list(bucket.values())
+            for cmp_peer in list(self.all_responses.keys()):
+                if not cmp_peer in members or cmp_peer == trusted_peer:
+                    continue
+                cmp_recorded = self.recorded.get(cmp_peer.long_id)
+                if cmp_recorded is None:
+                    continue
+                CT, CX, _ = self.row(cmp_peer)
+                x += int((counted & cmp_recorded & (self.altruism(CT, CX) > 0.95)).sum())
+            if bucket.verbose:
+                utils.log("%s x: %i", trusted_peer, x)
+            if x > len(bucket.router) * 0.7:
+                utils.log("Removing %s from P for deflating trust ratings.", trusted_peer)
+                del bucket[trusted_peer.long_id]
+                utils.count("evictions_p")
+                utils.record("eviction_p", bucket.router, trusted_peer)
+
+class EigenTrust(object):
+    """
+    Computes global trust values for the whole network at once, as in the
+    original EigenTrust paper, in place of TBucket.calculate_trust().
+
+    Each router's peer table contributes a row of the local trust matrix C,
+    with S(i, j) as TBucket defines it normalised over the row. The global
+    trust vector t is the fixed point of
+
+        t = beta * C^T t + (1 - beta) * p
+
+    where beta is the bucket's own, and p spreads trust evenly over the
+    members of routers' buckets, or the whole network if there are none.
+    Routers without any local trust to give defer to p. C is kept as (row,
+    column, value) arrays and t is found by power iteration, so each
+    iteration is a single pass over the entries. Where routers keep their
+    routing tables in a utils.NetworkState, C is read straight from its
+    arrays.
+
+    The network is solved once per sensing round. The first router to ask
+    after it has already been given its ratings triggers a new solve.
+    """
+    bucket = utils.TBucket
+
+    def __init__(self, tolerance=1e-10):
+        if numpy is None:
+            raise ImportError("The eigentrust engine requires numpy.")
+        self.tolerance  = tolerance
+        self.index      = {}
+        self.trust      = None
+        self.iterations = 0
+        self.delta      = None
+
+        # Routers given ratings from the current solution.
+        self.rated      = set()
+
+    def calculate_trust(self, bucket):
+        router = bucket.router
+        if self.trust is None or router.id in self.rated or \
+                not (router.node.id, router.node.port) in self.index:
+            self.solve([router] + list(router.routers), bucket.beta, bucket.iterations)
+
+        self.rated.add(router.id)
+        for peer in router.peers:
+            i = self.index.get((peer.id, peer.port))
+            if i is None:
+                continue
+            peer.trust = float(self.trust[i])
+            bucket.messages.append(("Recalculated trust of %s as %.4f.", peer, peer.trust))
+        router.touch()
+        bucket.read_messages()
+
+    def solve(self, routers, beta, iterations=100):
+        """
+        Compute the global trust vector for a list of routers, giving beta of
+        each router's trust to what its peers rate it.
+        """
+        routers = list(routers)
+        if routers and routers[0].state is not None and routers[0].index is not None:
+            index, rows, columns, values, pretrusted = \
+                self.state_matrix(routers[0].state, routers)
+        else:
+            index, rows, columns, values, pretrusted = self.matrix(routers)
+        n = len(index)
+
+        # Normalise each row of C to sum to 1.
+        sums    = numpy.bincount(rows, weights=values, minlength=n)
+        if len(values):
+            values /= sums[rows]
+        dangling = sums == 0
+
+        p = numpy.zeros(n)
+        if len(pretrusted):
+            p[pretrusted] = 1.0 / len(pretrusted)
+        else:
+            p[:] = 1.0 / n
+
+        t = p.copy()
+        self.iterations = 0
+        while self.iterations < iterations:
+            spread  = numpy.bincount(columns, weights=values * t[rows], minlength=n)
+            spread += t[dangling].sum() * p
+            last, t = t, beta * spread + (1.0 - beta) * p
+            self.iterations += 1
+            self.delta = numpy.abs(t - last).sum()
+            if self.delta < self.tolerance:
+                break
+
+        self.index = index
+        self.trust = t
+        self.rated = set()
+        return t
+
+    def matrix(self, routers):
+        """
+        Return an index of nodes by identity along with the rows, columns and
+        values of the local trust matrix and the columns of pre-trusted peers.
+        """
+        index = {}
+        def column(node):
+            return index.setdefault((node.id, node.port), len(index))
+
+        unique = []
+        for router in routers:
+            if not (router.node.id, router.node.port) in index:
+                column(router.node)
+                unique.append(router)
+
+        rows, columns, values, pretrusted = [], [], [], set()
+        for router in unique:
+            i = index[(router.node.id, router.node.port)]
+            for peer in router.peers:
+                if not peer.transactions:
+                    continue
+                s = max(peer.trust / peer.transactions, 0)
+                if s:
+                    rows.append(i)
+                    columns.append(column(peer))
+                    values.append(s)
+            for peer in router.tbucket.values():
+                pretrusted.add(column(peer))
+
+        return (index,
+                numpy.array(rows, dtype=numpy.int64),
+                numpy.array(columns, dtype=numpy.int64),
+                numpy.array(values, dtype=float),
+                numpy.array(sorted(pretrusted), dtype=numpy.int64))
+
+    def state_matrix(self, state, routers):
+        """
+        matrix() read from the arrays of a NetworkState.
+        """
+        unique  = {}
+        for router in routers:
+            unique.setdefault(router.index, router)
+        routers = unique
+        edges   = state.edges(routers.values())
+        trust   = state.trust[edges]
+        tx      = state.transactions[edges]
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            s   = numpy.where(tx != 0, numpy.maximum(trust / tx, 0), 0)
+        keep    = s > 0
+
+        rows       = state.owner[edges][keep]
+        columns    = state.target[edges][keep]
+        pretrusted = numpy.array([state.index(p) for r in routers.values()
+                                  for p in r.tbucket.values()], dtype=numpy.int64)
+
+        # Number the nodes involved densely.
+        members    = numpy.unique(numpy.concatenate(
+            (numpy.array(sorted(routers), dtype=numpy.int64), columns, pretrusted)))
+        index      = dict((state.keys[m], i) for i, m in enumerate(members.tolist()))
+        return (index,
+                numpy.searchsorted(members, rows),
+                numpy.searchsorted(members, columns),
+                s[keep],
+                numpy.unique(numpy.searchsorted(members, pretrusted)))
+
+class RoundEngine(object):
+    """
+    Runs a round of transactions between routers and their peers in bulk,
+    in place of calling Router.transact_with() for each peer in turn.
+
+    Whether each router transacts with each of its peers, and how, is drawn
+    for the whole round at once. Trust ratings and transaction counts are
+    then updated in the routers' utils.NetworkState and routing tables are
+    merged once per pair of routers that transacted. Everything is decided
+    against the state at the start of the round, so the outcome differs from
+    the reference loop in the details but not in distribution.
+
+    Routers whose malicious property has side effects are asked for all of
+    their round's transactions through Router.malicious_batch().
+    """
+    def __init__(self, state, seed=None):
+        if numpy is None:
+            raise ImportError("The round engine requires numpy.")
+        self.state   = state
+        # Seed from a stream so that seeded runs are reproducible.
+        if seed is None:
+            seed = utils.stream("rounds").getrandbits(32)
+        self.random  = numpy.random.RandomState(seed)
+
+        # The (router, peer) pairs with mishaps in the last round.
+        self.mishaps = []
+
+    def locate(self, owners, targets):
+        """
+        Return the router responsible for each target node, found through the
+        directory of routers of the router whose routing table it's in, as
+        Router.locate() would. None where there isn't one.
+        """
+        partners    = numpy.empty(len(owners), dtype=object)
+        directories = numpy.array([id(router.routers) for router in owners], dtype=numpy.int64)
+        keys        = self.state.keys
+        for key in numpy.unique(directories).tolist():
+            positions = numpy.flatnonzero(directories == key)
+            directory = owners[positions[0]].routers
+            if isinstance(directory, utils.RouterDirectory):
+                # Its own index, so that routers with directories of their own
+                # don't each cost a pass over the network.
+                for position, target in zip(positions.tolist(), targets[positions].tolist()):
+                    partners[position] = directory.lookup(keys[target])
+                continue
+            # Where routers share a node the directory finds the first of them.
+            located   = numpy.empty(len(keys), dtype=object)
+            for router in reversed(directory):
+                index = self.state.nodes.get((router.node.id, router.node.port))
+                if index is not None:
+                    located[index] = router
+            partners[positions] = located[targets[positions]]
+        return partners
+
+    def run(self, routers, participation=0.5, mishaps=0.0):
+        """
+        Run a round of transactions from routers to their peers, each of whom
+        is transacted with at a probability of participation. Transactions
+        between good routers go wrong at a probability of mishaps.
+
+        Returns the (router, peer) pairs of negative transactions.
+        """
+        state   = self.state
+        routers = list(routers)
+        tables  = [state.edges([router]) for router in routers]
+        edges   = numpy.concatenate(tables) if tables else numpy.zeros(0, dtype=numpy.int64)
+        if not len(edges):
+            self.mishaps = []
+            return []
+
+        # The router whose routing table each edge is in.
+        owners  = numpy.empty(len(routers), dtype=object)
+        for i, router in enumerate(routers):
+            owners[i] = router
+        owners  = owners.repeat([len(table) for table in tables])
+
+        # Transact_with() skips peers with no trust and those it can't locate.
+        active  = numpy.flatnonzero((self.random.random_sample(len(edges)) < participation) &
+                                    (state.trust[edges] > 0))
+        edges, owners = edges[active], owners[active]
+        partners = self.locate(owners, state.target[edges])
+        active   = numpy.flatnonzero([partner is not None for partner in partners])
+        if not len(active):
+            self.mishaps = []
+            return []
+        edges, owners, partners = edges[active], owners[active], partners[active]
+        positive = numpy.ones(len(edges), dtype=bool)
+
+        # Mishaps between good routers.
+        good     = numpy.array([not r.probably_malicious for r in owners]) & \
+                   numpy.array([not r.probably_malicious for r in partners])
+        mishap   = good & (self.random.random_sample(len(edges)) < mishaps)
+        positive[mishap] = False
+
+        # Ask each router we transacted with how each transaction went, in the
+        # order they happened in.
+        asked  = numpy.flatnonzero(~mishap)
+        groups = {}
+        for i in asked.tolist():
+            groups.setdefault(id(partners[i]), []).append(i)
+        for positions in groups.values():
+            partner = partners[positions[0]]
+            if type(partner).malicious is utils.Router.malicious:
+                malicious = [partner.probably_malicious] * len(positions)
+            else:
+                malicious = partner.malicious_batch(len(positions))
+            positive[positions] = ~numpy.array(malicious, dtype=bool)
+
+        # Apply every transaction's change in trust and count at once.
+        epsilon = routers[0].node.epsilon
+        harsh   = numpy.array([bool(r.no_prisoners) for r in owners])
+        numpy.add.at(state.trust, edges[positive], epsilon)
+        numpy.add.at(state.trust, edges[~positive & ~harsh], -epsilon)
+        state.trust[edges[~positive & harsh]] = 0
+        numpy.add.at(state.transactions, edges, 1)
+        if utils.recorder is not None:
+            utils.recorder.record_many("transaction", owners, partners, positive,
+                                       state.trust[edges], state.transactions[edges])
+
+        for router in set(owners.tolist()):
+            router.touch()
+
+        # Note when each peer was last transacted with, as Node.transact()
+        # does, for KBucketTables to evict by.
+        if utils.Router.k:
+            seen = {}
+            for router, edge in zip(owners.tolist(), edges.tolist()):
+                if not router.id in seen:
+                    seen[router.id] = dict((getattr(p, "edge", None), p) for p in router.peers)
+                peer = seen[router.id].get(edge)
+                if peer is not None:
+                    peer.seen = router.version
+
+        # Merge routing tables once per pair of routers that transacted.
+        merged = set()
+        for router, partner in zip(owners.tolist(), partners.tolist()):
+            if not (router.id, partner.id) in merged:
+                merged.add((router.id, partner.id))
+                router.gossip(partner)
+
+        peers = {}
+        def pair(i):
+            router = owners[i]
+            if not router.id in peers:
+                peers[router.id] = dict((getattr(p, "edge", None), p) for p in router.peers)
+            return (router, peers[router.id].get(edges[i]))
+
+        self.mishaps = [pair(i) for i in numpy.flatnonzero(mishap).tolist()]
+        return [pair(i) for i in numpy.flatnonzero(~positive).tolist()]
+
+class EventEngine(object):
+    """
+    Runs a network as a discrete-event simulation instead of in rounds.
+
+    Events are kept in a heap by the time they happen at. Each router makes
+    its transactions one at a time with a peer drawn from its routing table,
+    as a Poisson process at a rate of its own, and calculates trust every
+    utils.Scheduler.interval() units of time. Routers can be introduced and
+    depart at any time, and anything else can be scheduled with at().
+
+    Time is measured in rounds. By default a router makes half as many
+    transactions per unit of time as it has peers, which is what it makes in
+    a round of the scenario loops, but given a rate, or a rate for a router
+    in rates, routers transact that often instead however many peers they
+    have. A run costs one event per transaction rather than a pass over
+    every routing table per round, so traffic can be sparse and simulated
+    time long.
+    """
+    def __init__(self, directory=None, rate=None, sense_jobs=0):
+        # The routers that can be located, which introduced routers join and
+        # departing routers leave, if they share one.
+        self.directory  = directory
+        self.rate       = rate
+        self.rates      = {}
+        self.scheduler  = utils.Scheduler(jobs=sense_jobs)
+        self.random     = utils.stream("events")
+        self.now        = 0.0
+
+        # (time, sequence, action, args). The sequence keeps events at the
+        # same time in the order they were scheduled.
+        self.queue      = []
+        self.sequence   = itertools.count()
+
+        # IDs of routers that have departed for good. Their events are
+        # dropped as they come up.
+        self.departed   = set()
+        self.events     = 0
+
+        # The routers added, which a trace of the run begins with.
+        self.routers    = []
+
+    def at(self, time, action, *args):
+        """
+        Call action(*args) at time.
+        """
+        heapq.heappush(self.queue, (time, next(self.sequence), action, args))
+
+    def interval(self, router):
+        """
+        Draw the time until router's next transaction.
+        """
+        rate = self.rates.get(router.id, self.rate)
+        if rate is None:
+            rate = 0.5 * len(router.peers)
+        if rate <= 0:
+            return None
+        return router.random.expovariate(rate)
+
+    def add(self, routers, transact=None, sense=True):
+        """
+        Have routers start transacting and, unless sense is False, calculating
+        trust. transact(router, peer) is called for each of their transactions
+        in place of router.transact_with(peer). Adding a router twice gives it
+        a second stream of transactions.
+        """
+        for router in routers:
+            self.routers.append(router)
+            self.next_transaction(router, transact)
+            if sense:
+                interval = self.scheduler.interval(router)
+                self.at(self.now + self.random.uniform(0, interval), self.sense, router)
+
+    def next_transaction(self, router, transact):
+        interval = self.interval(router)
+        if interval is not None:
+            self.at(self.now + interval, self.transaction, router, transact)
+
+    def transaction(self, router, transact):
+        if router.peers:
+            peer = router.random.choice(router.peers)
+            if transact is None:
+                router.transact_with(peer)
+            else:
+                transact(router, peer)
+        self.next_transaction(router, transact)
+
+    def sense(self, router):
+        utils.sense([router], self.scheduler.jobs)
+        self.at(self.now + self.scheduler.interval(router), self.sense, router)
+
+    def introduce(self, time, routers, peers, **kwargs):
+        """
+        Introduce routers to peers at time, adding them to the directory and
+        to the simulation. Any keyword arguments go to add().
+        """
+        self.at(time, self.introduction, routers, peers, kwargs)
+
+    def introduction(self, routers, peers, kwargs):
+        if self.directory is not None:
+            self.directory.extend(routers)
+            [setattr(r, "routers", self.directory) for r in routers]
+        utils.introduce(routers, peers)
+        self.add(routers, **kwargs)
+        for r in routers:
+            utils.log("Introduced %s %s into the system.", r, r.node)
+
+    def depart(self, time, routers):
+        """
+        Have routers leave the network at time. Their peers keep them in their
+        routing tables but can no longer locate them.
+        """
+        self.at(time, self.departure, routers)
+
+    def departure(self, routers):
+        for router in routers:
+            self.departed.add(router.id)
+            if self.directory is not None and router in self.directory:
+                self.directory.remove(router)
+            utils.log("%s %s left the system.", router, router.node)
+
+    def run(self, until):
+        """
+        Process events up to time until, taking a snapshot of utils.counters
+        as each unit of time with events in it begins.
+        """
+        utils.log("Simulating %s units of time.", "{:,}".format(until - self.now))
+        queue = self.queue
+        if utils.recorder is not None:
+            utils.recorder.network(self.routers)
+        with utils.phase("events"):
+            while queue and queue[0][0] <= until:
+                time, _, action, args = heapq.heappop(queue)
+                if int(time) > int(self.now) or not self.events:
+                    utils.counters.snapshot()
+                    if utils.recorder is not None:
+                        utils.recorder.advance(int(time))
+                self.now = time
+                if action in (self.transaction, self.sense) and args[0].id in self.departed:
+                    continue
+                self.events += 1
+                utils.count("events")
+                action(*args)
+        self.now = max(self.now, until)
+
+map = {
+    "numpy":      VectorPTPEngine,
+    "eigentrust": EigenTrust,
+}
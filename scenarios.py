@@ -16,7 +16,75 @@ Real-world networks are unlikely to begin with 20 users so it's advised to test
 new algorithms with low node counts and high iteration counts.
 """
 import utils
-import random
+import traces
+import engines
+import checkpoints
+
+# The chance of a transaction between two good peers going wrong in scenarios
+# where that happens, as in router.random.randint(0, 250) == 1.
+MISHAPS = 1 / 251.0
+
+def batched(options):
+    """
+    Return the engines.RoundEngine to run rounds of transactions with if
+    --batch was given, or None to run them one at a time.
+    """
+    if getattr(options, "batch", False):
+        return engines.RoundEngine(utils.Router.state)
+
+def evented(options, directory=None):
+    """
+    Return the engines.EventEngine to run the scenario on for --duration
+    units of time if that was given, or None to run it in rounds.
+    """
+    if getattr(options, "duration", None):
+        return engines.EventEngine(directory, getattr(options, "rate", None),
+                                   getattr(options, "sense_jobs", 0))
+
+def mishaps(message, trusted=True):
+    """
+    Return a transact(router, peer) for engines.EventEngine under which
+    transactions between good routers go wrong as often as in the round
+    loops, only with trusted peers if trusted is True.
+    """
+    def transact(router, peer):
+        if not router.probably_malicious and not peer.router.probably_malicious:
+            if (peer.trust or not trusted) and router.random.randint(0, 250) == 1:
+                utils.log(message, router.node, peer)
+                return router.transact_with(peer, transaction_type=False)
+        return router.transact_with(peer)
+    return transact
+
+def scheduled(options):
+    """
+    Return the utils.Scheduler that decides which routers sense each round,
+    sensing all of them every --sense-every rounds if that was given.
+    """
+    return utils.Scheduler(getattr(options, "sense_every", None),
+                           getattr(options, "sense_jobs", 0))
+
+def rounds(options, routers, count, sensing):
+    """
+    Yield the number of each of count rounds to run with the network routers
+    make up, snapshotting utils.counters and moving utils.recorder on as each
+    begins. With --resume the network and sensing are restored from a
+    checkpoint and the rounds pick up where it left off, and with --checkpoint
+    they're checkpointed every --checkpoint-every rounds. See checkpoints.py.
+    """
+    start = 0
+    if getattr(options, "resume", None):
+        start = checkpoints.restore(options.resume, routers, sensing)
+    path  = getattr(options, "checkpoint", None)
+    every = getattr(options, "checkpoint_every", None)
+    if utils.recorder is not None:
+        utils.recorder.network(routers)
+    for n in range(start, count):
+        if path and every and n > start and not n % every:
+            checkpoints.save(path, n, routers, sensing, options)
+        utils.counters.snapshot()
+        if utils.recorder is not None:
+            utils.recorder.advance(n)
+        yield n
 
 def scenario_one(options):
     """
@@ -27,8 +95,8 @@ def scenario_one(options):
     Makes for an uncomplicated calculate_trust() computation.
     """
     routers      = utils.generate_routers(options, minimum=4)
-    good_routers = routers[:len(routers) / 2]
-    bad_routers  = routers[len(routers) / 2:]
+    good_routers = routers[:len(routers) // 2]
+    bad_routers  = routers[len(routers) // 2:]
 
 
     [setattr(_, "probably_malicious", True) for _ in bad_routers]
@@ -41,25 +109,33 @@ def scenario_one(options):
     
     utils.introduce(good_routers, bad_routers)
 
+    events = evented(options)
+    if events:
+        events.add(routers)
+        events.run(options.duration)
+        return {"routers": routers}
+
     # Note that this is based on a definite transaction count but that it's
     # through a random transaction count that the distributed trust algorithm
     # can be used to detect malicious peers via the set of pre-trusted peers.
     utils.log("Emulating %s iterations of transactions with all peers." % \
         "{:,}".format(options.transactions))
-    for _ in range(options.transactions):
-        for router in routers:
-            for peer in router:
-                c = random.randint(0, 1)
-                if options.verbose:
-                    utils.log("%s is making %i transactions with %s." % (router, c, peer))
-                [router.transact_with(peer) for i in range(c)]
-
-        # Calculate trust every 5 rounds here. The periodicity in reality is a
-        # function of network size.
-        if _ > 1 and not (_+1) % 5:
-            for i, router in enumerate(routers):
-                utils.log("%i %s %s is sensing." % (i+1, router, router.node))
-                router.tbucket.calculate_trust()
+    batch = batched(options)
+    sensing = scheduled(options)
+    for _ in rounds(options, routers, options.transactions, sensing):
+        with utils.phase("transactions"):
+            if batch:
+                batch.run(routers)
+            else:
+                for router in routers:
+                    for peer in router:
+                        c = router.random.randint(0, 1)
+                        if options.verbose:
+                            utils.log("%s is making %i transactions with %s.", router, c, peer)
+                        [router.transact_with(peer) for i in range(c)]
+
+        # Have whichever routers are due calculate trust.
+        sensing.run(routers, _)
 
     # The return value of a scenario is used to populate "locals" in the event
     # that you choose to use the --repl flag to spawn an interactive interpreter.
@@ -78,8 +154,8 @@ def scenario_two(options):
     This scenario has the highest likelihood of exhibiting consensus events.
     """
     routers      = utils.generate_routers(options, minimum=2)
-    good_routers = routers[:len(routers) / 2]
-    bad_routers  = routers[len(routers) / 2:]
+    good_routers = routers[:len(routers) // 2]
+    bad_routers  = routers[len(routers) // 2:]
 
 
     [setattr(_, "probably_malicious", True) for _ in bad_routers]
@@ -92,51 +168,74 @@ def scenario_two(options):
     
     utils.introduce(good_routers, bad_routers)
 
-    # Note that this is based on a definite transaction count but it's through a
-    # random transaction count with the possibility of some peers not transacting
-    # with some of their peers at all that the distributed trust algorithm can be
-    # used to detect malicious peers via the set of pre-trusted peers alone.
-    utils.log("Emulating %s iterations of transactions with all peers." % \
-        "{:,}".format(options.transactions))
-    for _ in range(options.transactions):
-        for router in routers:
-            for peer in router:
-                if not random.randint(0, 1): continue
-                if not router.probably_malicious and not peer.router.probably_malicious:
-                    if peer.trust and random.randint(0, 250) == 1:
-                        utils.log("Good peer %s is having a bad transaction with good peer %s." % \
-                            (router.node, peer))
-                        router.transact_with(peer, transaction_type=False)
-                        continue
-                router.transact_with(peer)
-
-        # Calculate trust every 5 rounds here. Normally the periodicity would be
-        # a function of network size.
-        if _ > 1 and not (_+1) % 5:
-            for i, router in enumerate(routers):
-                utils.log("%i %s %s is sensing." % (i+1, router, router.node))
-                router.tbucket.calculate_trust()
-
-        # Introduce a mix of new peers every 1/5th of the iteration count
-        if _ > 5 and not _ % (options.transactions / 5):
-            new_good_routers = utils.generate_routers(options, maximum=random.randint(1, 3))
+    churn = utils.stream("churn")
+    def inject():
+        """
+        Introduce a mix of new peers, returning them.
+        """
+        with utils.phase("injection"):
+            new_good_routers = utils.generate_routers(options, maximum=churn.randint(1, 3))
             new_bad_routers  = utils.generate_routers(options,
-                                                   maximum=random.randint(1, 3),
+                                                   maximum=churn.randint(1, 3),
                                                    attrs={'probably_malicious': True})
-            
+        
             routers.extend(new_good_routers)
             routers.extend(new_bad_routers)
             [setattr(r, "routers", routers) for r in routers]
 
-            utils.introduce(new_good_routers, random.sample(routers,
-                random.choice(range(2, len(routers)))))
-            utils.introduce(new_bad_routers,  random.sample(routers,
-                random.choice(range(2, len(routers)))))
-            
+            utils.introduce(new_good_routers, churn.sample(routers,
+                churn.choice(range(2, len(routers)))))
+            utils.introduce(new_bad_routers,  churn.sample(routers,
+                churn.choice(range(2, len(routers)))))
+        
             for r in new_good_routers:
-                utils.log("Introduced %s %s into the system." % (r, r.node))
+                utils.log("Introduced %s %s into the system.", r, r.node)
             for r in new_bad_routers:
-                utils.log("Introduced %s %s into the system." % (r, r.node))
+                utils.log("Introduced %s %s into the system.", r, r.node)
+        return new_good_routers + new_bad_routers
+
+    events = evented(options)
+    if events:
+        transact = mishaps("Good peer %s is having a bad transaction with good peer %s.")
+        events.add(routers, transact)
+        for i in range(1, 5):
+            events.at(i * options.duration / 5.0, lambda: events.add(inject(), transact))
+        events.run(options.duration)
+        return {"routers": routers}
+
+    # Note that this is based on a definite transaction count but it's through a
+    # random transaction count with the possibility of some peers not transacting
+    # with some of their peers at all that the distributed trust algorithm can be
+    # used to detect malicious peers via the set of pre-trusted peers alone.
+    utils.log("Emulating %s iterations of transactions with all peers." % \
+        "{:,}".format(options.transactions))
+    batch = batched(options)
+    sensing = scheduled(options)
+    for _ in rounds(options, routers, options.transactions, sensing):
+        with utils.phase("transactions"):
+            if batch:
+                batch.run(routers, mishaps=MISHAPS)
+                for router, peer in batch.mishaps:
+                    utils.log("Good peer %s is having a bad transaction with good peer %s.",
+                        router.node, peer)
+            else:
+                for router in routers:
+                    for peer in router:
+                        if not router.random.randint(0, 1): continue
+                        if not router.probably_malicious and not peer.router.probably_malicious:
+                            if peer.trust and router.random.randint(0, 250) == 1:
+                                utils.log("Good peer %s is having a bad transaction with good peer %s.",
+                                    router.node, peer)
+                                router.transact_with(peer, transaction_type=False)
+                                continue
+                        router.transact_with(peer)
+
+        # Have whichever routers are due calculate trust.
+        sensing.run(routers, _)
+
+        # Introduce a mix of new peers every 1/5th of the iteration count
+        if _ > 5 and not _ % (options.transactions // 5):
+            inject()
 
     return {"routers": routers}
 
@@ -160,11 +259,11 @@ def scenario_three(options):
                 for peer in self.peers:
                     data = peer.jsonify()
                     low  = 0.5 - (data['transactions'] * self.node.epsilon)
-                    data['trust'] = random.choice([low, 0])
+                    data['trust'] = self.random.choice([low, 0])
                     response.append(data)
                 return response
 
-    routers      = []
+    routers      = utils.RouterDirectory()
     good_routers = utils.generate_routers(options, minimum=4)
     bad_routers  = utils.generate_routers(options, minimum=1,
                                                    maximum=options.pre_trusted,
@@ -175,57 +274,81 @@ def scenario_three(options):
     [setattr(r, "routers", routers) for r in routers]
     utils.introduce(routers)
     
-    [r.tbucket.append(_) for _ in r.peers if _.router.__class__.__name__ == \
-    "EvilRouter" for r in good_routers]
+    [r.tbucket.append(_) for r in good_routers for _ in r.peers \
+    if _.router.__class__.__name__ == "EvilRouter"]
     
 
-    # Note that this is based on a definite transaction count but it's through a
-    # random transaction count with the possibility of some peers not transacting
-    # with some of their peers at all that the distributed trust algorithm can be
-    # used to detect malicious peers via the set of pre-trusted peers alone.
-    utils.log("Emulating %s iterations of transactions with all peers." % \
-        "{:,}".format(options.transactions))
-    for _ in range(options.transactions):
-        for router in routers:
-            for peer in router:
-                if not random.randint(0, 1): continue
-                if not router.probably_malicious and not peer.router.probably_malicious:
-                    if random.randint(0, 250) == 1:
-                        utils.log("Good peer %s is having a bad transaction with good peer %s." % \
-                            (router.node, peer))
-                        router.transact_with(peer, transaction_type=False)
-                        continue
-                router.transact_with(peer)
-
-        # Calculate trust every 5 rounds here. Normally the periodicity would be
-        # a function of network size.
-        if _ > 1 and not (_+1) % 5:
-            for i, router in enumerate(routers):
-                utils.log("%i %s %s is sensing." % (i+1, router, router.node))
-                router.tbucket.calculate_trust()
-
-        # Introduce a mix of new peers every 1/5th of the iteration count
-        if _ > 5 and not _ % (options.transactions / 5):
+    churn = utils.stream("churn")
+    def inject():
+        """
+        Introduce a mix of new peers, returning them.
+        """
+        with utils.phase("injection"):
             new_good_routers = utils.generate_routers(options,
-                                                   maximum=random.randint(1, 3))
+                                                   maximum=churn.randint(1, 3))
             new_bad_routers  = utils.generate_routers(options,
-                                                   maximum=random.randint(1, 3),
+                                                   maximum=churn.randint(1, 3),
                                                    attrs={'probably_malicious': True})
-            
+        
             routers.extend(new_good_routers)
             routers.extend(new_bad_routers)
-            
+        
             [setattr(r, "routers", routers) for r in routers]
 
-            utils.introduce(new_good_routers, random.sample(good_routers,
-                random.choice(range(2, 6))))
-            utils.introduce(new_bad_routers,  random.sample(good_routers,
-                random.choice(range(2, 6))))
-            
+            utils.introduce(new_good_routers, churn.sample(good_routers,
+                churn.choice(range(2, 6))))
+            utils.introduce(new_bad_routers,  churn.sample(good_routers,
+                churn.choice(range(2, 6))))
+        
             for r in new_good_routers:
-                utils.log("Introduced %s %s into the system." % (r, r.node))
+                utils.log("Introduced %s %s into the system.", r, r.node)
             for r in new_bad_routers:
-                utils.log("Introduced %s %s into the system." % (r, r.node))
+                utils.log("Introduced %s %s into the system.", r, r.node)
+        return new_good_routers + new_bad_routers
+
+    events = evented(options)
+    if events:
+        transact = mishaps("Good peer %s is having a bad transaction with good peer %s.",
+                           trusted=False)
+        events.add(routers, transact)
+        for i in range(1, 5):
+            events.at(i * options.duration / 5.0, lambda: events.add(inject(), transact))
+        events.run(options.duration)
+        return {"routers": routers}
+
+    # Note that this is based on a definite transaction count but it's through a
+    # random transaction count with the possibility of some peers not transacting
+    # with some of their peers at all that the distributed trust algorithm can be
+    # used to detect malicious peers via the set of pre-trusted peers alone.
+    utils.log("Emulating %s iterations of transactions with all peers." % \
+        "{:,}".format(options.transactions))
+    batch = batched(options)
+    sensing = scheduled(options)
+    for _ in rounds(options, routers, options.transactions, sensing):
+        with utils.phase("transactions"):
+            if batch:
+                batch.run(routers, mishaps=MISHAPS)
+                for router, peer in batch.mishaps:
+                    utils.log("Good peer %s is having a bad transaction with good peer %s.",
+                        router.node, peer)
+            else:
+                for router in routers:
+                    for peer in router:
+                        if not router.random.randint(0, 1): continue
+                        if not router.probably_malicious and not peer.router.probably_malicious:
+                            if router.random.randint(0, 250) == 1:
+                                utils.log("Good peer %s is having a bad transaction with good peer %s.",
+                                    router.node, peer)
+                                router.transact_with(peer, transaction_type=False)
+                                continue
+                        router.transact_with(peer)
+
+        # Have whichever routers are due calculate trust.
+        sensing.run(routers, _)
+
+        # Introduce a mix of new peers every 1/5th of the iteration count
+        if _ > 5 and not _ % (options.transactions // 5):
+            inject()
 
     return {"routers": routers}
 
@@ -244,43 +367,66 @@ def scenario_four(options):
     
     [_.tbucket.append(_.peers[:options.pre_trusted]) for _ in routers]
 
+    churn = utils.stream("churn")
+    def inject():
+        """
+        Introduce a few new peers, returning them.
+        """
+        with utils.phase("injection"):
+            new_routers = utils.generate_routers(options, maximum=churn.randint(1, 3))
+        
+            routers.extend(new_routers)
+            [setattr(r, "routers", routers) for r in routers]
+
+            utils.introduce(new_routers, churn.sample(routers,
+                churn.choice(range(2, len(routers)))))
+        
+            for r in new_routers:
+                utils.log("Introduced %s %s into the system.", r, r.node)
+        return new_routers
+
+    events = evented(options)
+    if events:
+        transact = mishaps("Peer %s is having a bad transaction with %s.")
+        events.add(routers, transact)
+        for i in range(1, 5):
+            events.at(i * options.duration / 5.0, lambda: events.add(inject(), transact))
+        events.run(options.duration)
+        return {"routers": routers}
+
     # Note that this is based on a definite transaction count but it's through a
     # random transaction count with the possibility of some peers not transacting
     # with some of their peers at all that the distributed trust algorithm can be
     # used to detect malicious peers via the set of pre-trusted peers alone.
     utils.log("Emulating %s iterations of transactions with all peers." % \
         "{:,}".format(options.transactions))
-    for _ in range(options.transactions):
-        for router in routers:
-            for peer in router:
-                if not random.randint(0, 1): continue
-                if not router.probably_malicious and not peer.router.probably_malicious:
-                    if peer.trust and random.randint(0, 250) == 1:
-                        utils.log("Peer %s is having a bad transaction with %s." % \
-                            (router.node, peer))
-                        router.transact_with(peer, transaction_type=False)
-                        continue
-                router.transact_with(peer)
-
-        # Calculate trust every 5 rounds here. Normally the periodicity would be
-        # a function of network size.
-        if _ > 1 and not (_+1) % 5:
-            for i, router in enumerate(routers):
-                utils.log("%i %s %s is sensing." % (i+1, router, router.node))
-                router.tbucket.calculate_trust()
+    batch = batched(options)
+    sensing = scheduled(options)
+    for _ in rounds(options, routers, options.transactions, sensing):
+        with utils.phase("transactions"):
+            if batch:
+                batch.run(routers, mishaps=MISHAPS)
+                for router, peer in batch.mishaps:
+                    utils.log("Peer %s is having a bad transaction with %s.",
+                        router.node, peer)
+            else:
+                for router in routers:
+                    for peer in router:
+                        if not router.random.randint(0, 1): continue
+                        if not router.probably_malicious and not peer.router.probably_malicious:
+                            if peer.trust and router.random.randint(0, 250) == 1:
+                                utils.log("Peer %s is having a bad transaction with %s.",
+                                    router.node, peer)
+                                router.transact_with(peer, transaction_type=False)
+                                continue
+                        router.transact_with(peer)
+
+        # Have whichever routers are due calculate trust.
+        sensing.run(routers, _)
 
         # Introduce a mix of new peers every 1/5th of the iteration count
-        if _ > 5 and not _ % (options.transactions / 5):
-            new_routers = utils.generate_routers(options, maximum=random.randint(1, 3))
-            
-            routers.extend(new_routers)
-            [setattr(r, "routers", routers) for r in routers]
-
-            utils.introduce(new_routers, random.sample(routers,
-                random.choice(range(2, len(routers)))))
-            
-            for r in new_routers:
-                utils.log("Introduced %s %s into the system." % (r, r.node))
+        if _ > 5 and not _ % (options.transactions // 5):
+            inject()
 
     return {"routers": routers}
 
@@ -299,20 +445,28 @@ def threat_model_a(options):
 
     routers.insert(0, good_peer)
     
+    events = evented(options)
+    if events:
+        events.add(routers)
+        events.run(options.duration)
+        return {"routers": routers}
+
     utils.log("Emulating %s iterations of transactions with all peers." % \
         "{:,}".format(options.transactions))
-    for _ in range(options.transactions):
-        for router in routers:
-            for peer in router.peers:
-                if not random.randint(0, 1): continue
-                router.transact_with(peer)
-
-        # Calculate trust every 5 rounds here. Normally the periodicity would be
-        # a function of network size.
-        if _ > 1 and not (_+1) % 5:
-            for i, router in enumerate(routers):
-                utils.log("%i %s %s is sensing." % (i+1, router, router.node))
-                router.tbucket.calculate_trust()
+    batch = batched(options)
+    sensing = scheduled(options)
+    for _ in rounds(options, routers, options.transactions, sensing):
+        with utils.phase("transactions"):
+            if batch:
+                batch.run(routers)
+            else:
+                for router in routers:
+                    for peer in router.peers:
+                        if not router.random.randint(0, 1): continue
+                        router.transact_with(peer)
+
+        # Have whichever routers are due calculate trust.
+        sensing.run(routers, _)
 
     return {"routers": routers}
 
@@ -332,7 +486,7 @@ def threat_model_b(options):
             response = []
             for peer in self.peers:
                 data = peer.jsonify()
-                if any(filter(lambda r: r.node == peer, self.collective)):
+                if self.collective.locate(peer):
                     data['trust'] = peer.transactions * self.node.epsilon
                 response.append(data)
             return response
@@ -342,7 +496,7 @@ def threat_model_b(options):
 
     [setattr(r, "collective", routers) for r in routers]
 
-    all_routers = []
+    all_routers = utils.RouterDirectory()
     all_routers.extend(good_peers)
     all_routers.extend(routers)
 
@@ -356,22 +510,32 @@ def threat_model_b(options):
     [_.tbucket.append(_.peers[:options.pre_trusted]) for _ in good_peers]
 
     divisor = 1 if options.nodes == 1 else 2
-    utils.introduce(good_peers, random.sample(routers, len(routers) / divisor))
+    introductions = utils.stream("introductions")
+    utils.introduce(good_peers, introductions.sample(routers, len(routers) // divisor))
+
+    events = evented(options)
+    if events:
+        events.add(good_peers, sense=False)
+        events.add(routers)
+        events.run(options.duration)
+        return {"routers": all_routers}
 
     utils.log("Emulating %s iterations of transactions with all peers." % \
         "{:,}".format(options.transactions))
-    for _ in range(options.transactions):
-        for router in all_routers:
-            for peer in router.peers:
-                if not random.randint(0, 1): continue
-                router.transact_with(peer)
-
-        # Calculate trust every 5 rounds here. Normally the periodicity would be
-        # a function of network size.
-        if _ > 1 and not (_+1) % 5:
-            for i, router in enumerate(routers):
-                utils.log("%i %s %s is sensing." % (i+1, router, router.node))
-                router.tbucket.calculate_trust()
+    batch = batched(options)
+    sensing = scheduled(options)
+    for _ in rounds(options, all_routers, options.transactions, sensing):
+        with utils.phase("transactions"):
+            if batch:
+                batch.run(all_routers)
+            else:
+                for router in all_routers:
+                    for peer in router.peers:
+                        if not router.random.randint(0, 1): continue
+                        router.transact_with(peer)
+
+        # Have whichever routers are due calculate trust.
+        sensing.run(routers, _)
 
     return {"routers": all_routers}
 
@@ -399,9 +563,17 @@ def threat_model_c(options):
             self.responses[1] += 1
             return False
 
+        def malicious_batch(self, count):
+            counters     = [(self.counter + i) % 100 for i in range(1, count + 1)]
+            self.counter = counters[-1] if counters else self.counter
+            malicious    = [c <= max(int(100 * self.f), 1) for c in counters]
+            self.responses[0] += sum(malicious)
+            self.responses[1] += count - sum(malicious)
+            return malicious
+
     bad_peers  = utils.generate_routers(options, minimum=10, router_class=EvilRouter)
     good_peers = utils.generate_routers(options, minimum=5)
-    routers = []
+    routers = utils.RouterDirectory()
     routers.extend(bad_peers)
     routers.extend(good_peers)
     [setattr(r, "routers", routers) for r in bad_peers]
@@ -413,24 +585,36 @@ def threat_model_c(options):
     # Configure pre-trusted peers
     [_.tbucket.append(_.peers[:options.pre_trusted]) for _ in good_peers]
 
-    utils.introduce(good_peers, random.sample(bad_peers, options.nodes))
+    introductions = utils.stream("introductions")
+    utils.introduce(good_peers, introductions.sample(bad_peers, options.nodes))
 
     transactions = max(options.transactions, 100)
 
+    events = evented(options)
+    if events:
+        events.add(routers)
+        events.run(options.duration)
+        for router in bad_peers:
+            utils.log("%s %i negative transactions, %i positive." % \
+                (router, router.responses[0], router.responses[1]))
+        return {"routers": routers}
+
     utils.log("Emulating %s transactions with each peer." % \
         "{:,}".format(transactions))
-    for _ in range(transactions):
-        for router in routers:
-            for peer in router.peers:
-                if not random.randint(0, 1): continue
-                router.transact_with(peer)
-
-        # Calculate trust every 5 rounds here. Normally the periodicity would be
-        # a function of network size.
-        if _ > 1 and not (_+1) % 5:
-            for i, router in enumerate(routers):
-                utils.log("%i %s %s is sensing." % (i+1, router, router.node))
-                router.tbucket.calculate_trust()
+    batch = batched(options)
+    sensing = scheduled(options)
+    for _ in rounds(options, routers, transactions, sensing):
+        with utils.phase("transactions"):
+            if batch:
+                batch.run(routers)
+            else:
+                for router in routers:
+                    for peer in router.peers:
+                        if not router.random.randint(0, 1): continue
+                        router.transact_with(peer)
+
+        # Have whichever routers are due calculate trust.
+        sensing.run(routers, _)
 
     for router in bad_peers:
         utils.log("%s %i negative transactions, %i positive." % \
@@ -451,7 +635,7 @@ def threat_model_d(options):
             response = []
             for peer in self.peers:
                 data = peer.jsonify()
-                if any(filter(lambda r: r.node == peer, self.collective)):
+                if self.collective.locate(peer):
                     data['trust'] = 0.5 + (peer.transactions * \
                         self.node.epsilon)
                 response.append(data)
@@ -467,7 +651,7 @@ def threat_model_d(options):
             response = []
             for peer in self.peers:
                 data = peer.jsonify()
-                if any(filter(lambda r: r.node == peer, self.collective)):
+                if self.collective.locate(peer):
                     data['trust'] = max(0.5 + (peer.transactions * \
                         self.node.epsilon), 0.5)
                 response.append(data)
@@ -479,7 +663,7 @@ def threat_model_d(options):
                                               router_class=AccompliceRouter)
     good_peers       = utils.generate_routers(options, minimum=20)
 
-    routers = []
+    routers = utils.RouterDirectory()
     routers.extend(bad_peers)
     routers.extend(accomplice_peers)
     routers.extend(good_peers)
@@ -492,29 +676,44 @@ def threat_model_d(options):
     utils.introduce(routers)
     
     # Set good peers up with some pre-trusted friends
-    [_.tbucket.append(random.sample(_.peers, options.pre_trusted)) for _ in good_peers]
+    introductions = utils.stream("introductions")
+    [_.tbucket.append(introductions.sample(_.peers, options.pre_trusted)) for _ in good_peers]
+
+    events = evented(options)
+    if events:
+        # Good peers transact in both phases of a round.
+        events.add(good_peers, sense=False)
+        events.add(routers)
+        events.run(options.duration)
+        return {"routers": routers}
 
     utils.log("Emulating %s iterations of transactions with all peers." % \
         "{:,}".format(options.transactions))
-    for _ in range(options.transactions):
-        for router in good_peers:
-            for peer in router.peers:
-                if not random.randint(0, 1): continue
-                router.transact_with(peer)
+    batch = batched(options)
+    sensing = scheduled(options)
+    for _ in rounds(options, routers, options.transactions, sensing):
+        with utils.phase("transactions"):
+            if batch:
+                batch.run(good_peers)
+            else:
+                for router in good_peers:
+                    for peer in router.peers:
+                        if not router.random.randint(0, 1): continue
+                        router.transact_with(peer)
 
         # Accomplice routers work by doubling the trust trust rating of
         # peers in the collective, which necessitates some good transactions
-        for router in routers:
-            for peer in router.peers:
-                if not random.randint(0, 1): continue
-                router.transact_with(peer)
-
-        # Calculate trust every 5 rounds here. Normally the periodicity would be
-        # a function of network size.
-        if _ > 1 and not (_+1) % 5:
-            for i, router in enumerate(routers):
-                utils.log("%i %s %s is sensing." % (i+1, router, router.node))
-                router.tbucket.calculate_trust()
+        with utils.phase("transactions"):
+            if batch:
+                batch.run(routers)
+            else:
+                for router in routers:
+                    for peer in router.peers:
+                        if not router.random.randint(0, 1): continue
+                        router.transact_with(peer)
+
+        # Have whichever routers are due calculate trust.
+        sensing.run(routers, _)
 
     return {"routers": routers}
 
@@ -529,7 +728,7 @@ def threat_model_e(options):
     
     [setattr(r, "probably_malicious", True) for r in bad_peers]
 
-    routers = []
+    routers = utils.RouterDirectory()
     routers.extend(bad_peers)
     routers.extend(good_peers)
 
@@ -543,35 +742,61 @@ def threat_model_e(options):
     [_.tbucket.append(_.peers[:options.pre_trusted]) for _ in good_peers]
 
     divisor = 1 if options.nodes == 1 else 2
-    utils.introduce(good_peers, random.sample(bad_peers, len(routers) / divisor))
+    introductions = utils.stream("introductions")
+    utils.introduce(good_peers, introductions.sample(bad_peers, len(routers) // divisor))
+
+    def replace(router, peer):
+        """
+        Replace the sybil behind peer with a new identity.
+        """
+        router.dereference(peer, and_router=True)
+        new_router = utils.Router()
+        new_router.probably_malicious = True
+        utils.introduce(router, new_router)
+
+    events = evented(options)
+    if events:
+        def transact(router, peer):
+            if router.transact_with(peer) == False:
+                replace(router, peer)
+        events.add(good_peers, transact, sense=False)
+        events.add(routers)
+        events.run(options.duration)
+        return {"routers": routers}
 
     utils.log("Emulating %s iterations of transactions with all peers." % \
         "{:,}".format(options.transactions))
-    for _ in range(options.transactions):
-        for router in good_peers:
-            for peer in router.peers:
-                if not random.randint(0, 1): continue 
-                positive_transaction = router.transact_with(peer)
-                
-                if positive_transaction == False:
-                    router.dereference(peer, and_router=True)
-                    new_router = utils.Router()
-                    new_router.probably_malicious = True
-                    utils.introduce(router, new_router)
+    batch = batched(options)
+    sensing = scheduled(options)
+    for _ in rounds(options, routers, options.transactions, sensing):
+        with utils.phase("transactions"):
+            if batch:
+                for router, peer in batch.run(good_peers):
+                    # Only the first good peer to be let down by a sybil replaces it.
+                    if not router.locate(peer): continue
+                    replace(router, peer)
+            else:
+                for router in good_peers:
+                    for peer in router.peers:
+                        if not router.random.randint(0, 1): continue 
+                        positive_transaction = router.transact_with(peer)
+                    
+                        if positive_transaction == False:
+                            replace(router, peer)
 
         # Accomplice routers work by doubling the trust trust rating of
         # peers in the collective, which necessitates some good transactions
-        for router in routers:
-            for peer in router.peers:
-                if not random.randint(0, 1): continue
-                router.transact_with(peer)
+        with utils.phase("transactions"):
+            if batch:
+                batch.run(routers)
+            else:
+                for router in routers:
+                    for peer in router.peers:
+                        if not router.random.randint(0, 1): continue
+                        router.transact_with(peer)
         
-        # Calculate trust every 5 rounds here. Normally the periodicity would be
-        # a function of network size.
-        if _ > 1 and not (_+1) % 5:
-            for i, router in enumerate(routers):
-                utils.log("%i %s %s is sensing." % (i+1, router, router.node))
-                router.tbucket.calculate_trust()
+        # Have whichever routers are due calculate trust.
+        sensing.run(routers, _)
 
     return {"routers": routers}
 
@@ -591,10 +816,14 @@ def threat_model_f(options):
             self.counter += 1
             return not self.counter % 100
 
+        def malicious_batch(self, count):
+            self.counter += count
+            return [not c % 100 for c in range(self.counter - count + 1, self.counter + 1)]
+
     bad_peers  = utils.generate_routers(options, minimum=10,
                                         router_class=EvilRouter)
     good_peers = utils.generate_routers(options, minimum=5)
-    routers = []
+    routers = utils.RouterDirectory()
     routers.extend(bad_peers)
     routers.extend(good_peers)
     [setattr(r, "routers", routers) for r in bad_peers]
@@ -607,31 +836,93 @@ def threat_model_f(options):
     [_.tbucket.append(_.peers[:options.pre_trusted]) for _ in good_peers]
 
     # and then some not so trustworthy peers
-    utils.introduce(good_peers, random.sample(bad_peers, options.nodes))
+    introductions = utils.stream("introductions")
+    utils.introduce(good_peers, introductions.sample(bad_peers, options.nodes))
 
     # Since our EvilRouter only does its thing once every hundred transactions
     # we're going to define a minimum transaction count of 1,000 in this case.
     transactions = max(options.transactions, 1000)
 
+    events = evented(options)
+    if events:
+        events.add(routers)
+        events.run(options.duration)
+        return {"routers": routers}
+
     utils.log("Emulating %s transactions with each peer." % \
         "{:,}".format(transactions))
-    for _ in range(transactions):
+    batch = batched(options)
+    sensing = scheduled(options)
+    for _ in rounds(options, routers, transactions, sensing):
         # Accomplice routers work by doubling the trust trust rating of
         # peers in the collective, which requires some good transactions
-        for router in routers:
-            for peer in router.peers:
-                if not random.randint(0, 1): continue
-                router.transact_with(peer)
-
-        # Calculate trust every 5 rounds here. Normally the periodicity would be
-        # a function of network size.
-        if _ > 1 and not (_+1) % 5:
-            for i, router in enumerate(routers):
-                utils.log("%i %s %s is sensing." % (i+1, router, router.node))
-                router.tbucket.calculate_trust()
+        with utils.phase("transactions"):
+            if batch:
+                batch.run(routers)
+            else:
+                for router in routers:
+                    for peer in router.peers:
+                        if not router.random.randint(0, 1): continue
+                        router.transact_with(peer)
+
+        # Have whichever routers are due calculate trust.
+        sensing.run(routers, _)
 
     return {"routers": routers}
 
+def overlay(options):
+    """
+    A sparse overlay network, too large to run in rounds, run as a
+    discrete-event simulation for --duration units of time, or --transactions
+    if that isn't given. Each router is introduced to eight others on average
+    and knows those who were introduced to it. A tenth of them are malicious.
+
+    ./eigentrust.py -s overlay -n 100000 --duration 60 --rate 0.1
+    """
+    routers = utils.generate_routers(options, minimum=2, shared=True)
+    count   = len(routers)
+
+    introductions = utils.stream("introductions")
+    for i in introductions.sample(range(count), count // 10):
+        routers[i].probably_malicious = True
+
+    tables = [set() for _ in routers]
+    for i in range(count):
+        for _ in range(4):
+            j = introductions.randrange(count)
+            if j != i:
+                tables[i].add(j)
+                tables[j].add(i)
+    for router, table in zip(routers, tables):
+        router.peers = [routers[j].node.copy() for j in sorted(table)]
+
+    # Good routers start out trusting their first good peers.
+    for router in routers:
+        if not router.probably_malicious:
+            router.tbucket.append([p for p in router.peers if not
+                                   p.router.probably_malicious][:options.pre_trusted])
+
+    events = evented(options, routers) or \
+        engines.EventEngine(routers, getattr(options, "rate", None),
+                            getattr(options, "sense_jobs", 0))
+    events.add(routers)
+    events.run(getattr(options, "duration", None) or options.transactions)
+    return {"routers": routers}
+
+def replay(options):
+    """
+    Replay the last run recorded in the trace given with --replay, putting
+    fresh routers through the same transactions, with the bucket given with
+    --bucket if any. See traces.replay().
+
+    ./eigentrust.py -s two -n 50 -t 1000 --seed 1 --trace two.trace
+    ./eigentrust.py --replay two.trace --bucket tbucket
+    """
+    bucket = getattr(options, "bucket", None)
+    routers = traces.replay(options.replay, traces.BUCKETS[bucket] if bucket else None,
+                            options.no_prisoners, getattr(options, "sense_jobs", 0))
+    return {"routers": routers}
+
 map = {
         "one":   scenario_one,
         "two":   scenario_two,
@@ -642,6 +933,8 @@ map = {
         "C": threat_model_c,
         "D": threat_model_d,
         "E": threat_model_e,
-        "F": threat_model_f
+        "F": threat_model_f,
+        "overlay": overlay,
+        "replay":  replay
       }
 
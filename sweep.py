@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# _*_ coding: utf-8 _*_
+"""
+Parameter sweeps over scenarios.
+
+A sweep runs a scenario once per seed for every combination of the values
+given for each parameter, spread across a pool of worker processes, and
+summarises the runs for each combination with means and 95% confidence
+intervals:
+
+    ./eigentrust.py --scenario two --sweep nodes=20,50,100 --sweep alpha=250,500 \\
+        --seeds 16 --jobs 8
+
+Parameters are either eigentrust.py options (nodes, pre_trusted, transactions)
+or attributes of PTPBucket (alpha, beta, gamma, delta).
+"""
+import math
+import utils
+import optparse
+import itertools
+import contextlib
+import scenarios
+import multiprocessing
+
+OPTIONS = ("nodes", "pre_trusted", "transactions")
+BUCKET  = ("alpha", "beta", "gamma", "delta")
+
+# What summarise() gives for each combination of parameters, in order.
+MEASURES = ("Runs", "Consensus Events", "Accuracy", "Good Trust", "Malicious Trust")
+
+# Two-tailed 95% critical values of Student's t distribution by degrees of
+# freedom. Beyond the table the normal distribution is close enough.
+T_95 = [None, 12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262,
+        2.228, 2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093,
+        2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045,
+        2.042]
+
+def parse(specs):
+    """
+    Turn ["nodes=20,50", "alpha=250,500"] into [("nodes", [20, 50]),
+    ("alpha", [250, 500])].
+    """
+    axes = []
+    for spec in specs:
+        if not "=" in spec:
+            raise ValueError("Expected name=value,value,... but got %s." % spec)
+        name, values = spec.split("=", 1)
+        name = name.strip().replace("-", "_")
+        if not name in OPTIONS + BUCKET:
+            raise ValueError("Can't sweep %s. Choose from %s." % \
+                (name, ", ".join(OPTIONS + BUCKET)))
+        try:
+            values = [float(v) if "." in v else int(v) for v in values.split(",")]
+        except ValueError:
+            raise ValueError("Values for %s must be numbers." % name)
+        axes.append((name, values))
+    return axes
+
+def grid(axes):
+    """
+    Return a dictionary of parameters for every combination of values.
+    """
+    names = [name for name, values in axes]
+    return [dict(zip(names, combination)) for combination in
+            itertools.product(*[values for name, values in axes])]
+
+@contextlib.contextmanager
+def tune(parameters):
+    """
+    Have every PTPBucket use the bucket parameters given for the duration,
+    then put PTPBucket's own back.
+    """
+    parameters = dict((k, v) for k, v in parameters.items() if k in BUCKET)
+    defaults   = dict((name, getattr(utils.PTPBucket, name)) for name in parameters)
+    for name, value in parameters.items():
+        setattr(utils.PTPBucket, name, value)
+    try:
+        yield
+    finally:
+        for name, value in defaults.items():
+            setattr(utils.PTPBucket, name, value)
+
+def run(task):
+    """
+    Run a scenario with one combination of parameters and one seed, in a
+    worker process of its own, and return a summary of how it went.
+    """
+    options, parameters, seed = task
+    options = optparse.Values(options)
+    for name, value in parameters.items():
+        if name in OPTIONS:
+            setattr(options, name, value)
+
+    # Runs are already spread across processes, and pool workers can't fork
+    # their own.
+    options.sense_jobs = min(getattr(options, "sense_jobs", 0), 1)
+
+    utils.set_log_level(utils.WARNING)
+    if options.state or options.batch:
+        utils.Router.state = utils.NetworkState()
+    if getattr(options, "k_bucket", None):
+        utils.Router.k = options.k_bucket
+    # Each run has streams of its own, derived from --seed if one was given.
+    utils.set_seed(seed if options.seed is None else (options.seed, seed))
+
+    with tune(parameters):
+        routers = scenarios.map[options.scenario](options)["routers"]
+
+    # The trust each router has in each of the others, in directory order.
+    keys  = [(r.node.id, r.node.port) for r in routers]
+    trust = []
+    for router in routers:
+        peers = router.peers
+        trust.append([float(peers.lookup(key).trust) if peers.lookup(key) else None
+                      for key in keys])
+
+    # How often good routers' trust ratings agree with who's malicious, where
+    # a rating below the default of 0.5 counts as calling a peer malicious.
+    malicious = [bool(r.probably_malicious) for r in routers]
+    correct, total = 0, 0
+    for i, router in enumerate(routers):
+        if malicious[i]:
+            continue
+        for j, rating in enumerate(trust[i]):
+            if rating is None or i == j:
+                continue
+            correct += (rating < 0.5) == malicious[j]
+            total   += 1
+
+    return {
+        "parameters":       parameters,
+        "seed":             seed,
+        "consensus_events": [getattr(r.tbucket, "consensus_events", 0) for r in routers],
+        "trust":            trust,
+        "malicious":        malicious,
+        "accuracy":         float(correct) / total if total else None,
+        "counters":         dict(utils.counters),
+    }
+
+def interval(samples):
+    """
+    Return the mean of samples and the half-width of its 95% confidence
+    interval.
+    """
+    samples = [s for s in samples if s is not None]
+    if not samples:
+        return None, None
+    n    = len(samples)
+    mean = sum(samples) / float(n)
+    if n < 2:
+        return mean, 0.0
+    variance = sum((s - mean) ** 2 for s in samples) / (n - 1)
+    t = T_95[n - 1] if n - 1 < len(T_95) else 1.960
+    return mean, t * math.sqrt(variance / n)
+
+def mean_trust(result, malicious):
+    """
+    Return the mean trust good routers have in good or malicious routers.
+    """
+    ratings = [rating for i, row in enumerate(result["trust"]) if not result["malicious"][i]
+               for j, rating in enumerate(row)
+               if i != j and rating is not None and result["malicious"][j] == malicious]
+    if not ratings:
+        return None
+    return sum(ratings) / float(len(ratings))
+
+def summarise(axes, results):
+    """
+    Return a row per combination of parameters with the mean and confidence
+    interval of each measurement across seeds.
+    """
+    def show(samples, precision):
+        mean, error = interval(samples)
+        if mean is None:
+            return "-"
+        return "%.*f +/- %.*f" % (precision, mean, precision, error)
+
+    rows = []
+    for parameters in grid(axes):
+        runs = [r for r in results if r["parameters"] == parameters]
+        row  = dict((name, parameters[name]) for name, values in axes)
+        row.update({
+            "Runs":             len(runs),
+            "Consensus Events": show([sum(r["consensus_events"]) for r in runs], 1),
+            "Accuracy":         show([r["accuracy"] for r in runs], 3),
+            "Good Trust":       show([mean_trust(r, False) for r in runs], 3),
+            "Malicious Trust":  show([mean_trust(r, True) for r in runs], 3),
+        })
+        # utils.table() sizes columns by their values.
+        rows.append(dict((k, str(v).ljust(len(k))) for k, v in row.items()))
+    return rows
+
+def sweep(options, axes, seeds=8, jobs=None):
+    """
+    Run options.scenario for every combination of parameters in axes with
+    seeds seeds each across jobs worker processes, returning every run's
+    result.
+    """
+    tasks = [(vars(options).copy(), parameters, seed)
+             for parameters in grid(axes) for seed in range(seeds)]
+    utils.log("Sweeping %s with %s runs across %s processes.", options.scenario,
+        "{:,}".format(len(tasks)), jobs or multiprocessing.cpu_count())
+    utils.flush()
+
+    # A fresh process per run keeps the class attributes runs set, such as
+    # Router.state, from leaking into other runs.
+    pool = multiprocessing.Pool(jobs, maxtasksperchild=1)
+    try:
+        return pool.map(run, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
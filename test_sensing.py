@@ -0,0 +1,78 @@
+"""
+Seeded runs should come out the same however sensing is split across
+processes.
+
+    python -m pytest -q test_sensing.py
+"""
+import optparse
+import unittest
+import multiprocessing
+import utils
+import scenarios
+
+def run(scenario, nodes=10, transactions=200, **options):
+    """
+    Run a scenario with seed 1 in a process of its own, as every run starts
+    from a fresh network and counters, and return the trust each router has
+    in its peers along with the counters.
+    """
+    values = dict(nodes=nodes, pre_trusted=2, transactions=transactions,
+                  verbose=False, no_prisoners=False, batch=False, state=False,
+                  sense_every=None, sense_jobs=0, duration=None, rate=None)
+    values.update(options)
+
+    def target(connection):
+        utils.set_log_level(utils.WARNING)
+        utils.set_seed(1)
+        routers = scenarios.map[scenario](optparse.Values(values))["routers"]
+        connection.send((
+            [[(p.id, p.port, float(p.trust), p.transactions) for p in r.peers]
+             for r in routers],
+            dict(utils.counters),
+        ))
+        connection.close()
+
+    context = multiprocessing.get_context("fork") \
+        if hasattr(multiprocessing, "get_context") else multiprocessing
+    receiver, sender = context.Pipe(False)
+    process = context.Process(target=target, args=(sender,))
+    process.start()
+    sender.close()
+    result = receiver.recv()
+    process.join()
+    return result
+
+class TestSenseJobs(unittest.TestCase):
+
+    def test_staggered_schedule(self):
+        # Routers that sense query routers that don't, which have to be read
+        # as they were before any of them sensed.
+        for scenario in ("three", "two"):
+            trust, counters = run(scenario, transactions=300, sense_jobs=1)
+            for jobs in (2, 3):
+                self.assertEqual(run(scenario, transactions=300, sense_jobs=jobs)[0], trust,
+                                 "%s with %i jobs" % (scenario, jobs))
+
+    def test_sensing_together(self):
+        trust, counters = run("three", transactions=100, sense_every=5, sense_jobs=1)
+        self.assertEqual(run("three", transactions=100, sense_every=5, sense_jobs=3)[0], trust)
+
+    def test_unchanged_peers_passed_over(self):
+        # Workers send back what calculate_trust() keeps from last time, so
+        # peers are passed over as often as without them.
+        for scenario in ("one", "four"):
+            trust, counters = run(scenario, sense_jobs=0)
+            self.assertTrue(counters.get("peers_unchanged"))
+            parallel = run(scenario, sense_jobs=2)
+            self.assertEqual(parallel[0], trust)
+            for name in ("peers_sensed", "peers_unchanged"):
+                self.assertEqual(parallel[1].get(name), counters.get(name),
+                                 "%s in %s" % (name, scenario))
+
+        trust, counters = run("C", transactions=100, sense_jobs=1)
+        parallel = run("C", transactions=100, sense_jobs=2)
+        for name in ("peers_sensed", "peers_unchanged"):
+            self.assertEqual(parallel[1].get(name), counters.get(name), name)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# _*_ coding: utf-8 _*_
+"""
+Binary traces of runs.
+
+Given --trace, every transaction made through Router.transact_with() or a
+RoundEngine, and every consensus event, graduation and eviction decided by
+PTPBucket.calculate_trust() or an engine, is appended to a file as a record of
+RECORD.itemsize bytes. Routers are identified by Router.serial.
+
+read() maps a trace into memory as a numpy record array, so traces larger than
+memory can be analysed without turning them into Python objects:
+
+    ./eigentrust.py -s two -n 50 -t 1000 --seed 1 --trace two.trace
+
+    >>> trace = traces.read("two.trace")
+    >>> trace[trace.kind == traces.KINDS["consensus"]].time
+
+A trace also holds the network as each run began, the routing tables that
+introductions leave, the peers routers forget and when each router senses,
+which is enough for replay() to put fresh routers and buckets through the
+same transactions without running the scenario again:
+
+    ./eigentrust.py --replay two.trace --bucket tbucket
+    ./eigentrust.py --replay two.trace --sweep alpha=250,500 --seeds 1
+"""
+import os
+import utils
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC   = b"TTTRACE\0"
+VERSION = 1
+
+# Magic, version and record size, ahead of the records.
+HEADER  = struct.Struct("<8sII")
+
+# The round, or the unit of time with --duration (-1 during setup), the kind
+# of record, how a transaction went (1 for positive, 0 for negative and -1 for
+# records other than transactions), the router doing the recording, the router
+# its peer represents (-1 if none), and the peer's trust rating and
+# transaction count after the fact.
+FORMAT  = struct.Struct("<iBbxxiidq")
+NAMES   = ("time", "kind", "outcome", "source", "target", "trust", "transactions")
+
+KINDS = {
+    "transaction":   0,
+    "consensus":     1,
+    "graduation_ep": 2,
+    "graduation_p":  3,
+    "eviction_ep":   4,
+    "eviction_p":    5,
+    # A run beginning, followed by its network. See Recorder.network().
+    "network":       6,
+    # A router, whose outcome is 1 if it's malicious, plus 2 if it takes no
+    # prisoners, plus 4 if it can't be located, and whose transaction count is
+    # its node's port.
+    "router":        7,
+    # A routing table being replaced by the peers that follow, in order.
+    "table":         8,
+    "peer":          9,
+    # Members of P and EP as a run begins.
+    "pretrusted":    10,
+    "extended":      11,
+    # A peer being forgotten, whose outcome is whether its router was too.
+    "dereference":   12,
+    "sense":         13,
+}
+
+# The buckets replay() can put routers through, for --bucket.
+BUCKETS = {
+    "ptpbucket": utils.PTPBucket,
+    "tbucket":   utils.TBucket,
+}
+
+if numpy is not None:
+    RECORD = numpy.dtype({
+        "names":    list(NAMES),
+        "formats":  ["<i4", "u1", "i1", "<i4", "<i4", "<f8", "<i8"],
+        "offsets":  [0, 4, 5, 8, 12, 16, 24],
+        "itemsize": FORMAT.size,
+    })
+
+def serial(router):
+    return getattr(router, "serial", -1)
+
+class Recorder(object):
+    """
+    Appends records to the trace at path, creating it if need be.
+
+    Records are kept in memory until the round changes or flush() is called,
+    then written out together. A trace cut short by a crash loses at most the
+    round in progress, and a partly written record at its end is dropped when
+    it's next opened.
+    """
+    def __init__(self, path):
+        self.path    = path
+        self.round   = -1
+        self.pending = []
+
+        # The serials of routers with a router record, and those routers by
+        # the identity of their nodes for peers that can't be located.
+        self.known   = set()
+        self.keys    = {}
+
+        if os.path.exists(path) and os.path.getsize(path):
+            count = check(path)
+            with open(path, "r+b") as fd:
+                fd.truncate(HEADER.size + count * FORMAT.size)
+        else:
+            with open(path, "wb") as fd:
+                fd.write(HEADER.pack(MAGIC, VERSION, FORMAT.size))
+        self.fd = open(path, "ab")
+
+    def record(self, kind, router, peer=None, outcome=None, partner=None):
+        """
+        Record something router did with or decided about peer, who's
+        partner's node in its routing table, located if not given.
+        """
+        if not router.serial in self.known:
+            self.router(router)
+        listed = True
+        if partner is None and peer is not None:
+            partner, listed = self.locate(router, peer)
+        if partner is not None and not partner.serial in self.known:
+            self.router(partner, listed)
+        self.pending.append(FORMAT.pack(self.round, KINDS[kind],
+            -1 if outcome is None else int(bool(outcome)), router.serial,
+            serial(partner), float(getattr(peer, "trust", 0)),
+            int(getattr(peer, "transactions", 0))))
+
+    def locate(self, router, peer):
+        """
+        Return the router peer represents and whether router can locate it
+        through its directory.
+        """
+        partner = router.locate(peer)
+        if partner is not None:
+            return partner, True
+        key = (peer.id, peer.port)
+        if key in self.keys:
+            return self.keys[key], False
+        # Routing tables' own copies of nodes refer to the router they're in.
+        partner = getattr(peer, "router", None)
+        if partner is not None and (partner.node.id, partner.node.port) == key:
+            return partner, False
+        return None, False
+
+    def router(self, router, listed=True):
+        """
+        Record a router that hasn't been recorded before, and whether it's in
+        the directory routers locate their peers through.
+        """
+        self.known.add(router.serial)
+        self.keys[(router.node.id, router.node.port)] = router
+        flags = int(bool(router.probably_malicious)) | 2 * int(bool(router.no_prisoners)) | \
+            4 * int(not listed)
+        self.pending.append(FORMAT.pack(self.round, KINDS["router"], flags,
+            router.serial, -1, float(router.node.trust), router.node.port))
+
+    def table(self, router):
+        """
+        Record router's routing table as it stands.
+        """
+        self.record("table", router)
+        for peer in router.peers:
+            self.record("peer", router, peer)
+
+    def network(self, routers):
+        """
+        Record that a run is beginning with every router reachable from
+        routers, their routing tables and their members of P and EP.
+        """
+        self.known = set()
+        self.keys  = {}
+        self.pending.append(FORMAT.pack(self.round, KINDS["network"], -1, -1, -1, 0.0, 0))
+        routers = utils.reachable(routers)
+        listed  = set(id(r) for router in routers for r in router.routers)
+        for router in routers:
+            self.router(router, id(router) in listed)
+        for router in routers:
+            self.table(router)
+            for peer in router.tbucket.values():
+                self.record("pretrusted", router, peer)
+            for peer in getattr(router.tbucket, "extent", {}).values():
+                self.record("extended", router, peer)
+
+    def record_many(self, kind, routers, partners, outcomes, trust, transactions):
+        """
+        Record many transactions at once from sequences of equal length.
+        """
+        for router in list(routers) + list(partners):
+            if not router.serial in self.known:
+                self.router(router)
+        records = numpy.zeros(len(routers), dtype=RECORD)
+        records["time"]         = self.round
+        records["kind"]         = KINDS[kind]
+        records["outcome"]      = outcomes
+        records["source"]       = [serial(r) for r in routers]
+        records["target"]       = [serial(r) for r in partners]
+        records["trust"]        = trust
+        records["transactions"] = transactions
+        self.pending.append(records.tobytes())
+
+    def take(self):
+        """
+        Return the records not yet written out, as bytes, and forget them.
+        """
+        records = b"".join(self.pending)
+        del self.pending[:]
+        return records
+
+    def extend(self, records):
+        """
+        Queue bytes from take() in another process to be written out.
+        """
+        self.pending.append(records)
+
+    def advance(self, n):
+        """
+        Write out what's been recorded so far and move on to round n.
+        """
+        self.flush()
+        self.round = n
+
+    def flush(self):
+        self.fd.write(self.take())
+        self.fd.flush()
+
+    def close(self):
+        self.flush()
+        self.fd.close()
+
+def check(path):
+    """
+    Return how many whole records the trace at path holds, or raise
+    ValueError if it isn't a trace this version can read.
+    """
+    with open(path, "rb") as fd:
+        header = fd.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise ValueError("%s isn't a trace." % path)
+    magic, version, size = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError("%s isn't a trace." % path)
+    if version != VERSION or size != FORMAT.size:
+        raise ValueError("%s is a version %i trace. Expected version %i." % \
+            (path, version, VERSION))
+    return (os.path.getsize(path) - HEADER.size) // FORMAT.size
+
+def read(path):
+    """
+    Return the records in the trace at path as a read-only numpy record array
+    mapped from the file.
+    """
+    if numpy is None:
+        raise ImportError("Reading traces requires numpy.")
+    count = check(path)
+    if not count:
+        return numpy.zeros(0, dtype=RECORD).view(numpy.recarray)
+    return numpy.memmap(path, dtype=RECORD, mode="r", offset=HEADER.size,
+                        shape=(count,)).view(numpy.recarray)
+
+def replay(path, bucket=None, no_prisoners=None, jobs=0):
+    """
+    Put fresh routers through the last run recorded in the trace at path,
+    with bucket as their bucket class if given, and return them in the order
+    they were created in.
+
+    The routers start out with the routing tables and members of P and EP the
+    run began with. Each transaction is then made with the outcome it had,
+    routing tables are merged as they were, introductions and forgotten peers
+    change routing tables as they did, and routers calculate trust when they
+    did. Nothing is drawn at random, so buckets and their parameters can be
+    compared on exactly the same traffic. What buckets decide is worked out
+    afresh, so records of consensus events, graduations and evictions are
+    passed over.
+    """
+    trace   = read(path)
+    # Recorders append, so a trace can hold several runs, each beginning
+    # with its network. Earlier runs needn't be read at all.
+    starts  = numpy.flatnonzero(trace["kind"] == KINDS["network"])
+    if len(starts):
+        trace = trace[starts[-1]:]
+    codes   = dict((code, kind) for kind, code in KINDS.items())
+    routers = {}
+    started = False
+    sensing = []
+    tables  = {}
+    now     = None
+    utils.log("Replaying %s records from %s.", "{:,}".format(len(trace)), path)
+
+    def sense():
+        if sensing:
+            utils.sense(sensing, jobs)
+            del sensing[:]
+
+    def lookup(router, partner):
+        return router.peers.lookup((partner.node.id, partner.node.port))
+
+    with utils.phase("replay"):
+        for start in range(0, len(trace), 65536):
+            rows = trace[start:start + 65536]
+            for time, code, outcome, source, target, trust, transactions in \
+                    zip(*[rows[name].tolist() for name in NAMES]):
+                kind = codes.get(code)
+                if kind == "network":
+                    # The run begins.
+                    routers, tables, started = {}, {}, True
+                    directory = utils.RouterDirectory()
+                    continue
+                if not started:
+                    continue
+                if kind != "sense":
+                    sense()
+                if kind != "peer":
+                    tables.clear()
+                if time != now and time >= 0:
+                    utils.counters.snapshot()
+                    now = time
+
+                if kind == "router":
+                    # Routers keep their ports, which their peers' buckets
+                    # are keyed by.
+                    router = utils.Router()
+                    if bucket is not None:
+                        router.tbucket = bucket(router)
+                    router.node.port          = transactions
+                    router.node.long_id       = transactions
+                    router.probably_malicious = bool(outcome & 1)
+                    router.no_prisoners       = no_prisoners or bool(outcome & 2)
+                    router.routers            = directory
+                    if not outcome & 4:
+                        directory.append(router)
+                    routers[source] = router
+                    continue
+
+                router  = routers.get(source)
+                partner = routers.get(target)
+                if router is None:
+                    continue
+
+                if kind == "sense":
+                    sensing.append(router)
+
+                elif kind == "table":
+                    # Nodes are kept across introductions, as P and EP hold them.
+                    tables[source] = dict((id(router.locate(p)), p) for p in router.peers)
+                    router.peers   = []
+
+                elif partner is None:
+                    continue
+
+                elif kind == "peer":
+                    node = tables.get(source, {}).pop(id(partner), None)
+                    if node is None:
+                        node              = partner.node.copy()
+                        node.trust        = trust
+                        node.transactions = transactions
+                    router.peers.append(node)
+
+                elif kind in ("pretrusted", "extended"):
+                    node = lookup(router, partner)
+                    if node is None:
+                        continue
+                    if kind == "pretrusted":
+                        router.tbucket[node.long_id] = node
+                    elif hasattr(router.tbucket, "extent"):
+                        router.tbucket.extent[node.long_id] = node
+
+                elif kind == "transaction":
+                    node = lookup(router, partner)
+                    if node is None:
+                        continue
+                    node.transact(positively=bool(outcome), router=router)
+                    router.gossip(partner)
+
+                elif kind == "dereference":
+                    node = lookup(router, partner)
+                    if node is not None:
+                        router.peers.remove(node)
+                    # Forgetting the router too takes it out of the directory.
+                    if outcome > 0 and directory.locate(partner.node) is partner:
+                        directory.remove(partner)
+        sense()
+
+    return utils.RouterDirectory(routers[s] for s in sorted(routers))
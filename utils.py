@@ -1,26 +1,52 @@
 # _*_ coding: utf-8 _*_
+import sys
 import math
 import time
+import atexit
 import uuid
 import pprint
 import random
+import json
 import hashlib
 import binascii
 import datetime
+import platform
+import functools
+import contextlib
+import collections
+import multiprocessing
 
 try:
     import numpy
 except ImportError:
     numpy = None
 
+# Python 3 folds unicode into str and long into int.
+if sys.version_info[0] > 2:
+    unicode = str
+    long    = int
+
+# Dicts iterate in the order keys were added on Python 3.7 and later and on
+# PyPy, but in order of hash on Python 2. Dicts whose order decides anything
+# are OrderedDicts, so that a seed gives the same run on any interpreter.
+if sys.version_info >= (3, 7) or platform.python_implementation() == "PyPy":
+    OrderedDict = dict
+else:
+    OrderedDict = collections.OrderedDict
+
 class Node(object):
     """
     Nodes are our local representation of remote routing tables.
     A Node represents what a Router sees of another Router in the network.
     """
+    # There's a Node for every entry in every routing table, so they go
+    # without a __dict__.
+    __slots__ = ("id", "ip", "port", "trust", "router", "epsilon", "long_id",
+                 "transactions", "seen")
+
     def __init__(self, node_id=None, ip="127.0.0.1", port=None, router=None):
         
-        if isinstance(node_id, long):
+        if isinstance(node_id, long) and node_id > sys.maxsize:
             try:    node_id = binascii.unhexlify('%x' % node_id)
             except: return Node(node_id, ip, port, router)
         self.id           = "Test Node"
@@ -30,13 +56,16 @@ class Node(object):
 #                                datetime.datetime.now().strftime("%f")
 #                            ).digest()
         self.ip           = ip
-        self.port         = port or random.randint(0, 99999)
+        self.port         = port if port is not None else random.randint(0, 99999)
         self.trust        = 0.50
         self.router       = router
         self.epsilon      = 0.0001
 #        self.long_id      = long(self.id.encode("hex"), 16)
         self.long_id      = self.port
         self.transactions = 0
+        # The version of the routing table we're in as of our last transaction,
+        # which KBucketTable evicts by.
+        self.seen         = 0
 
     @property
     def threeple(self):
@@ -47,6 +76,9 @@ class Node(object):
         node         = Node(*self.threeple)
         node.epsilon = self.epsilon
         node.router  = router or self.router
+        # Copies made for a routing table are kept in its network state.
+        if router is not None and router.state is not None:
+            return router.state.view(router, node)
         return node
 
     def transact(self, positively=True, router=None):
@@ -62,6 +94,12 @@ class Node(object):
         
         self.transactions += 1
 
+        # Let the routing table we belong to know that what it would
+        # render for its peers has changed.
+        if router:
+            router.touch()
+            self.seen = router.version
+
     def jsonify(self):
         response = {}
         response['node']         = [self.long_id, self.ip, self.port]
@@ -74,6 +112,11 @@ class Node(object):
             return False
         return self.id == other.id and self.port == other.port
 
+    def __hash__(self):
+        # Consistent with __eq__. Hashing on the port alone keeps the order
+        # of sets of nodes independent of string hash randomisation.
+        return hash(self.port)
+
     def __repr__(self):
         malicious = None
         if self.router:
@@ -85,20 +128,644 @@ class Node(object):
             self.trust,
             self.transactions)
 
+class EdgeNode(Node):
+    """
+    A view of an entry in a routing table kept in a NetworkState. Everything
+    about it is read from and written to the state's arrays, so views are
+    made as they're asked for and any two views of an edge are alike.
+    """
+    __slots__ = ("state", "edge", "target")
+
+    def __init__(self, state, edge, target=None):
+        self.state  = state
+        self.edge   = edge
+        self.target = state.target.item(edge) if target is None else target
+
+    @property
+    def id(self):
+        return self.state.keys[self.target][0]
+
+    @property
+    def port(self):
+        return self.state.keys[self.target][1]
+
+    @property
+    def ip(self):
+        return self.state.ips[self.target]
+
+    @property
+    def long_id(self):
+        return self.state.long_ids[self.target]
+
+    @property
+    def epsilon(self):
+        return self.state.epsilons[self.target]
+
+    @property
+    def router(self):
+        return self.state.referents[self.edge]
+
+    @property
+    def trust(self):
+        return self.state.trust.item(self.edge)
+
+    @trust.setter
+    def trust(self, value):
+        self.state.trust[self.edge] = value
+
+    @property
+    def transactions(self):
+        return self.state.transactions.item(self.edge)
+
+    @transactions.setter
+    def transactions(self, value):
+        self.state.transactions[self.edge] = value
+
+    @property
+    def seen(self):
+        return self.state.seen.item(self.edge)
+
+    @seen.setter
+    def seen(self, value):
+        self.state.seen[self.edge] = value
+
+class NetworkState(object):
+    """
+    Trust ratings and transaction counts for every entry in every routing
+    table in a network, kept in arrays indexed by edge, so that trust engines
+    can work on them directly.
+
+    Routers and the nodes they know of are given dense indices. The owner and
+    target of each edge are the indices of the router whose routing table it's
+    in and of the node it's about. Routers created while Router.state is set
+    register themselves, and their routing tables become EdgeTables, which
+    hold only edges:
+
+        utils.Router.state = utils.NetworkState()
+    """
+    def __init__(self, capacity=1024):
+        if numpy is None:
+            raise ImportError("NetworkState requires numpy.")
+        self.routers      = []
+        self.nodes        = {}
+        self.count        = 0
+
+        # The identity of each node by index, and nodes' indices by triple.
+        self.keys         = []
+        self.ips          = []
+        self.long_ids     = []
+        self.epsilons     = []
+        self.threeples    = {}
+
+        self.trust        = numpy.zeros(capacity)
+        self.transactions = numpy.zeros(capacity, dtype=numpy.int64)
+        self.seen         = numpy.zeros(capacity, dtype=numpy.int64)
+        self.owner        = numpy.zeros(capacity, dtype=numpy.int64)
+        self.target       = numpy.zeros(capacity, dtype=numpy.int64)
+        # The router each entry's Node.router refers to.
+        self.referents    = numpy.empty(capacity, dtype=object)
+
+        # Edges in each router's routing table by router index, along with
+        # the table and version they were collected from.
+        self.tables       = {}
+
+    def index(self, node):
+        """
+        Return the dense index of a node, assigning one if it's new to us.
+        """
+        key = (node.id, node.port)
+        if not key in self.nodes:
+            self.nodes[key] = len(self.keys)
+            self.keys.append(key)
+            self.ips.append(node.ip)
+            self.long_ids.append(node.long_id)
+            self.epsilons.append(node.epsilon)
+            self.threeples.setdefault(tuple(node.threeple), self.nodes[key])
+        return self.nodes[key]
+
+    def register(self, router):
+        self.routers.append(router)
+        return self.index(router.node)
+
+    def edge(self, router, node):
+        if self.count == len(self.trust):
+            for name in ("trust", "transactions", "seen", "owner", "target", "referents"):
+                array = getattr(self, name)
+                setattr(self, name, numpy.concatenate((array, numpy.zeros_like(array))))
+        edge = self.count
+        self.count += 1
+        self.trust[edge]        = node.trust
+        self.transactions[edge] = node.transactions
+        self.seen[edge]         = node.seen
+        self.owner[edge]        = router.index
+        self.target[edge]       = self.index(node)
+        self.referents[edge]    = node.router
+        return edge
+
+    def adopt(self, router, node):
+        """
+        Return the edge for node as an entry in router's routing table.
+        """
+        if isinstance(node, EdgeNode) and node.state is self and \
+                self.owner[node.edge] == router.index:
+            return node.edge
+        return self.edge(router, node)
+
+    def node(self, edge):
+        """
+        Return a view of edge.
+        """
+        return EdgeNode(self, edge)
+
+    def view(self, router, node):
+        """
+        Return node as an entry in router's routing table.
+        """
+        return self.node(self.adopt(router, node))
+
+    def edges(self, routers=None):
+        """
+        Return the indices of the edges in the routing tables of routers, or
+        of every router.
+        """
+        if routers is None:
+            routers = self.routers
+        edges = []
+        for router in routers:
+            peers  = router.peers
+            cached = self.tables.get(router.index)
+            if cached is None or cached[0] is not peers or cached[1] != peers.version:
+                if isinstance(peers, EdgeTable) and peers.state is self:
+                    table = numpy.array(peers.edges(), dtype=numpy.int64)
+                else:
+                    table = numpy.array([p.edge for p in peers if isinstance(p, EdgeNode)
+                                         and p.state is self], dtype=numpy.int64)
+                cached = self.tables[router.index] = (peers, peers.version, table)
+            edges.append(cached[2])
+        if not edges:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.concatenate(edges)
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return "<NetworkState of %i routers and %i edges>" % \
+            (len(self.routers), self.count)
+
+class IndexedList(list):
+    """
+    A list that also keeps a hashed index of its members so membership tests
+    and lookups don't require a scan. Members are keyed by node identity
+    (id, port) unless a subclass overrides key().
+
+    Mutate it as you would any other list and the index follows along. Where
+    two members share a key the index refers to the first in list order.
+
+    version is bumped on every change to membership, and rewrites whenever
+    members are removed or reordered, so while it stands the list has only
+    been appended to.
+    """
+    def __init__(self, items=[]):
+        self.version  = 0
+        self.rewrites = 0
+        list.__init__(self, items)
+        self.reindex()
+
+    def key(self, item):
+        return (item.id, item.port)
+
+    def index_item(self, item):
+        self.version += 1
+        self.by_key.setdefault(self.key(item), item)
+
+    def unindex_item(self, item):
+        self.version  += 1
+        self.rewrites += 1
+        key = self.key(item)
+        if self.by_key.get(key) is not item:
+            return
+        # Fall back to the next member in list order sharing the key.
+        del self.by_key[key]
+        for other in self:
+            if self.key(other) == key:
+                self.by_key[key] = other
+                return
+
+    def reindex(self):
+        self.version  += 1
+        self.rewrites += 1
+        self.by_key = {}
+        for item in self:
+            self.index_item(item)
+
+    def lookup(self, key):
+        return self.by_key.get(key)
+
+    def append(self, item):
+        list.append(self, item)
+        self.index_item(item)
+
+    def extend(self, items):
+        items = list(items)
+        list.extend(self, items)
+        for item in items:
+            self.index_item(item)
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def remove(self, item):
+        self.pop(self.index(item))
+
+    def pop(self, *args):
+        item = list.pop(self, *args)
+        self.unindex_item(item)
+        return item
+
+    # Operations that can reorder or replace members are rare enough
+    # to simply rebuild the index.
+    def insert(self, i, item):
+        list.insert(self, i, item)
+        self.reindex()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self.reindex()
+
+    def reverse(self):
+        list.reverse(self)
+        self.reindex()
+
+    def __setitem__(self, i, value):
+        list.__setitem__(self, i, value)
+        self.reindex()
+
+    def __delitem__(self, i):
+        list.__delitem__(self, i)
+        self.reindex()
+
+    # Python 2 slices through these instead of __setitem__ and __delitem__.
+    def __setslice__(self, i, j, value):
+        list.__setslice__(self, i, j, value)
+        self.reindex()
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self.reindex()
+
+class RouterDirectory(IndexedList):
+    """
+    A list of routers indexed by the identity (id, port) of the nodes they're
+    represented by, so that locating the routing table responsible for a peer
+    doesn't mean scanning the network.
+    """
+    def key(self, router):
+        return (router.node.id, router.node.port)
+
+    def locate(self, node):
+        """
+        Return the router responsible for node, or None.
+        """
+        if not hasattr(node, "id") or not hasattr(node, "port"):
+            return None
+        return self.lookup((node.id, node.port))
+
+class PeerTable(IndexedList):
+    """
+    The ordered list of peers in a routing table, indexed both by node
+    identity (id, port) for membership tests and by node triple for
+    Router.get().
+    """
+    def index_item(self, node):
+        IndexedList.index_item(self, node)
+        self.by_threeple.setdefault(tuple(node.threeple), node)
+
+    def unindex_item(self, node):
+        IndexedList.unindex_item(self, node)
+        threeple = tuple(node.threeple)
+        if self.by_threeple.get(threeple) is not node:
+            return
+        del self.by_threeple[threeple]
+        for other in self:
+            if tuple(other.threeple) == threeple:
+                self.by_threeple[threeple] = other
+                return
+
+    def reindex(self):
+        self.by_threeple = {}
+        IndexedList.reindex(self)
+
+    def get(self, nodeple):
+        return self.by_threeple.get(tuple(nodeple))
+
+    def admit(self, node):
+        """
+        Make room for node if need be and return whether it can be added.
+        """
+        return True
+
+    def __contains__(self, node):
+        if not hasattr(node, "id") or not hasattr(node, "port"):
+            return False
+        return (node.id, node.port) in self.by_key
+
+class EdgeTable(PeerTable):
+    """
+    A PeerTable kept in a NetworkState. It holds the edges of its entries and
+    indexes them by node identity, and hands out EdgeNode views of them as
+    they're asked for, so that routing tables cost little more than the
+    state's arrays however large the network grows.
+    """
+    def __init__(self, state, owner, nodes=[]):
+        self.state = state
+        self.owner = owner
+        PeerTable.__init__(self, [state.adopt(owner, node) for node in nodes])
+
+    def edges(self):
+        return list.__getitem__(self, slice(None))
+
+    def key(self, edge):
+        return self.state.keys[self.state.target.item(edge)]
+
+    # Entries are found by node triple through the state's index of nodes,
+    # so there's no index by triple of our own.
+    def index_item(self, edge):
+        IndexedList.index_item(self, edge)
+
+    def unindex_item(self, edge):
+        self.version  += 1
+        self.rewrites += 1
+        key = self.key(edge)
+        if self.by_key.get(key) != edge:
+            return
+        del self.by_key[key]
+        for other in list.__iter__(self):
+            if self.key(other) == key:
+                self.by_key[key] = other
+                return
+
+    def reindex(self):
+        self.version  += 1
+        self.rewrites += 1
+        self.by_key = {}
+        for edge in list.__iter__(self):
+            self.index_item(edge)
+
+    def lookup(self, key):
+        edge = self.by_key.get(key)
+        return None if edge is None else self.state.node(edge)
+
+    def get(self, nodeple):
+        target = self.state.threeples.get(tuple(nodeple))
+        if target is None:
+            return None
+        return self.lookup(self.state.keys[target])
+
+    def views(self, edges):
+        state = self.state
+        return [EdgeNode(state, edge, target) for edge, target in
+                zip(edges, state.target[edges].tolist())]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.views(list.__getitem__(self, i))
+        return self.state.node(list.__getitem__(self, i))
+
+    # Python 2 slices through this instead of __getitem__.
+    def __getslice__(self, i, j):
+        return self.__getitem__(slice(i, j))
+
+    # Like a list's, iteration carries on into members appended meanwhile.
+    def __iter__(self):
+        node = self.state.node
+        for edge in list.__iter__(self):
+            yield node(edge)
+
+    def __reversed__(self):
+        node = self.state.node
+        for edge in list.__reversed__(self):
+            yield node(edge)
+
+    def index(self, node, *args):
+        edge = self.by_key.get((node.id, node.port)) if hasattr(node, "id") else None
+        if edge is None:
+            raise ValueError("%r is not in the routing table" % (node,))
+        return list.index(self, edge, *args)
+
+    def pop(self, *args):
+        edge = list.pop(self, *args)
+        self.unindex_item(edge)
+        return self.state.node(edge)
+
+    def append(self, node):
+        edge = self.state.adopt(self.owner, node)
+        list.append(self, edge)
+        self.index_item(edge)
+
+    def extend(self, nodes):
+        for node in list(nodes):
+            self.append(node)
+
+    def insert(self, i, node):
+        list.insert(self, i, self.state.adopt(self.owner, node))
+        self.reindex()
+
+    def sort(self, key=None, reverse=False):
+        views = sorted(self, key=key, reverse=reverse)
+        list.__setitem__(self, slice(None), [view.edge for view in views])
+        self.reindex()
+
+    def __setitem__(self, i, value):
+        if isinstance(i, slice):
+            value = [self.state.adopt(self.owner, node) for node in value]
+        else:
+            value = self.state.adopt(self.owner, value)
+        list.__setitem__(self, i, value)
+        self.reindex()
+
+    def __setslice__(self, i, j, value):
+        self.__setitem__(slice(i, j), value)
+
+    def __repr__(self):
+        return repr(list(self))
+
+class KBucketTable(PeerTable):
+    """
+    A routing table that holds at most k peers at each distance from its
+    owner, as in Kademlia, so that it stays the same size however large the
+    network grows. A peer's distance is the XOR of its long_id with ours, and
+    it goes in the bucket for the highest bit set in that distance.
+
+    A peer arriving at a full bucket takes the place of a member we've rated
+    at 0 or, failing that, of the member we've gone longest without
+    transacting with if that's more than stale changes to our table ago.
+    Otherwise it's turned away, as long-lived peers are the likeliest to stay.
+    Members of P and EP are never evicted.
+
+    Routers use these tables when Router.k is set:
+
+        utils.Router.k = 20
+    """
+    stale = 1000
+
+    def __init__(self, owner, items=[]):
+        self.owner = owner
+        PeerTable.__init__(self)
+        self.extend(items)
+
+    def bucket(self, node):
+        return (self.owner.node.long_id ^ node.long_id).bit_length()
+
+    def index_item(self, node):
+        PeerTable.index_item(self, node)
+        self.buckets.setdefault(self.bucket(node), []).append(node)
+
+    def unindex_item(self, node):
+        PeerTable.unindex_item(self, node)
+        members = self.buckets.get(self.bucket(node), [])
+        for i, member in enumerate(members):
+            if member is node:
+                del members[i]
+                break
+
+    def reindex(self):
+        self.buckets = {}
+        PeerTable.reindex(self)
+
+    def pinned(self, node):
+        """
+        Whether node is a member of P or EP, which aren't evicted.
+        """
+        bucket = getattr(self.owner, "tbucket", None)
+        if bucket is None:
+            return False
+        return node.long_id in bucket or node.long_id in getattr(bucket, "extent", {})
+
+    def admit(self, node):
+        members = self.buckets.get(self.bucket(node), [])
+        if len(members) < self.owner.k:
+            return True
+        candidates = [m for m in members if not self.pinned(m)]
+        victim     = None
+        for member in candidates:
+            if member.trust <= 0:
+                victim = member
+                break
+        if victim is None and candidates:
+            member = min(candidates, key=lambda m: m.seen)
+            if self.owner.version - member.seen > self.stale:
+                victim = member
+        if victim is None:
+            count("kbucket_rejections")
+            return False
+        count("kbucket_evictions")
+        self.remove(victim)
+        return True
+
+    def entry(self, node):
+        """
+        Return node as a member of this table, kept in the owner's network
+        state if it has one. Only those admitted get an edge there.
+        """
+        state = self.owner.state
+        return node if state is None else state.view(self.owner, node)
+
+    def append(self, node):
+        if self.admit(node):
+            PeerTable.append(self, self.entry(node))
+
+    def extend(self, nodes):
+        for node in list(nodes):
+            self.append(node)
+
+    def insert(self, i, node):
+        if self.admit(node):
+            PeerTable.insert(self, i, self.entry(node))
+
 class Router(object):
     """
     A Router is responsible for maintaining awareness of other routing tables
     and what their attributes are as network nodes.
     """
+    # A NetworkState to keep routing tables in. See NetworkState.
+    state = None
+
+    # Peers per k-bucket, if routing tables are to be KBucketTables.
+    k = None
+
+    # The class of bucket routers calculate trust with, PTPBucket if None.
+    bucket = None
+
+    # The bytes gossip() counts for an entry in a routing table, a node triple
+    # with a 160-bit ID and an IPv4 address, and for a digest of one.
+    entry_size  = 26
+    digest_size = 16
+
+    # How many routers have been created, which names their random streams.
+    created = 0
+
     def __init__(self):
-        self.id                 = hashlib.sha1(hex(id(self))).hexdigest()
-        self.node               = Node(router=self)
+        serial                  = Router.created
+        Router.created         += 1
+
+        # Which router this is in order of creation.
+        self.serial             = serial
+
+        # Our own stream of random numbers. See stream().
+        self.random             = stream("router", serial)
+        if seed is None:
+            self.id             = hashlib.sha1(hex(id(self)).encode("utf-8")).hexdigest()
+        else:
+            self.id             = hashlib.sha1(repr((seed, "router", serial)).encode("utf-8")).hexdigest()
+        self.node               = Node(router=self, port=self.random.randint(0, 99999))
+        self.index              = None
+        if self.state is not None:
+            self.index          = self.state.register(self)
         self.network            = "Test Network"
         self.no_prisoners       = None
+        self.version            = 0
         self.peers              = []
         self.routers            = []
-        self.tbucket            = PTPBucket(self)
+        self.tbucket            = (self.bucket or PTPBucket)(self)
         self.probably_malicious = False
+        self.rendered           = None
+
+        # What snapshot() returns while a sensing phase holds the network
+        # still. See sense().
+        self.frozen             = None
+
+        # Our routing table and theirs, their rewrites and their lengths as of
+        # when we last merged with a router, by router ID. See gossip().
+        self.gossiped           = {}
+
+    @property
+    def peers(self):
+        return self._peers
+
+    @peers.setter
+    def peers(self, nodes):
+        # Assigning a plain list, as introduce() does, re-indexes it.
+        if self.k:
+            if not isinstance(nodes, KBucketTable) or nodes.owner is not self:
+                nodes = KBucketTable(self, nodes)
+        elif self.state is not None:
+            nodes = EdgeTable(self.state, self, nodes)
+        elif not isinstance(nodes, PeerTable):
+            nodes = PeerTable(nodes)
+        self._peers = nodes
+        self.touch()
+
+    def touch(self):
+        """
+        Mark the trust ratings or transaction counts in our routing table as
+        changed so that the next snapshot() re-renders it.
+
+        Node.transact() does this for the router it's given. Call it yourself
+        after writing to a peers' attributes directly.
+        """
+        self.version += 1
 
     @property
     def malicious(self):
@@ -111,11 +778,20 @@ class Router(object):
         """
         return self.probably_malicious
 
+    def locate(self, peer):
+        """
+        Locate the routing table responsible for the peer we're dealing with.
+        """
+        if isinstance(self.routers, RouterDirectory):
+            count("directory_lookups")
+            return self.routers.locate(peer)
+        count("directory_scans")
+        for router in self.routers:
+            if router.node == peer:
+                return router
+
     def get(self, nodeple):
-        nodeple = list(nodeple)
-        for p in self.peers:
-            if p.threeple == nodeple:
-                return p
+        return self.peers.get(nodeple)
 
     def render_peers(self):
         """
@@ -124,6 +800,23 @@ class Router(object):
         """
         return [peer.jsonify() for peer in self.peers]
 
+    def snapshot(self):
+        """
+        Return what render_peers() gives along with an index of its entries by
+        node triple. The rendering is cached until our routing table changes.
+        """
+        if self.frozen is not None:
+            return self.frozen
+        stamp = (self.version, self.peers.version)
+        if self.rendered is None or self.rendered[0] != stamp:
+            count("render_peers")
+            rendered = self.render_peers()
+            index    = {}
+            for response in rendered:
+                index.setdefault(tuple(response['node']), response)
+            self.rendered = (stamp, rendered, index)
+        return self.rendered[1:]
+
     def transact_with(self, peer, transaction_type=None):
         """
         Update local trust rating and transaction count of peer
@@ -135,9 +828,8 @@ class Router(object):
             return None
 
         # Locate the routing table responsible for the peer we're dealing with
-        router = filter(lambda x: x.node == peer, self.routers)
-        if not any(router): return
-        router = router[0]
+        router = self.locate(peer)
+        if not router: return
         
         # Routers can be subclassed to turn their .malicious attr into a property
         # with statistical variance. E.g. to return True every 100th transaction.
@@ -145,27 +837,102 @@ class Router(object):
             transaction_type = not router.malicious
  
         peer.transact(positively=transaction_type, router=self)
+        record("transaction", self, peer, transaction_type, router)
         
         #log("[%s] %s <-- %s" % \
         #    ("+" if not maliciousness else "-", self.node, peer))
 
-        # Reinforce the network by making ourselves aware of this peers' peers
-        for node in router.peers:
-            if node == self.node or node in self.peers:
-                continue
-            self.peers.append(node.copy(router=self))
-
-        # and make the peer routing table aware of our peers.
-        for node in self.peers:
-            if node == router.node or node in router.peers:
-                continue
-            router.peers.append(node.copy(router=router))
+        self.gossip(router)
 
         # NoneType indicates an unreachable peer, True indicates a positive
         # transaction and False means the remote peer can be said to have
         # provided a malicious resource.
         return transaction_type
 
+    def gossip(self, router):
+        """
+        Merge routing tables with another router.
+
+        Routers first swap digests saying how far each table had got when they
+        last merged and whether it's only been appended to since. If both
+        have, only the entries added since are sent, so a merge costs what's
+        new rather than what's known. Otherwise the tables are compared in
+        full, as they are after a merge that evicted or turned away a peer.
+        The bytes this sends are counted as gossip_bytes, and those a digest
+        saves over swapping whole tables as gossip_bytes_saved.
+        """
+        ours, theirs = self.peers, router.peers
+        whole  = (len(ours) + len(theirs)) * self.entry_size
+        since  = None
+        merged = self.gossiped.get(router.id)
+        if merged is not None and merged[0] is ours and merged[1] == ours.rewrites and \
+                merged[3] is theirs and merged[4] == theirs.rewrites:
+            since = (merged[5], merged[2])
+            sent  = 2 * self.digest_size + \
+                    (len(theirs) - since[0] + len(ours) - since[1]) * self.entry_size
+            count("gossip_bytes_saved", whole - sent)
+        else:
+            sent = 2 * self.digest_size + whole
+        count("gossip_bytes", sent)
+
+        # Neither table has changed since we last merged them.
+        if since is not None and since == (len(theirs), len(ours)):
+            return
+
+        # Reinforce the network by making ourselves aware of this peers' peers
+        # and make the peer routing table aware of our peers. Comparing keys
+        # is what Node.__eq__ and PeerTable.__contains__ do, without the calls.
+        rewrites = (ours.rewrites, theirs.rewrites)
+        complete = True
+        for (source, target), start in zip(((router, self), (self, router)), since or (0, 0)):
+            table = target.peers
+            if since is None:
+                nodes   = source.peers
+                missing = set(nodes.by_key)
+            else:
+                # Each table held every entry of the other when we last
+                # merged, so anything missing was added since.
+                nodes   = source.peers[start:]
+                missing = set((node.id, node.port) for node in nodes)
+            missing.difference_update(table.by_key)
+            missing.discard((target.node.id, target.node.port))
+            if not missing:
+                continue
+            for node in list(nodes):
+                key = (node.id, node.port)
+                if not key in missing:
+                    continue
+                missing.remove(key)
+                if not table.admit(node):
+                    complete = False
+                    continue
+                copy      = node.copy(router=target)
+                copy.seen = target.version
+                table.append(copy)
+                count("gossip_copies")
+
+        ours, theirs = self.peers, router.peers
+        if not complete or rewrites != (ours.rewrites, theirs.rewrites):
+            # A KBucketTable turned a peer away or evicted one to make room,
+            # so neither table need hold all of the other.
+            self.gossiped.pop(router.id, None)
+            router.gossiped.pop(self.id, None)
+            return
+        self.gossiped[router.id] = (ours, ours.rewrites, len(ours),
+                                    theirs, theirs.rewrites, len(theirs))
+        router.gossiped[self.id] = (theirs, theirs.rewrites, len(theirs),
+                                    ours, ours.rewrites, len(ours))
+
+    def malicious_batch(self, count):
+        """
+        Return whether each of our next count transactions is malicious, for
+        engines that run transactions in bulk.
+
+        Override this alongside malicious if your malicious property has side
+        effects, so the two agree.
+        """
+        return [self.malicious for _ in range(count)]
+
     def dereference(self, peer, and_router=False):
         """
         Force a router to forget a peer and optionally the router it represents.
@@ -174,18 +941,22 @@ class Router(object):
             return
 
         self.peers.remove(peer)
+        record("dereference", self, peer, and_router == True)
         if and_router != True:
             return
 
-        router = filter(lambda x: x.node == peer, self.routers)
-        if not any(router): return
-        self.routers.remove(router[0])
+        router = self.locate(peer)
+        if not router: return
+        self.routers.remove(router)
 
     def __eq__(self, other):
         if not hasattr(other, "id"):
             return False
         return self.id == other.id
 
+    # Python 3 drops the default hash of classes that define __eq__.
+    __hash__ = object.__hash__
+
     def __len__(self):
         return len(self.peers)
 
@@ -197,6 +968,239 @@ class Router(object):
             ("-" if self.probably_malicious else "+",
              self.__class__.__name__, self.id, len(self.peers))
 
+def memoize(depends_on_trust=False):
+    """
+    Cache a TBucket method's results for the rest of the current sensing epoch.
+    Results that depend on trust ratings are also dropped whenever a rating is
+    written back.
+    """
+    def decorator(method):
+        name = method.__name__
+
+        @functools.wraps(method)
+        def wrapper(self, *args):
+            if not self.memoize:
+                return method(self, *args)
+            cache = self.trust_cache if depends_on_trust else self.cache
+            key   = (name,) + tuple(cache_key(_) for _ in args)
+            if key in cache:
+                self.hits[name] = self.hits.get(name, 0) + 1
+                return cache[key]
+            self.misses[name] = self.misses.get(name, 0) + 1
+            cache[key] = method(self, *args)
+            return cache[key]
+        return wrapper
+    return decorator
+
+def cache_key(value):
+    if isinstance(value, Node):
+        return (value.id, value.port)
+    if isinstance(value, list):
+        return tuple(cache_key(_) for _ in value)
+    return value
+
+class PhaseTimer(object):
+    """
+    Wall-clock and CPU time spent in each phase of a run, such as generating
+    routers or the transaction rounds, optionally with a cProfile profile of
+    each phase.
+
+    Phases can nest. Time is charged to the innermost phase running, so that
+    what's spent sensing isn't also counted against the round around it,
+    while each phase's total includes the phases nested in it.
+    """
+    def __init__(self, profile=False):
+        self.profile  = profile
+        self.order    = []
+        self.phases   = {}
+        self.profiles = {}
+
+        # [name, wall clock and CPU time when last resumed, when entered]
+        self.stack    = []
+
+    @staticmethod
+    def clocks():
+        cpu = getattr(time, "process_time", None) or time.clock
+        return time.time(), cpu()
+
+    def charge(self, frame, wall, cpu):
+        phase     = self.phases[frame[0]]
+        phase[1] += wall - frame[1]
+        phase[2] += cpu  - frame[2]
+        if self.profile:
+            self.profiles[frame[0]].disable()
+
+    def resume(self, frame, wall, cpu):
+        frame[1], frame[2] = wall, cpu
+        if self.profile:
+            self.profiles[frame[0]].enable()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not name in self.phases:
+            self.order.append(name)
+            # Calls, wall clock and CPU time, and total wall clock time.
+            self.phases[name] = [0, 0.0, 0.0, 0.0]
+            if self.profile:
+                import cProfile
+                self.profiles[name] = cProfile.Profile()
+
+        wall, cpu = self.clocks()
+        if self.stack:
+            self.charge(self.stack[-1], wall, cpu)
+        frame = [name, wall, cpu, wall]
+        self.stack.append(frame)
+        self.resume(frame, wall, cpu)
+        try:
+            yield
+        finally:
+            wall, cpu = self.clocks()
+            self.charge(frame, wall, cpu)
+            self.phases[name][0] += 1
+            self.phases[name][3] += wall - frame[3]
+            self.stack.pop()
+            if self.stack:
+                self.resume(self.stack[-1], wall, cpu)
+
+    # The order report()'s columns go in.
+    columns = ("Phase", "Wall", "CPU", "Share", "Total", "Calls")
+
+    def report(self):
+        """
+        A row per phase for utils.table(), with columns in the order given by
+        columns.
+        """
+        overall = sum(phase[1] for phase in self.phases.values()) or 1.0
+        rows    = []
+        for name in self.order:
+            calls, wall, cpu, total = self.phases[name]
+            rows.append(dict((k, str(v).ljust(len(k))) for k, v in {
+                "Phase": name,
+                "Calls": calls,
+                "Wall":  "%.3fs" % wall,
+                "CPU":   "%.3fs" % cpu,
+                "Share": "%.1f%%" % (100 * wall / overall),
+                "Total": "%.3fs" % total,
+            }.items()))
+        return rows
+
+    def dump(self, directory):
+        """
+        Write each phase's profile to directory/<phase>.pstats.
+        """
+        paths = []
+        for name in self.order:
+            if name in self.profiles:
+                path = "%s/%s.pstats" % (directory.rstrip("/"), name)
+                self.profiles[name].dump_stats(path)
+                paths.append(path)
+        return paths
+
+# The PhaseTimer for this run, if it's being profiled. See phase().
+timer = None
+
+class NullPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+null_phase = NullPhase()
+
+def phase(name):
+    """
+    Return a context manager that charges what it runs to the phase called
+    name when the run is being timed:
+
+        with utils.phase("transactions"):
+            ...
+    """
+    if timer is None:
+        return null_phase
+    return timer.phase(name)
+
+def timed(name):
+    """
+    Charge every call of the decorated function to the phase called name.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if timer is None:
+                return function(*args, **kwargs)
+            with timer.phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class Counters(dict):
+    """
+    How many times each kind of work has been done, by name, such as
+    "bucket_queries" or "altruism", for checking how the algorithms scale.
+
+    Scenarios take a snapshot() as each round begins. rounds() turns them into
+    the work done in each round.
+    """
+    def __init__(self):
+        dict.__init__(self)
+        self.snapshots = []
+
+    def snapshot(self):
+        self.snapshots.append(dict(self))
+
+    def merge(self, counts):
+        for name, n in counts.items():
+            self[name] = self.get(name, 0) + n
+
+    @staticmethod
+    def difference(after, before):
+        return dict((name, n - before.get(name, 0)) for name, n in after.items()
+                    if n != before.get(name, 0))
+
+    def since(self, before):
+        """
+        What's been counted since before, a snapshot or a copy of us.
+        """
+        return self.difference(self, before)
+
+    def rounds(self):
+        """
+        The counts for each round, the last running up to now.
+        """
+        marks = self.snapshots[1:] + [dict(self)]
+        return [self.difference(after, before)
+                for before, after in zip(self.snapshots, marks)]
+
+    def dump(self, path):
+        """
+        Write the totals, what was counted before the first round and the
+        counts for each round to path as JSON.
+        """
+        with open(path, "w") as fd:
+            json.dump({
+                "totals": self,
+                "setup":  self.snapshots[0] if self.snapshots else dict(self),
+                "rounds": self.rounds(),
+            }, fd, indent=2, sort_keys=True)
+
+# Counts of the work done on the hot paths this run. See count().
+counters = Counters()
+
+def count(name, n=1):
+    counters[name] = counters.get(name, 0) + n
+
+# The traces.Recorder for this run, if it's being traced. See record().
+recorder = None
+
+def record(kind, router, peer=None, outcome=None, partner=None):
+    """
+    Have the recorder note that router transacted with peer, or what it
+    decided about peer, if the run is being traced. See traces.py.
+    """
+    if recorder is not None:
+        recorder.record(kind, router, peer, outcome, partner)
+
 class TBucket(dict):
     """
     A set of pre-trusted peers. The aim is to totally starve
@@ -230,13 +1234,28 @@ class TBucket(dict):
          w(i,j) = (i - b) * C(j,i) + b * sim(j,i)
               b = 0.85
 
+    The same (i, j) pairs are visited many times over during a call to
+    calculate_trust(), so results are memoized until the next call.
     """
+    # An object with a calculate_trust(bucket) method to use in place of the
+    # pure Python implementation below. See engines.py.
+    engine = None
+
     def __init__(self, router, *args, **kwargs):
         self.beta       = 0.85  # proportion factor 
         self.gamma      = 0.0
         self.iterations = 100
         self.router     = router
         self.messages   = []
+
+        # Per-epoch memoization of the functions below, with hit and miss
+        # counts by function name since this bucket was created.
+        self.memoize     = True
+        self.cache       = {}
+        self.trust_cache = {}
+        self.hits        = {}
+        self.misses      = {}
+
         dict.__init__(self, *args, **kwargs)
     
     def append(self, nodes):
@@ -249,6 +1268,7 @@ class TBucket(dict):
                 continue
             node.trust += 1.0 / c
             self[node.long_id] = node
+        self.router.touch()
 
     def get(self, node, endpoint=""):
         """
@@ -256,30 +1276,38 @@ class TBucket(dict):
         """
         if not node:
             return
-        for router in self.router.routers:
-            if router.node == node:
-                return router.render_peers()
+        router = self.router.locate(node)
+        if router is not None:
+            return router.snapshot()[0]
 
+    @memoize(depends_on_trust=True)
     def S(self, i, j):
         if not j.transactions:
             return 0
         r = max(j.trust / j.transactions, 0)
-        log("S:   %s %s %i" % (i, j, r))
+        log("S:   %s %s %i", i, j, r, level=DEBUG)
         return r
 
+    @memoize(depends_on_trust=True)
     def C(self, i, j):
+        score = self.C_sum(i)
+        if not score:
+            return 0
+        s = self.S(i,j) / score
+        log("C:   %s %s %i", i, j, s, level=DEBUG)
+        return s
+
+    @memoize(depends_on_trust=True)
+    def C_sum(self, i):
         score = 0
         for _, m in enumerate(self):
             if _ >= self.iterations: break
             if m in self:
                 score +=  1.0 / len(self)
             score += self.S(i, m)
-        if not score:
-            return 0
-        s = self.S(i,j) / score
-        log("C:   %s %s %i" % (i, j, s))
-        return s
+        return score
 
+    @memoize(depends_on_trust=True)
     def sim(self, u, v):
         score = 0
         common_peers = self.common_peers(u, v)
@@ -288,9 +1316,10 @@ class TBucket(dict):
             return 0
         s = s / len(common_peers)
         sim = 1 - math.sqrt(s)
-        log("sim: %s %s %i" % (u, v, sim))
+        log("sim: %s %s %i", u, v, sim, level=DEBUG)
         return sim
 
+    @memoize(depends_on_trust=True)
     def tr(self, u, w):
         if not isinstance(u, Node):
             u = self.router.get(u)
@@ -301,9 +1330,10 @@ class TBucket(dict):
             tr = 0
         else:
             tr = u.trust + w.trust / s
-        log("tr:  %s %s %i" % (u, w, tr))
+        log("tr:  %s %s %i", u, w, tr, level=DEBUG)
         return tr
 
+    @memoize()
     def R0(self, u, v):
         results = []
         
@@ -321,13 +1351,14 @@ class TBucket(dict):
                 return vr[0]['transactions']
 
         if ur and vr:
-            R0 = (ur[0]['transactions'] + vr[0]['transactions']) / 2
+            R0 = (ur[0]['transactions'] + vr[0]['transactions']) // 2
         else:
             R0 = 0
     
-        log("R0:  %s %s %i" % (u, v, R0))
+        log("R0:  %s %s %i", u, v, R0, level=DEBUG)
         return R0
 
+    @memoize()
     def R1(self, i):
         """
         The set of our peers who've had transactions with peer i.
@@ -338,9 +1369,10 @@ class TBucket(dict):
             for friend_of_a_friend in remotes_peers:
                 if friend_of_a_friend['node'] == i.threeple and friend_of_a_friend['transactions']:
                     results.append(peer)
-        log("R1:  %s %s" % (i, str(results)))
+        log("R1:  %s %s", i, results, level=DEBUG)
         return results
 
+    @memoize(depends_on_trust=True)
     def f(self, i, j):
         # Feedback credibility
         s = sum([self.sim(_, j) for _ in self.R1(i)])
@@ -349,36 +1381,43 @@ class TBucket(dict):
             f = 0
         else:
             f = self.sim(i, j) / s
-        log("f:   %s %s %i" % (i, j, f))
+        log("f:   %s %s %i", i, j, f, level=DEBUG)
         return f
 
+    @memoize(depends_on_trust=True)
     def fC(self, i, j):
         fC = self.f(i,j) * self.C(i, j)
-        log("fC:  %s %s %i" % (i, j, fC))
+        log("fC:  %s %s %i", i, j, fC, level=DEBUG)
         return fC
 
+    @memoize(depends_on_trust=True)
     def l(self, i, j):
-        s = sum([max(self.fC(i,m), 0) for m in self])
+        s = self.l_sum(i)
         if not s:
             l = 0
         else:
             l = max(self.fC(i,j), 0) / s
-        log("l:   %s %s %i" % (i, j, l))
+        log("l:   %s %s %i", i, j, l, level=DEBUG)
         return l
 
+    @memoize(depends_on_trust=True)
+    def l_sum(self, i):
+        return sum([max(self.fC(i,m), 0) for m in self])
+
     def t(self, i, j):
         score = 0
         for _, k in enumerate(self.router):
             if _ >= self.iterations: break
             score += self.l(i,k) + self.C(k,j)
-        log("t:   %s %s %i" % (i, j, score))
+        log("t:   %s %s %i", i, j, score, level=DEBUG)
         return score
 
     def w(self, i, j):
         w = (1.0 - self.beta) * self.C(j,k) + (self.beta * self.sim(j, i))
-        log("w:   %i" % w)
+        log("w:   %i", w, level=DEBUG)
         return w
 
+    @memoize()
     def common_peers(self, i, j):
         """
         Returns the set of the common peers between sets i and j who have
@@ -391,10 +1430,10 @@ class TBucket(dict):
             return []
 
         ir = [tuple(p['node']) for p in ir if p['transactions']]
-        jr = [tuple(p['node']) for p in jr if p['transactions']]
+        jr = set(tuple(p['node']) for p in jr if p['transactions'])
 
-        result = list(set(ir).intersection(jr))
-        log("cmn: %s %s %i: %s" % (i, j, len(result), result))
+        result = distinct(p for p in ir if p in jr)
+        log("cmn: %s %s %i: %s", i, j, len(result), result, level=DEBUG)
         return result
 
     def aggregate_trust(self):
@@ -405,10 +1444,10 @@ class TBucket(dict):
         AC    = []
         peers = [peer for peer in self.router]
         x     = len(peers)
-        if x / 5:
-            x = x / 5
-        elif x / 2:
-            x = x / 2
+        if x // 5:
+            x = x // 5
+        elif x // 2:
+            x = x // 2
         for i in range(x):
             AC.append(peers[i:i+x])
         return AC
@@ -417,27 +1456,51 @@ class TBucket(dict):
         """
         Weight peers by the ratings assigned to them via trusted peers.
         """
+        if self.engine:
+            return self.engine.calculate_trust(self)
+
+        # Start a new epoch.
+        self.cache       = {}
+        self.trust_cache = {}
+
         for remote_peer in self.router.peers:
             new_trust = self.t(self.router.node, remote_peer)
-            self.messages.append("Recalculated trust of %s as %.4f." %\
-                (remote_peer, new_trust))
+            self.messages.append(("Recalculated trust of %s as %.4f.", remote_peer, new_trust))
             remote_peer.trust = new_trust
+            self.trust_cache = {}
+        self.router.touch()
         # AC = self.aggregate_trust()
         self.read_messages()
         # log(AC)
 
+    def cache_stats(self):
+        """
+        Memoization hits and misses by function, for utils.table().
+        """
+        rows = []
+        for name in sorted(set(self.hits) | set(self.misses)):
+            hits   = self.hits.get(name, 0)
+            misses = self.misses.get(name, 0)
+            row    = {"Function": name, "Hits": hits, "Misses": misses,
+                      "Hit Rate": "%.1f%%" % (100.0 * hits / (hits + misses))}
+            # table() sizes columns by their values.
+            rows.append(dict((k, str(v).ljust(len(k))) for k, v in row.items()))
+        return rows
+
     def read_messages(self):
+        # Messages are a format and its arguments, formatted only if logged.
         for message in self.messages:
-            log(message)
+            log(*message)
         self.messages = []
 
     def __iter__(self):
-        return iter(self.values())
+        # In order of long_id, which is the same on every interpreter.
+        return iter([self[key] for key in sorted(self.keys())])
 
     def __repr__(self):
         return "<TBucket of %i pre-trusted peers>" % len(self)
 
-class PTPBucket(dict):
+class PTPBucket(OrderedDict):
     """
     A two-tiered bucket of pre-trusted peers.
 
@@ -468,29 +1531,36 @@ class PTPBucket(dict):
     to at least either half of our set of pre-trusted peers or if none are
     available, directly to ourselves.
     """
+    # An object with a calculate_trust(bucket) method to use in place of the
+    # pure Python implementation below. See engines.py.
+    engine = None
+
+    # The parameters below are class attributes so that a sweep can set them
+    # for every bucket in a run. Set them on a bucket to tune it alone.
+
+    # We require alpha satisfactory transactions and altruism(peer) = 1
+    # before we graduate a remote peer from the extended set into this set.
+    alpha = 500
+
+    # The minimum satisfactory transactions required with at least half of
+    # the members of this set, or if there are no members of this set, with
+    # ourselves before graduating remote peers into the extended set.
+    beta  = 250
+
+    # Percentage of purportedly malicious downloads before a far peer can be
+    # pre-emptively dismissed for service. 0.5% by default. This means that
+    # we'll tolerate one unsatisfactory download out of every 200 per
+    # threat model F.
+    delta = 0.005
+
+    # Percentage of network peers we need to trust before we start
+    # letting them cut us off from peers they report to be malicious.
+    gamma = 0.04
+
     def __init__(self, router, *args, **kwargs):
         # Peers trusted by pre-trusted peers. These are peers we're observing
         # for possible inclusion into the set of pre-trusted peers.
-        self.extent  = {}
-        
-        # We require alpha satisfactory transactions and altruism(peer) = 1
-        # before we graduate a remote peer from the extended set into this set.
-        self.alpha   = 500
-        
-        # The minimum satisfactory transactions required with at least half of
-        # the members of this set, or if there are no members of this set, with
-        # ourselves before graduating remote peers into the extended set.
-        self.beta    = 250
-        
-        # Percentage of purportedly malicious downloads before a far peer can be
-        # pre-emptively dismissed for service. 0.5% by default. This means that
-        # we'll tolerate one unsatisfactory download out of every 200 per
-        # threat model F.
-        self.delta = 0.005
-        
-        # Percentage of network peers we need to trust before we start
-        # letting them cut us off from peers they report to be malicious.
-        self.gamma = 0.04
+        self.extent  = OrderedDict()
         
         # Access to the routing table.
         self.router  = router
@@ -502,11 +1572,19 @@ class PTPBucket(dict):
         # events for review at the end of simulation run.
         self.consensus_events = 0
 
-        dict.__init__(self, *args, **kwargs)
+        # What calculate_trust() knows from last time: for each peer that
+        # sense() left alone, what it was told and the context it was judged
+        # in, by (id, port). What each member of P and EP last said, by long_id.
+        # The context sense() last ran in and a number for it.
+        self.sensed  = {}
+        self.heard   = {}
+        self.epoch   = (0, None)
+
+        OrderedDict.__init__(self, *args, **kwargs)
 
     @property
     def all(self):
-        copy = self.copy()
+        copy = dict(self)
         copy.update(self.extent)
         return iter(copy.values())
 
@@ -523,13 +1601,93 @@ class PTPBucket(dict):
         """
         Ask a remote peer about a peer.
         """
+        count("bucket_queries")
         if not node:
             return
-        for router in self.router.routers:
-            if router.node == node:
-                for _ in router.render_peers():
-                    if _['node'] == about_node.threeple:
-                        return _
+        router = self.router.locate(node)
+        if router is None:
+            return
+        return router.snapshot()[1].get(tuple(about_node.threeple))
+
+    def get_many(self, node, about_nodes):
+        """
+        Ask a remote peer about a set of peers in one request.
+        Returns their responses keyed by node triple, omitting peers they
+        don't know of.
+        """
+        count("bucket_queries")
+        responses = {}
+        if not node:
+            return responses
+        router = self.router.locate(node)
+        if router is None:
+            return responses
+        index = router.snapshot()[1]
+        for about_node in about_nodes:
+            threeple = tuple(about_node.threeple)
+            if threeple in index:
+                responses[threeple] = index[threeple]
+        return responses
+
+    def context(self, multiplier):
+        """
+        What sense() looks at besides a peer and what P and EP say about it:
+        who's in P and EP and in what order, which members of P have had more
+        than alpha transactions with us, and our own parameters.
+        """
+        node = self.router.node
+        return (tuple(self.extent.keys()),
+                tuple((m.long_id, m.transactions > self.alpha) for m in self.values()),
+                multiplier, len(self.router), node.trust, node.epsilon,
+                self.alpha, self.beta, self.gamma, self.delta)
+
+    def advance(self, context):
+        """
+        Return the number of the context calculate_trust() is judging peers
+        in, which changes whenever the context does.
+        """
+        if self.epoch[1] != context:
+            self.epoch = (self.epoch[0] + 1, context)
+        return self.epoch[0]
+
+    def changes(self, opinions):
+        """
+        Ask the members of P and EP whose routing tables have changed since
+        last time what they make of our peers and return the (id, port) of
+        each peer whose responses differ. What members say goes in opinions.
+        """
+        peers   = self.router.peers
+        changed = set()
+        heard   = {}
+        for member in list(self.extent.values()) + list(self.values()):
+            router = self.router.locate(member)
+            index  = router.snapshot()[1] if router is not None else None
+            last   = self.heard.get(member.long_id)
+            if last is not None and last[0] is index and last[1] is peers and \
+                    last[2] == peers.version:
+                responses = last[3]
+            else:
+                responses = self.get_many(member, peers)
+                previous  = last[3] if last is not None else {}
+                for peer in peers:
+                    threeple = tuple(peer.threeple)
+                    if responses.get(threeple) != previous.get(threeple):
+                        changed.add((peer.id, peer.port))
+            opinions[member.long_id] = responses
+            heard[member.long_id]    = (index, peers, peers.version, responses)
+        self.heard = heard
+        return changed
+
+    def ask(self, opinions, node, about_node):
+        """
+        Look up what node reported about about_node this sensing round.
+        Members of P and EP are asked about all of our peers at once the first
+        time they're consulted, so a round costs one request per member.
+        """
+        if not node.long_id in opinions:
+            opinions[node.long_id] = self.get_many(node, self.router.peers)
+        return opinions[node.long_id].get(tuple(about_node.threeple))
+
     def med(self, ls):
         if numpy:
             return numpy.median(numpy.array(ls))
@@ -537,9 +1695,9 @@ class PTPBucket(dict):
         if len(ls) < 1:
             return None
         if len(ls) %2 == 1:
-            return ls[((len(ls)+1)/2)-1]
+            return ls[((len(ls)+1)//2)-1]
         else:
-            return float(sum(ls[(len(ls)/2)-1:(len(ls)/2)+1]))/2.0
+            return float(sum(ls[(len(ls)//2)-1:(len(ls)//2)+1]))/2.0
 
     def mean(self, ls):
         if not isinstance(ls, (list, tuple)):
@@ -563,13 +1721,14 @@ class PTPBucket(dict):
         m  = self.med(l)
         me = self.mean([a, m])
         if self.verbose:
-            log("a,m,me: [%f, %f] %f" % (a, m, me))
+            log("a,m,me: [%f, %f] %f", a, m, me)
         median = min(max(me, 0), 1)
         if self.verbose:
-            log("median: %s %f" % (l, median))
+            log("median: %s %f", l, median)
         return median
 
     def altruism(self, i):
+        count("altruism")
         if isinstance(i, Node):
             i = {"trust": i.trust, "transactions": i.transactions}
         divisor = (i['transactions'] * self.router.node.epsilon)
@@ -578,126 +1737,141 @@ class PTPBucket(dict):
         if not divisor: return 0.00
         return a / divisor
 
+    def multiplier(self):
+        """
+        Multiplier is the amount of transactions more than ourselves we're
+        checking a trusted peer is reporting they've satisfactorily had
+        with an untrustworthy peer. For small networks we would find it
+        interesting if a peer we depend on for consensus claims to have
+        had more than twice as many satisfactory transactions than
+        ourselves with a peer who we've only have had (100% - delta)
+        satisfactory transactions with.
+        """
+        return 2.1 if len(self.router) < 40 else 1.1
+
     def calculate_trust(self):
+        """
+        Vet every peer in our routing table, then maintain P and EP.
+
+        A peer sense() left alone last time is passed over while its trust
+        rating and transaction count, what P and EP say about it and the
+        context() it's judged in stay the same, since it'd be left alone
+        again. Members of P and EP are only asked again once their routing
+        tables have changed.
+        """
+        if self.engine:
+            return self.engine.calculate_trust(self)
+
         # Simple behaviors here can be enhanced with decision trees.
-        all_responses = {} 
+        all_responses = OrderedDict()
+
+        # What each member of P and EP has told us about our peers this round.
+        opinions      = {}
 
+        multiplier    = self.multiplier()
+        changed       = self.changes(opinions)
+        context       = self.context(multiplier)
+        epoch         = self.advance(context)
+        sensed        = {}
         for peer in self.router:
-            responses             = []
-            ep_responses          = []
-            altruism              = []
-            local_altruism        = 0.00
-
-            # Multiplier is the amount of transactions more than ourselves we're
-            # checking a trusted peer is reporting they've satisfactorily had
-            # with an untrustworthy peer. For small networks we would find it
-            # interesting if a peer we depend on for consensus claims to have
-            # had more than twice as many satisfactory transactions than
-            # ourselves with a peer who we've only have had (100% - delta)
-            # satisfactory transactions with.
-            multiplier = 2.1 if len(self.router) < 40 else 1.1
-            
-            # Ask members of EP about the peer in question.
-            for extent_peer in self.extent.values():
-                if extent_peer == peer: continue
-                response = self.get(extent_peer, peer)
-                if response:
-                    ep_responses.append(response)
-
-            # Ask members of set P about the peer.
-            for trusted_peer in self.values():
-                if trusted_peer == peer: continue
-                response = self.get(trusted_peer, peer)
-                if response and response['transactions']:
-                    responses.append((trusted_peer, response))
-                    
-                    if not trusted_peer in all_responses:
-                        all_responses[trusted_peer] = [(peer, response)]
-                    else:
-                        all_responses[trusted_peer].append((peer, response))
-
-            for response in ep_responses:
-                if response and response['transactions']:
-                    
-                    # Check for peers in EP reporting trust ratings greater or lower
-                    # than what they could be in relation to reported transaction counts.
-                    if (response['trust'] > 0.5 + (response['transactions'] * self.router.node.epsilon)) \
-                    or (response['trust'] < 0.5 - (response['transactions'] * self.router.node.epsilon)) \
-                    and response['trust'] and extent_peer.long_id in self.extent:
-                        extent_peer.trust = 0
-                        [setattr(_, "trust", 0) for _ in self.router.peers if _ == extent_peer]
-                        log("Removing %s from EP for impossible trust ratings." % extent_peer)
-                        del self.extent[extent_peer.long_id]
-                        continue
+            key   = (peer.id, peer.port)
+            state = (peer.trust, peer.transactions)
+
+            # sense() left this peer alone last time and nothing it looks at
+            # has changed since, so it would again. Its responses from P still
+            # count towards check_deflation().
+            last = self.sensed.get(key)
+            if last is not None and last[0] == epoch and last[1] == state \
+                    and not key in changed:
+                for trusted_peer, response in last[2]:
+                    all_responses.setdefault(trusted_peer, []).append((peer, response))
+                sensed[key] = last
+                count("peers_unchanged")
+                continue
 
-                    # Check for members of set EP reporting 100% unsatisfactory
-                    # transactions with the peer in question but not reporting the
-                    # peer as having trust == 0 when reporting altruism < 0.8.
-                    if self.altruism(response) <= 0.8 and response['trust'] > 0:
-                        if self.verbose:
-                            log((extent_peer, peer, response))
-                        if extent_peer.long_id in self:
-                            log("Removing %s from EP for deflating trust ratings." % \
-                                extent_peer)
-                            del self.extent[extent_peer.long_id]
-                            continue
-
-                    # Check for peers in EP reporting high transaction count and
-                    # high trust with peers we don't trust, indicating inflated scores.
-                    if not peer.trust and peer.transactions > 5 * multiplier \
-                        and response['transactions'] >= peer.transactions * multiplier \
-                        and float("%.1f" % self.altruism(response)) >= 1.0:
-                        # Check for at least two members of set P to cross-reference with
-                        if len(responses) < 3: break
-                        c = 0
-                        for _, resp in responses:
-                            if self.altruism(resp) > 0.95: c += 1
-                        # Vet the next response from the next member of EP if
-                        # less than 90% of P find the current peer untrustworthy.
-                        if c < 0.9 * (len(responses) - 1):
-                            continue
-                        if self.verbose:
-                            log((peer, extent_peer, response))
-                        if extent_peer.long_id in self.extent:
-                            extent_peer.trust = 0
-                            [setattr(_, "trust", 0) for _ in self.router.peers if _ == extent_peer]
-                            log("Removing %s from EP for inflating trust ratings." % extent_peer)
-                            del self.extent[extent_peer.long_id]
- 
+            count("peers_sensed")
+            before = dict((m, len(r)) for m, r in all_responses.items())
+            events = self.consensus_events
+            self.sense(peer, all_responses, opinions, multiplier)
+
+            if self.context(multiplier) != context:
+                context = self.context(multiplier)
+                epoch   = self.advance(context)
+                continue
+            if (peer.trust, peer.transactions) != state or \
+                    self.consensus_events != events or \
+                    any(len(all_responses.get(m, ())) < n for m, n in before.items()):
+                continue
+            sensed[key] = (epoch, state,
+                           [(m, all_responses[m][-1][1]) for m in self.values()
+                            if len(all_responses.get(m, ())) > before.get(m, 0)])
+        self.sensed = sensed
+
+        self.graduate()
+        self.check_deflation(all_responses)
+        self.report()
+
+    def sense(self, peer, all_responses, opinions, multiplier):
+        """
+        Vet what members of P and EP report about a peer, then decide whether
+        the peer is malicious or can be graduated into EP.
+        """
+        responses             = []
+        ep_responses          = []
+        altruism              = []
+        local_altruism        = 0.00
+
+        # Ask members of EP about the peer in question.
+        for extent_peer in self.extent.values():
+            if extent_peer == peer: continue
+            response = self.ask(opinions, extent_peer, peer)
+            if response:
+                ep_responses.append(response)
+
+        # Ask members of set P about the peer.
+        for trusted_peer in self.values():
+            if trusted_peer == peer: continue
+            response = self.ask(opinions, trusted_peer, peer)
+            if response and response['transactions']:
+                responses.append((trusted_peer, response))
+                
+                if not trusted_peer in all_responses:
+                    all_responses[trusted_peer] = [(peer, response)]
+                else:
+                    all_responses[trusted_peer].append((peer, response))
 
-            # Check for peers in P reporting trust ratings greater or lower
-            # than what they could be in relation to reported transaction counts.
-            for trusted_peer, response in responses:
+        for response in ep_responses:
+            if response and response['transactions']:
+                
+                # Check for peers in EP reporting trust ratings greater or lower
+                # than what they could be in relation to reported transaction counts.
                 if (response['trust'] > 0.5 + (response['transactions'] * self.router.node.epsilon)) \
                 or (response['trust'] < 0.5 - (response['transactions'] * self.router.node.epsilon)) \
-                and response['trust'] and trusted_peer.long_id in self:
-                    trusted_peer.trust = 0
-                    [setattr(_, "trust", 0) for _ in self.router.peers if _ == trusted_peer]
-                    log("Removing %s from P for impossible trust ratings." % trusted_peer)
-                    del self[trusted_peer.long_id]
-                    del all_responses[trusted_peer]
-                    responses.remove((trusted_peer, response))
+                and response['trust'] and extent_peer.long_id in self.extent:
+                    extent_peer.trust = 0
+                    [setattr(_, "trust", 0) for _ in self.router.peers if _ == extent_peer]
+                    log("Removing %s from EP for impossible trust ratings.", extent_peer)
+                    count("evictions_ep")
+                    record("eviction_ep", self.router, extent_peer)
+                    del self.extent[extent_peer.long_id]
                     continue
 
-                # Check for members of set P reporting 100% unsatisfactory
+                # Check for members of set EP reporting 100% unsatisfactory
                 # transactions with the peer in question but not reporting the
-                # peer as having trust == 0 when reporting altruism < 0.5.
-                if response['trust'] > 0 and self.altruism(response) <= 0.5 \
-                    and response['transactions'] >= 5 * multiplier:
+                # peer as having trust == 0 when reporting altruism < 0.8.
+                if self.altruism(response) <= 0.8 and response['trust'] > 0:
                     if self.verbose:
-                        log((trusted_peer, peer, response))
-                        log(self.altruism(response))
-                    if trusted_peer.long_id in self:
-                        log("Removing %s from P for deflating trust ratings." % \
-                            trusted_peer)
-                        del self[trusted_peer.long_id]
-                        del all_responses[trusted_peer]
-                        responses.remove((trusted_peer, response))
+                        log((extent_peer, peer, response))
+                    if extent_peer.long_id in self:
+                        log("Removing %s from EP for deflating trust ratings.",
+                            extent_peer)
+                        count("evictions_ep")
+                        record("eviction_ep", self.router, extent_peer)
+                        del self.extent[extent_peer.long_id]
                         continue
 
-                # Check for peers in P reporting high transaction count and
-                # altruism > 1 - delta with peers we don't trust, which indicates
-                # trusted peers giving inflated trust ratings.
+                # Check for peers in EP reporting high transaction count and
+                # high trust with peers we don't trust, indicating inflated scores.
                 if not peer.trust and peer.transactions > 5 * multiplier \
                     and response['transactions'] >= peer.transactions * multiplier \
                     and float("%.1f" % self.altruism(response)) >= 1.0:
@@ -711,129 +1885,205 @@ class PTPBucket(dict):
                     if c < 0.9 * (len(responses) - 1):
                         continue
                     if self.verbose:
-                        log((peer, trusted_peer, response))
-                    if trusted_peer.long_id in self:
-                        trusted_peer.trust = 0
-                        [setattr(_, "trust", 0) for _ in self.router.peers if _ == trusted_peer]
-                        log("Removing %s from P for inflating trust ratings." % \
-                            trusted_peer)
-                        del self[trusted_peer.long_id]
-                        del all_responses[trusted_peer]
-                        responses.remove((trusted_peer, response))
-
-            if not peer.trust: continue
-
-            local_altruism = float("%.1f" % self.altruism(peer))
-            
-            if (local_altruism + self.delta) <= 1.0:
-                log("Local experience shows %s is malicious." % peer)
-                peer.trust = 0
+                        log((peer, extent_peer, response))
+                    if extent_peer.long_id in self.extent:
+                        extent_peer.trust = 0
+                        [setattr(_, "trust", 0) for _ in self.router.peers if _ == extent_peer]
+                        log("Removing %s from EP for inflating trust ratings.", extent_peer)
+                        count("evictions_ep")
+                        record("eviction_ep", self.router, extent_peer)
+                        del self.extent[extent_peer.long_id]
+ 
+
+        # Check for peers in P reporting trust ratings greater or lower
+        # than what they could be in relation to reported transaction counts.
+        for trusted_peer, response in responses:
+            if (response['trust'] > 0.5 + (response['transactions'] * self.router.node.epsilon)) \
+            or (response['trust'] < 0.5 - (response['transactions'] * self.router.node.epsilon)) \
+            and response['trust'] and trusted_peer.long_id in self:
+                trusted_peer.trust = 0
+                [setattr(_, "trust", 0) for _ in self.router.peers if _ == trusted_peer]
+                log("Removing %s from P for impossible trust ratings.", trusted_peer)
+                count("evictions_p")
+                record("eviction_p", self.router, trusted_peer)
+                del self[trusted_peer.long_id]
+                del all_responses[trusted_peer]
+                responses.remove((trusted_peer, response))
                 continue
 
-            median_reported_altruism = 0.00
-            # Let our pre-trusted peers have some say about this if they
-            # A) Represent at least gamma percent of who we know in the network.
-            # B) Report having more experience than us with the peer in question.
-            if float(len(self)) / len(self.router) >= self.gamma:
-                
-                # Filter responses to those from peers who report having more
-                # experience than us with the peer in question if we're ascribing
-                # a 100% altruism rating to this peer.
-                filtered_responses = filter(lambda r:
-                                        r[1]['transactions'] >= peer.transactions and \
-                                        (float(r[1]['transactions'] - peer.transactions) / r[1]['transactions']) \
-                                        >= 0.01,
-                                        responses
-                                  )
-
-                # If we have good faith in the peer regardless of having had no
-                # transactions with them we'll require the votes to come from
-                # pre-trusted peers who've rendered excellent service to
-                # mitigate the effect of maximally deflationary pre-trusted peers.
-                if local_altruism >= 0.99:
-                    filtered_responses = filter(lambda r: r[0].transactions > self.alpha,
-                                                filtered_responses)
-
-
-                for response in filtered_responses:
-                    altruism.append(self.altruism(response[1]))
-
-                # continue if we've had good service from the peer in question
-                # and only received one vote, or if we've had perfect service
-                # from the peer so far. Listen to trusted peers if we have no
-                # prior transactions with the peer in question as this is really
-                # what the system's about: Pre-emptively identifying
-                # untrustworthy peers without having to transact with them.
-                if not len(altruism) or (local_altruism == 1.0 and len(altruism) == 1) or \
-                        (peer.transactions and local_altruism == 1.0):
-                    continue
-                
-                if numpy:
-                    [altruism.remove(_) for _ in altruism if _ == None or _ is numpy.nan]
-                else:
-                    [altruism.remove(_) for _ in altruism if _ == None]
-                
+            # Check for members of set P reporting 100% unsatisfactory
+            # transactions with the peer in question but not reporting the
+            # peer as having trust == 0 when reporting altruism < 0.5.
+            if response['trust'] > 0 and self.altruism(response) <= 0.5 \
+                and response['transactions'] >= 5 * multiplier:
                 if self.verbose:
-                    log(filtered_responses)
-                    log("%s local_altruism %f" % (peer, local_altruism))
+                    log((trusted_peer, peer, response))
+                    log(self.altruism(response))
+                if trusted_peer.long_id in self:
+                    log("Removing %s from P for deflating trust ratings.",
+                        trusted_peer)
+                    count("evictions_p")
+                    record("eviction_p", self.router, trusted_peer)
+                    del self[trusted_peer.long_id]
+                    del all_responses[trusted_peer]
+                    responses.remove((trusted_peer, response))
+                    continue
 
-                log("%s %s" % (peer, altruism))
-                
-                median_reported_altruism = self.median(altruism)
-                log("Median reported altruism: %f" % median_reported_altruism)
-                # Check if global altruism is below our accepted threshold (delta) and
-                # if it's reportedly less than our experience minus the accepted threshold
-                # gamma, which is made to be a function of routing table size. 
-                if (median_reported_altruism + self.delta) < 1.0:
-                    log("Consensus from our trusted peers is that %s is malicious." % peer)
-                    peer.trust = 0
-                    self.consensus_events += 1
+            # Check for peers in P reporting high transaction count and
+            # altruism > 1 - delta with peers we don't trust, which indicates
+            # trusted peers giving inflated trust ratings.
+            if not peer.trust and peer.transactions > 5 * multiplier \
+                and response['transactions'] >= peer.transactions * multiplier \
+                and float("%.1f" % self.altruism(response)) >= 1.0:
+                # Check for at least two members of set P to cross-reference with
+                if len(responses) < 3: break
+                c = 0
+                for _, resp in responses:
+                    if self.altruism(resp) > 0.95: c += 1
+                # Vet the next response from the next member of EP if
+                # less than 90% of P find the current peer untrustworthy.
+                if c < 0.9 * (len(responses) - 1):
                     continue
-            
-            # Don't adjust a peers' trust rating to more closely reflect the consensus
-            # as this gives an innacurate reflection of their trust / transaction ratio
-            # from our perspective.
+                if self.verbose:
+                    log((peer, trusted_peer, response))
+                if trusted_peer.long_id in self:
+                    trusted_peer.trust = 0
+                    [setattr(_, "trust", 0) for _ in self.router.peers if _ == trusted_peer]
+                    log("Removing %s from P for inflating trust ratings.",
+                        trusted_peer)
+                    count("evictions_p")
+                    record("eviction_p", self.router, trusted_peer)
+                    del self[trusted_peer.long_id]
+                    del all_responses[trusted_peer]
+                    responses.remove((trusted_peer, response))
 
-            # Check who we can invite into the extended set.
-            if (len(self) and float("%.1f" % median_reported_altruism) != 1.0) \
-            or peer in self.all:
-                continue
+        if not peer.trust: return
+
+        local_altruism = float("%.1f" % self.altruism(peer))
+        
+        if (local_altruism + self.delta) <= 1.0:
+            log("Local experience shows %s is malicious.", peer)
+            peer.trust = 0
+            return
+
+        median_reported_altruism = 0.00
+        # Let our pre-trusted peers have some say about this if they
+        # A) Represent at least gamma percent of who we know in the network.
+        # B) Report having more experience than us with the peer in question.
+        if float(len(self)) / len(self.router) >= self.gamma:
             
-            # If we haven't continued from this peer we'll see if they can be
-            # graduated into the extended set of pre-trusted peers using the
-            # responses obtained earlier.
-            #
-            # We do this based on the peer having median_reported_altruism == 1
-            # and either at least half of our trusted peers having at least
-            # the minimum required transaction count (beta) with this peer or
-            # if we're in need of some pre-trusted peers, this instance having
-            # the necessary transaction count.
-            votes = sum([1 for r in responses if r[1]['transactions'] >= self.beta])
-            if len(self) and not votes: continue
+            # Filter responses to those from peers who report having more
+            # experience than us with the peer in question if we're ascribing
+            # a 100% altruism rating to this peer.
+            filtered_responses = [r for r in responses if
+                                    r[1]['transactions'] >= peer.transactions and \
+                                    (float(r[1]['transactions'] - peer.transactions) / r[1]['transactions']) \
+                                    >= 0.01]
+
+            # If we have good faith in the peer regardless of having had no
+            # transactions with them we'll require the votes to come from
+            # pre-trusted peers who've rendered excellent service to
+            # mitigate the effect of maximally deflationary pre-trusted peers.
+            if local_altruism >= 0.99:
+                filtered_responses = [r for r in filtered_responses
+                                      if r[0].transactions > self.alpha]
+
+
+            for response in filtered_responses:
+                altruism.append(self.altruism(response[1]))
+
+            # continue if we've had good service from the peer in question
+            # and only received one vote, or if we've had perfect service
+            # from the peer so far. Listen to trusted peers if we have no
+            # prior transactions with the peer in question as this is really
+            # what the system's about: Pre-emptively identifying
+            # untrustworthy peers without having to transact with them.
+            if not len(altruism) or (local_altruism == 1.0 and len(altruism) == 1) or \
+                    (peer.transactions and local_altruism == 1.0):
+                return
             
-            if (not len(self) and peer.transactions >= self.beta) \
-            or (len(self) and votes >= (len(self) / 2)):
-                if len(self):
-                    log("votes: %s %i" % (peer, votes))
-                log("Graduating %s into EP." % peer)
-                self.extent[peer.long_id] = peer
-
-        for peer in self.extent.copy().values():
+            if numpy:
+                [altruism.remove(_) for _ in altruism if _ == None or _ is numpy.nan]
+            else:
+                [altruism.remove(_) for _ in altruism if _ == None]
+            
+            if self.verbose:
+                log(filtered_responses)
+                log("%s local_altruism %f", peer, local_altruism)
+
+            log("%s %s", peer, altruism)
+            
+            median_reported_altruism = self.median(altruism)
+            log("Median reported altruism: %f", median_reported_altruism)
+            # Check if global altruism is below our accepted threshold (delta) and
+            # if it's reportedly less than our experience minus the accepted threshold
+            # gamma, which is made to be a function of routing table size. 
+            if (median_reported_altruism + self.delta) < 1.0:
+                log("Consensus from our trusted peers is that %s is malicious.", peer)
+                peer.trust = 0
+                count("consensus_events")
+                record("consensus", self.router, peer)
+                self.consensus_events += 1
+                return
+        
+        # Don't adjust a peers' trust rating to more closely reflect the consensus
+        # as this gives an innacurate reflection of their trust / transaction ratio
+        # from our perspective.
+
+        # Check who we can invite into the extended set.
+        if (len(self) and float("%.1f" % median_reported_altruism) != 1.0) \
+        or peer in self.all:
+            return
+        
+        # If we haven't continued from this peer we'll see if they can be
+        # graduated into the extended set of pre-trusted peers using the
+        # responses obtained earlier.
+        #
+        # We do this based on the peer having median_reported_altruism == 1
+        # and either at least half of our trusted peers having at least
+        # the minimum required transaction count (beta) with this peer or
+        # if we're in need of some pre-trusted peers, this instance having
+        # the necessary transaction count.
+        votes = sum([1 for r in responses if r[1]['transactions'] >= self.beta])
+        if len(self) and not votes: return
+        
+        if (not len(self) and peer.transactions >= self.beta) \
+        or (len(self) and votes >= (len(self) // 2)):
+            if len(self):
+                log("votes: %s %i", peer, votes)
+            log("Graduating %s into EP.", peer)
+            count("graduations_ep")
+            record("graduation_ep", self.router, peer)
+            self.extent[peer.long_id] = peer
+
+    def graduate(self):
+        """
+        Graduate members of EP into P and drop members of either set whose
+        altruism has fallen.
+        """
+        for peer in list(self.extent.values()):
             if float("%.1f" % self.altruism(peer)) != 1.0:
-                log("Removing %s from the extended set of pre-trusted peers." % peer)
+                log("Removing %s from the extended set of pre-trusted peers.", peer)
+                count("evictions_ep")
+                record("eviction_ep", self.router, peer)
                 del self.extent[peer.long_id]
                 continue
             # Check if they're trustworthy enough to be a pre-trusted peer
             if peer.transactions >= self.alpha:
-                log("Graduating %s from EP to P." % peer)
+                log("Graduating %s from EP to P.", peer)
                 del self.extent[peer.long_id]
+                count("graduations_p")
+                record("graduation_p", self.router, peer)
                 self[peer.long_id] = peer
 
-        for peer in self.copy().values():
+        for peer in list(self.values()):
             if float("%.1f" % self.altruism(peer)) != 1.0:
-                log("Removing %s from the set of pre-trusted peers." % peer)
+                log("Removing %s from the set of pre-trusted peers.", peer)
+                count("evictions_p")
+                record("eviction_p", self.router, peer)
                 del self[peer.long_id]
-        
+
+    def check_deflation(self, all_responses):
         # Check the percentage of high transaction/altruism peers being
         # reported as untrustworthy by this peer.
         for trusted_peer, responses in all_responses.items():
@@ -852,27 +2102,80 @@ class PTPBucket(dict):
                         if _peer == peer and self.altruism(cmp_response) > 0.95:
                             x += 1
             if self.verbose:
-                log("%s x: %i" % (trusted_peer, x))
+                log("%s x: %i", trusted_peer, x)
             if x > len(self.router) * 0.7:
-                log("Removing %s from P for deflating trust ratings." % trusted_peer)
+                log("Removing %s from P for deflating trust ratings.", trusted_peer)
+                count("evictions_p")
+                record("eviction_p", self.router, trusted_peer)
                 del self[trusted_peer.long_id]
 
-        log("P:  %s" % str(self.values()))
-        log("EP: %s" % str(self.extent.values()))
+    def report(self):
+        """
+        Log the state of P, EP and our routing table at the end of a round.
+        """
+        log("P:  %s", list(self.values()))
+        log("EP: %s", list(self.extent.values()))
 
         for _ in sort_nodes_by_trust(self.router.peers):
             log(_)
 
-        del all_responses
+        # Peers' trust ratings may have been zeroed above.
+        self.router.touch()
+
+# What set_seed() was given. Every stream() is derived from it.
+seed = None
+
+# Every stream() handed out, by path, so that checkpoints can save and
+# restore where each one is up to.
+streams = {}
+
+class Stream(random.Random):
+    """
+    A random number generator that picks integers, choices, samples and
+    shuffles by scaling random() as Python 2 does. Python 3 draws them from
+    getrandbits() instead, which would give a seed a different run there.
+    """
+    def _randbelow(self, n, *args, **kwargs):
+        return int(self.random() * n)
 
-def generate_routers(options, minimum=None, maximum=None, attrs={}, router_class=Router):
-    routers = []
+def set_seed(value):
+    """
+    Seed every stream() from here on with value, e.g. from --seed.
+    """
+    global seed
+    seed = value
+
+def stream(*path):
+    """
+    Return a random number generator of its own for path, such as
+    ("router", 3) for the fourth router created, derived from the seed given
+    to set_seed(). A seed and path always give the same numbers, whatever
+    else draws from other streams and in whichever process, so a seeded run
+    comes out the same when its work is split up or reordered.
+
+    Without a seed this is the random module, as if there were no streams.
+    """
+    if seed is None:
+        return random
+    digest = hashlib.sha1(repr((seed,) + path).encode("utf-8")).hexdigest()
+    streams[path] = Stream(int(digest, 16))
+    return streams[path]
+
+@timed("generation")
+def generate_routers(options, minimum=None, maximum=None, attrs={}, router_class=Router,
+                     shared=False):
+    """
+    Create routers, each with a directory of the others, or if shared is True
+    with the one directory they're in, which doesn't grow with the square of
+    their number.
+    """
+    routers = RouterDirectory()
     
-    node_count = max(options.nodes, minimum)
+    node_count = max(options.nodes, minimum or 0)
     if maximum:
         node_count = min(node_count, maximum)
     
-    log("Creating %s routing tables." % "{:,}".format(node_count))
+    log("Creating %s routing tables.", "{:,}".format(node_count))
     for _ in range(node_count):
         router                 = router_class()
         router.no_prisoners    = options.no_prisoners
@@ -880,7 +2183,10 @@ def generate_routers(options, minimum=None, maximum=None, attrs={}, router_class
         routers.append(router)
 
     for router in routers:
-        router.routers = [r for r in routers if r != router]
+        if shared:
+            router.routers = routers
+        else:
+            router.routers = RouterDirectory(r for r in routers if r != router)
         for key, value in attrs.items():
             setattr(router, key, value)
     
@@ -891,6 +2197,30 @@ def fabricate_transactions(node, floor=5, ceiling=75):
     node.trust        = random.randint(floor, node.transactions)
     return node
 
+def reachable(network):
+    """
+    Return every router that can be reached from network through directories
+    and routing tables, in order of creation.
+    """
+    found = {}
+    stack = list(network)
+    while stack:
+        router = stack.pop()
+        if id(router) in found:
+            continue
+        found[id(router)] = router
+        stack.extend(router.routers)
+        stack.extend(p.router for p in router.peers if p.router is not None)
+    return sorted(found.values(), key=lambda router: router.serial)
+
+def distinct(items):
+    """
+    Return items without repeats, in the order they first appear.
+    """
+    seen = set()
+    return [item for item in items if not (item in seen or seen.add(item))]
+
+@timed("introductions")
 def introduce(routers, secondary=[]):
     """
     Introduce a set of routers to one another or all routers of one set to all
@@ -902,10 +2232,12 @@ def introduce(routers, secondary=[]):
         secondary = [secondary]
     
     if not secondary:
-        log("Introducing %s routing tables to one another." % "{:,}".format(len(routers)))
+        log("Introducing %s routing tables to one another.", "{:,}".format(len(routers)))
         for router in routers:
             router.peers.extend([r.node.copy() for r in routers if r != router])
-            router.peers = list(set(router.peers))
+            router.peers = distinct(router.peers)
+            if recorder is not None:
+                recorder.table(router)
     else:
         log("Introducing %s to %s." % \
             ("a set of {:,} routing tables".format(len(routers)) if len(routers) \
@@ -913,14 +2245,289 @@ def introduce(routers, secondary=[]):
                 .format(len(secondary)) if len(secondary) > 1 else "1 routing table"))
         for router in routers:
             router.peers.extend([r.node.copy() for r in secondary if r != router])
-            router.peers = list(set(router.peers))
+            router.peers = distinct(router.peers)
+            if recorder is not None:
+                recorder.table(router)
 
         for router in secondary:
             router.peers.extend([r.node.copy() for r in routers if r != router])
-            router.peers = list(set(router.peers))
+            router.peers = distinct(router.peers)
+            if recorder is not None:
+                recorder.table(router)
 
     return routers
 
+class Scheduler(object):
+    """
+    Decides which routers calculate trust in each round.
+
+    Each router senses once every interval(router) rounds. The interval grows
+    with the square root of its routing table's size, so that routers in
+    larger networks sense less often, as PTPBucket suggests, and shrinks with
+    how much of the table has changed since the router last sensed. Routers
+    are staggered as they're first seen so that about the same number sense
+    each round instead of all of them at once.
+
+    Given every, all routers sense together every that many rounds instead,
+    as the scenarios used to with every=5.
+    """
+    def __init__(self, every=None, jobs=0):
+        self.every     = every
+        self.jobs      = jobs
+
+        # The interval for a routing table of reference peers, the shortest and
+        # longest intervals, and how much sooner churn brings sensing forward.
+        # A table a quarter of which is new senses in half the time.
+        self.base      = 5
+        self.reference = 10
+        self.minimum   = 2
+        self.maximum   = 50
+        self.churn     = 4.0
+
+        # The round each router is next due to sense in and the peers in its
+        # routing table when it last did, by router ID.
+        self.due       = {}
+        self.tables    = {}
+        self.seen      = 0
+
+    def interval(self, router):
+        """
+        How many rounds router should go between sensing, from the size of
+        its routing table and the share of it that's changed since last time.
+        """
+        keys  = set(router.peers.by_key)
+        size  = max(len(keys), 1)
+        last  = self.tables.get(router.id)
+        churn = len(keys.symmetric_difference(last)) / float(size) if last else 0.0
+        self.tables[router.id] = keys
+
+        interval = self.base * math.sqrt(size / float(self.reference)) / \
+            (1 + self.churn * churn)
+        # Rounding half away from zero, as Python 2's round() does.
+        return int(min(max(math.floor(interval + 0.5), self.minimum), self.maximum))
+
+    def scheduled(self, routers, n):
+        """
+        Return the routers due to sense in round n, in the order given.
+        """
+        if self.every:
+            if n > 1 and not (n + 1) % self.every:
+                return list(routers)
+            return []
+
+        due = []
+        for router in routers:
+            when = self.due.get(router.id)
+            if when is None:
+                interval = self.interval(router)
+                self.due[router.id] = n + 1 + self.seen % interval
+                self.seen += 1
+            elif when <= n:
+                due.append(router)
+        for router in due:
+            self.due[router.id] = n + self.interval(router)
+        return due
+
+    def run(self, routers, n):
+        """
+        Have the routers due in round n calculate trust.
+        """
+        due = self.scheduled(routers, n)
+        if due:
+            sense(due, self.jobs)
+        return due
+
+@timed("sensing")
+def sense(routers, jobs=0):
+    """
+    Have every router calculate trust.
+
+    By default routers sense one after another and each sees what those before
+    it wrote. Given jobs, every router instead sees a snapshot of the network
+    taken before any of them started, and the routers are split across that
+    many worker processes, whose results are then applied in order. A run
+    gives the same results whatever the number of jobs.
+    """
+    if recorder is not None:
+        for router in routers:
+            recorder.record("sense", router)
+
+    if not jobs:
+        for i, router in enumerate(routers):
+            log("%i %s %s is sensing.", i+1, router, router.node)
+            router.tbucket.calculate_trust()
+        return
+
+    global sensing
+    routers = list(routers)
+    # Every router they can reach is frozen, not only those sensing, so that
+    # none of them sees what those sensing before it wrote to a router that
+    # isn't.
+    frozen  = reachable(routers)
+    for router in frozen:
+        router.frozen = None
+        router.frozen = router.snapshot()
+    try:
+        if jobs == 1:
+            for i, router in enumerate(routers):
+                apply_sensing(router, calculate(router, i))
+            return
+
+        # Workers inherit the network when they're forked. multiprocessing.Pool
+        # takes a tenth of a second to shut down, which is often longer than a
+        # phase takes, so this forks workers of its own.
+        context = multiprocessing.get_context("fork") \
+            if hasattr(multiprocessing, "get_context") else multiprocessing
+        flush()
+        if recorder is not None:
+            recorder.flush()
+        sensing = routers
+        workers = []
+        try:
+            for chunk in range(jobs):
+                receiver, sender = context.Pipe(False)
+                worker = context.Process(target=sense_routers,
+                    args=(range(chunk, len(routers), jobs), sender))
+                worker.start()
+                sender.close()
+                workers.append((worker, receiver))
+            results = {}
+            for worker, receiver in workers:
+                results.update(receiver.recv())
+                worker.join()
+        finally:
+            for worker, receiver in workers:
+                if worker.is_alive():
+                    worker.terminate()
+            sensing = None
+        for i, router in enumerate(routers):
+            log_buffer.extend(results[i]["log"])
+            counters.merge(results[i]["counts"])
+            if recorder is not None:
+                recorder.extend(results[i]["records"])
+            apply_sensing(router, results[i])
+    finally:
+        for router in frozen:
+            router.frozen = None
+
+# The routers of the sensing phase in progress, for worker processes.
+sensing = None
+
+def sense_routers(positions, connection):
+    """
+    Calculate trust for the routers at positions in the sensing phase in a
+    worker process, keeping what they log and record to be written out by the
+    parent and what they count to be added to its counters.
+    """
+    global log_buffer_size
+    log_buffer_size = float("inf")
+    results = {}
+    for i in positions:
+        before               = dict(counters)
+        results[i]           = calculate(sensing[i], i)
+        results[i]["log"]    = log_buffer[:]
+        results[i]["counts"] = counters.since(before)
+        results[i]["records"] = recorder.take() if recorder is not None else b""
+        del log_buffer[:]
+    connection.send(results)
+    connection.close()
+
+def calculate(router, i):
+    """
+    Calculate trust for router and return what changed as plain data, since
+    routing table entries refer to their routers and can't be sent whole.
+    """
+    bucket = router.tbucket
+    keys   = dict((n.long_id, (n.id, n.port)) for n in
+                  list(bucket.values()) + list(getattr(bucket, "extent", {}).values()))
+    log("%i %s %s is sensing.", i+1, router, router.node)
+    bucket.calculate_trust()
+
+    def members(nodes):
+        return [(n.long_id, (n.id, n.port), n.trust, n.transactions) for n in nodes]
+
+    # What a PTPBucket knows from last time refers to nodes, routing tables
+    # and renderings, which go by long_id and (id, port) instead. What it
+    # heard is from those in P and EP before it sensed.
+    sensed = getattr(bucket, "sensed", None)
+    if sensed is not None:
+        sensed = [(key, epoch, state, [(m.long_id, (m.id, m.port), response)
+                                       for m, response in said])
+                  for key, (epoch, state, said) in sensed.items()]
+    heard  = getattr(bucket, "heard", None)
+    if heard is not None:
+        heard  = [(long_id, keys.get(long_id) if index is not None else None, version, responses)
+                  for long_id, (index, peers, version, responses) in heard.items()]
+
+    return {
+        "peers":   [(p.trust, p.transactions) for p in router.peers],
+        "bucket":  members(bucket.values()),
+        "extent":  members(getattr(bucket, "extent", {}).values()),
+        "events":  getattr(bucket, "consensus_events", None),
+        "sensed":  sensed,
+        "heard":   heard,
+        "epoch":   getattr(bucket, "epoch", None),
+    }
+
+def apply_sensing(router, result):
+    """
+    Write what calculate() returned back to router and its bucket. The
+    bucket's sets are rebuilt in the order they were iterated in, which keeps
+    how they iterate next time the same however many processes there were.
+    """
+    for peer, (trust, transactions) in zip(router.peers, result["peers"]):
+        peer.trust        = trust
+        peer.transactions = transactions
+
+    bucket = router.tbucket
+    known  = {}
+    for node in list(bucket.values()) + list(getattr(bucket, "extent", {}).values()):
+        known[node.long_id] = node
+
+    def restore(target, members):
+        target.clear()
+        for long_id, key, trust, transactions in members:
+            node = router.peers.lookup(key) or known.get(long_id)
+            if node is None:
+                continue
+            node.trust        = trust
+            node.transactions = transactions
+            target[long_id]   = node
+
+    restore(bucket, result["bucket"])
+    if hasattr(bucket, "extent"):
+        restore(bucket.extent, result["extent"])
+    if result["events"] is not None:
+        bucket.consensus_events = result["events"]
+
+    # So that the next calculate_trust() can pass over what hasn't changed,
+    # as it would have without workers. Renderings are those of the snapshot
+    # sensed against, which routers hold until this phase is over.
+    if result["sensed"] is not None:
+        bucket.sensed = {}
+        for key, epoch, state, said in result["sensed"]:
+            said = [(router.peers.lookup(k) or known.get(long_id), response)
+                    for long_id, k, response in said]
+            bucket.sensed[key] = (epoch, state, [(m, r) for m, r in said if m is not None])
+    if result["heard"] is not None:
+        bucket.heard = {}
+        for long_id, key, version, responses in result["heard"]:
+            index = None
+            if key is not None:
+                # As router.locate() finds it, without counting another lookup.
+                if isinstance(router.routers, RouterDirectory):
+                    located = router.routers.lookup(key)
+                else:
+                    located = [r for r in router.routers if (r.node.id, r.node.port) == key][0]
+                index = located.snapshot()[1]
+            bucket.heard[long_id] = (index, router.peers, version, responses)
+    if result["epoch"] is not None:
+        bucket.epoch = result["epoch"]
+
+    if len(log_buffer) >= log_buffer_size:
+        flush()
+    router.touch()
+
 def configure(repl):
     repl.prompt_style                   = "ipython"
     repl.vi_mode                        = True
@@ -931,7 +2538,7 @@ def configure(repl):
     repl.highlight_matching_parenthesis = True
     repl.use_code_colorscheme("native")
 
-def format(data):
+def format(data, columns=()):
     fmt=[]
     tmp={}
     r_append=0
@@ -941,7 +2548,10 @@ def format(data):
                 if value: tmp[key] = len(str(value))
             elif len(str(value)) > tmp[key]:
                 if value: tmp[key] = len(str(value))
-    for key,value in tmp.items():
+    # The columns given first, then the rest sorted, so that tables come out
+    # the same whichever order dicts iterate in.
+    order = dict((key, i) for i, key in enumerate(columns))
+    for key,value in sorted(tmp.items(), key=lambda item: (order.get(item[0], len(order)), item[0])):
         if (key == 'Hash') or (key =='State'): r_append=(key,key,value)
         else: fmt.append((key, key, value))  
     if r_append: fmt.append(r_append)
@@ -951,12 +2561,14 @@ class tabulate(object):
     "Print a list of dictionaries as a table"
     def __init__(self, fmt, sep=' ', ul=None):
         super(tabulate,self).__init__()
-        self.fmt   = str(sep).join('{lb}{0}:{1}{rb}'.format(key, width, lb='{', rb='}') for heading,key,width in fmt)
+        # Fields are positional, as keys can be anything, like a path.
+        self.fmt   = str(sep).join('{lb}{0}:{1}{rb}'.format(i, width, lb='{', rb='}') for i,(heading,key,width) in enumerate(fmt))
+        self.keys  = [key for heading,key,width in fmt]
         self.head  = {key:heading for heading,key,width in fmt}
         self.ul    = {key:str(ul)*width for heading,key,width in fmt} if ul else None
         self.width = {key:width for heading,key,width in fmt}
     def row(self, data):
-        return(self.fmt.format(**{ k:str(data.get(k,''))[:w] for k,w in self.width.iteritems() }))
+        return(self.fmt.format(*[ str(data.get(k,''))[:self.width[k]] for k in self.keys ]))
     def __call__(self, dataList):
         _r = self.row
         res = [_r(data) for data in dataList]
@@ -965,8 +2577,8 @@ class tabulate(object):
             res.insert(1, _r(self.ul))
         return('\n'.join(res))
 
-def table(data, ts=False):
-    log(tabulate(format(data))(data), with_timestamp=ts)
+def table(data, ts=False, columns=()):
+    log(tabulate(format(data, columns))(data), with_timestamp=ts)
 
 def invoke_ptpython(env={}):
     try:
@@ -980,27 +2592,79 @@ def invoke_ptpython(env={}):
     l = {"p": p}
     l.update(env)
     log("\n^D to exit.", with_timestamp=False)
+    flush()
     embed(locals=l, configure=configure)
 
-def log(message, with_timestamp=True):
+# Log levels. Messages below log_level are dropped before being formatted.
+DEBUG     = 10
+INFO      = 20
+WARNING   = 30
+log_level = INFO
+
+# Lines waiting to be written to stdout. See flush().
+log_buffer      = []
+log_buffer_size = 1000
+
+# The time of day formatted to the second, and the second it's for.
+log_clock       = (None, "")
+
+def set_log_level(level):
+    global log_level
+    log_level = level
+
+def timestamp():
+    """
+    The time of day to the microsecond. Formatting the time of day is the
+    expensive part, so that's done at most once a second.
+    """
+    global log_clock
+    now    = time.time()
+    second = int(now)
+    if log_clock[0] != second:
+        log_clock = (second, time.strftime("%H:%M:%S", time.localtime(second)))
+    return "%s.%06d" % (log_clock[1], (now - second) * 1000000)
+
+def log(message, *args, **kwargs):
+    """
+    Log message at INFO, or at the level given as level=. Any args are only
+    interpolated into message if it's going to be logged.
+    """
+    if kwargs.get("level", INFO) < log_level:
+        return
+
+    if args:
+        message = message % args
+
     if not isinstance(message, (str, unicode)):
         message = pprint.pformat(message)
 
-    if not with_timestamp:
-        print(message)
-        return
+    if not kwargs.get("with_timestamp", True):
+        log_buffer.append(message)
+    else:
+        stamp = timestamp()
+        log_buffer.extend(stamp + " " + _ for _ in message.split("\n"))
+
+    if len(log_buffer) >= log_buffer_size:
+        flush()
 
-    for _ in message.split("\n"):
-        print(datetime.datetime.now().strftime("%H:%M:%S.%f") + " " + _)
+@timed("logging")
+def flush():
+    """
+    Write out buffered log lines. Called at exit and before handing the
+    terminal to anything else.
+    """
+    if log_buffer:
+        sys.stdout.write("\n".join(log_buffer) + "\n")
+        del log_buffer[:]
+    sys.stdout.flush()
+
+atexit.register(flush)
 
 def sort_nodes_by_trust(nodes):
-    if nodes == []: 
-        return []
-    else:
-        pivot   = nodes[0]
-        lesser  = sort_nodes_by_trust([x for x in nodes[1:] if x.trust < pivot.trust])
-        greater = sort_nodes_by_trust([x for x in nodes[1:] if x.trust >= pivot.trust])
-        return greater + [pivot] + lesser
+    """
+    Nodes by descending trust rating, those rated the same in reverse order.
+    """
+    return list(reversed(sorted(nodes, key=lambda node: node.trust)))
 
 class colour:
     purple = '\033[95m' 